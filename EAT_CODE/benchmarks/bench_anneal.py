@@ -0,0 +1,139 @@
+##################################################################################
+# Replay of the eta annealing controllers on recorded minimization histories
+##################################################################################
+# Feeds the epochs of every run below --root (min_progress.txt and min_details.txt) to a controller as
+# if it had run the epoch loop. Recorded runs followed their own eta schedule, so only decisions up to
+# the first stop are replayed exactly. The table compares where each controller stops with the
+# recorded end of the run, and the factors it would have chosen with the recorded ones. The archive has
+# no gradients, so the ones of the gradient balance rule come from the local linear fit of the replay
+# store (modules/replaystore.py) over all recorded runs with the same elements and cell.
+#   python3 benchmarks/bench_anneal.py
+#   python3 benchmarks/bench_anneal.py --root ../DFT/noRelax_noMag --patience 1 3 --json anneal.json
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import modules.histread as hr
+import modules.etaanneal as ea
+import modules.replaystore as rs
+import modules.tqentropy as tq
+
+# replay store of the runs below root with the elements and cell of folder, shared by all such runs
+def history_store(folder, root, stores):
+    progress = hr.read_progress(os.path.join(folder, 'min_progress.txt'))
+    key = (tuple(progress['elements']), progress['iterations'][0]['weights'].shape)
+    if key not in stores:
+        # load_store keeps the runs that match the first one
+        stores[key] = rs.load_store([folder] + [other for other in hr.find_histories(root) if other != folder])
+    return stores[key]
+
+# gradients of the binding term of the cost (eV) and of the Tsallis entropy at weights, flat. The
+# binding gradient is the one of the local fit of the store
+def replay_gradients(store, weights, elements, target, q):
+    binding, grad, _, _ = store.query(weights, elements)
+    return ((binding - target) * grad).flatten(), tq.grad_Tsallis(weights, len(elements), q).flatten()
+
+# epoch summaries of a recorded history, with the DFT evaluations and binding energy after each epoch.
+# Without a store the gradients are None and the controllers skip the gradient balance rule
+def epoch_summaries(history, store=None, q=2):
+    res = []
+    weights = None
+    binding = None
+    epochs = history['epochs']
+    for k, epoch in enumerate(epochs):
+        if epoch['progress']:
+            last = history['iterations'][epoch['progress'][-1]]
+            weights = last['weights']
+            binding = last['binding']
+        # the entropy after an epoch is the one the next epoch starts with
+        if k + 1 < len(epochs):
+            entropy_end = epochs[k + 1]['entropy']
+        elif 'final' in epoch:
+            entropy_end = epoch['final']['entropy']
+        else:
+            break
+        if weights is None or epoch['eta'] is None:
+            continue
+        grad_binding, grad_entropy = None, None
+        if store is not None:
+            grad_binding, grad_entropy = replay_gradients(store, weights, history['elements'], history['target'], q)
+        res.append({'eta': epoch['eta'], 'status': epoch['status'], 'entropy_start': epoch['entropy'], 'entropy_end': entropy_end, 'weights': weights, 'grad_binding': grad_binding, 'grad_entropy': grad_entropy, 'evaluations': epoch['evaluations'], 'binding': binding})
+    return res
+
+def replay(controller, summaries, target):
+    """
+    Runs a controller over the epochs of one recorded history
+
+    Args:
+        controller: Annealing controller (modules/etaanneal.py)
+        summaries: Epoch summaries of epoch_summaries
+        target: Target binding energy (eV)
+
+    Returns:
+        res: Dict with the epoch the controller stops after, the evaluations up to it and after it, the
+            entropy and binding error at the stop, and the factors it chose on the way
+    """
+    factors = []
+    stop = len(summaries)
+    for k, summary in enumerate(summaries):
+        factors.append(controller.next_eta(summary) / summary['eta'])
+        if controller.should_stop(summary):
+            stop = k + 1
+            break
+    last = summaries[stop - 1]
+    return {
+        'stop_epoch': stop,
+        'evaluations': sum(summary['evaluations'] for summary in summaries[:stop]),
+        'saved_evaluations': sum(summary['evaluations'] for summary in summaries[stop:]),
+        'entropy': last['entropy_end'],
+        'binding_error_eV': abs(last['binding'] - target),
+        'factors': factors,
+    }
+
+def main_bench(argv=None):
+    parser = argparse.ArgumentParser(description='Replay of eta annealing controllers on recorded histories')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'DFT'))
+    parser.add_argument('--patience', nargs='+', type=int, default=[1, 2, 3], help='epochs with an unchanged active set before stopping')
+    parser.add_argument('--purity', type=float, default=0.9)
+    parser.add_argument('--q', type=float, default=2, help='Tsallis q of the recorded runs (q of main.py)')
+    parser.add_argument('--no-gradients', action='store_true', help='replay without the gradient balance rule')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"{'run':<28}{'controller':<14}{'epochs':>7}{'evals':>7}{'stop':>6}{'used':>6}{'saved':>7}{'entropy':>11}{'|dE|[eV]':>10}{'end |dE|':>10}  factors (recorded / chosen)")
+    stores = {}
+    for folder in hr.find_histories(args.root):
+        history = hr.read_history(folder)
+        store = None
+        if not args.no_gradients and history['iterations']:
+            store = history_store(folder, args.root, stores)
+        summaries = epoch_summaries(history, store, args.q)
+        if not summaries:
+            continue
+        run = os.path.relpath(folder, args.root)
+        recorded = [summaries[k + 1]['eta'] / summaries[k]['eta'] for k in range(len(summaries) - 1)]
+        controllers = {'fixed': ea.FixedFactor(recorded[0] if recorded else 10)}
+        for patience in args.patience:
+            controllers[f'adaptive p={patience}'] = ea.Adaptive(factor=recorded[0] if recorded else 10, patience=patience, purity=args.purity)
+        end_error = abs(summaries[-1]['binding'] - history['target'])
+        for name, controller in controllers.items():
+            res = replay(controller, summaries, history['target'])
+            res.update({'run': run, 'controller': name, 'epochs': len(summaries), 'total_evaluations': sum(summary['evaluations'] for summary in summaries), 'end_binding_error_eV': end_error, 'recorded_factors': recorded})
+            results.append(res)
+            chosen = ' '.join(f'{factor:g}' for factor in res['factors'][:6])
+            print(f"{run:<28}{name:<14}{res['epochs']:>7}{res['total_evaluations']:>7}{res['stop_epoch']:>6}{res['evaluations']:>6}{res['saved_evaluations']:>7}{res['entropy']:>11.2e}{res['binding_error_eV']:>10.3f}{end_error:>10.3f}  {' '.join(f'{factor:g}' for factor in recorded[:6])} / {chosen}")
+    for name in dict.fromkeys(res['controller'] for res in results):
+        selected = [res for res in results if res['controller'] == name]
+        print(f"{name}: {sum(res['stop_epoch'] for res in selected)} of {sum(res['epochs'] for res in selected)} epochs, {sum(res['evaluations'] for res in selected)} of {sum(res['total_evaluations'] for res in selected)} evaluations, mean |dE| at stop {np.mean([res['binding_error_eV'] for res in selected]):.3f} eV")
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=1)
+    return results
+
+if __name__ == '__main__':
+    main_bench()
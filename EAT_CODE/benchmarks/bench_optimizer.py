@@ -0,0 +1,185 @@
+##################################################################################
+# Benchmark of DFT evaluations per converged design on synthetic binding models
+##################################################################################
+# Runs the epoch loop of main.py (main.run_epochs) against the fake backend.
+#   python3 benchmarks/bench_optimizer.py                      # N = 16 to 1024
+#   python3 benchmarks/bench_optimizer.py --sites 16 64        # CI sized run
+#   python3 benchmarks/bench_optimizer.py --species 4 6 8 --json bench.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+import modules.bsruncalc as bs
+import modules.tqentropy as tq
+import modules.etaanneal as ea
+
+# element names used for the synthetic cells
+element_pool = ['Mn', 'Cu', 'Ni', 'Fe', 'Co', 'Cr', 'Zn', 'Ti']
+
+# synthetic binding models, as settings of the fake backend
+models = {
+    'quadratic': {'model': 'quadratic'},
+    'random_feature': {'model': 'random_feature'},
+    'noisy_gradient': {'model': 'quadratic', 'grad_noise': 2e-4},
+}
+
+# ion lines of N mixed sites on a square grid in the plane of the surface
+def synthetic_positions(N):
+    side = int(np.ceil(np.sqrt(N)))
+    return [f'ion mix{i+1}   {(i % side) / side:.6f}   {(i // side) / side:.6f}   0.1   1\n' for i in range(N)]
+
+# electronic iterations of all runs, from the logs of the fake jdftx
+def count_scf_iterations(run_folder):
+    res = 0
+    for calc in os.listdir(run_folder):
+        for adsorbate in ['O', 'OH']:
+            out_path = os.path.join(run_folder, calc, adsorbate, f'{adsorbate}.out')
+            if os.path.exists(out_path):
+                with open(out_path, 'r') as file:
+                    res += sum(1 for line in file if line.startswith('ElecMinimize: Iter:'))
+    return res
+
+def run_case(model, N, S, num_epochs, maxit, memory, seed, inexact=False, alphas=None, warm_start=False, structured=False, annealing='fixed', multi_secant=None, backend_config=None, elements=None, positions_ordered=None, x0=None, wfns_store=False, cross_seed=False, target=None):
+    """
+    Runs one optimization in the current folder
+
+    Args:
+        model: Name of the synthetic model
+        N: Number of mixed sites
+        S: Number of elements
+        num_epochs: Maximum number of epochs
+        maxit: Maximum PBFGS iterations per epoch
+        memory: Number of (s, y) pairs in limited-memory mode, None for a dense quasi-Hessian
+        seed: Seed of the initial weights and of the model
+        inexact: Loosen the DFT thresholds far from convergence (main.dft_tolerance)
+        alphas: Step sizes of the speculative line search, None for serial trials
+        warm_start: Carry the quasi-Hessian across epochs (warm_start_hessian of main.py)
+        structured: Structured quasi-Newton (main.residual and main.entropy_hessian)
+        multi_secant: Number of earlier points in the multi-secant update, None for the accepted step only
+        annealing: 'fixed' multiplies eta by 10 every epoch, 'adaptive' uses ea.Adaptive(factor=10)
+        wfns_store: Start every run from the nearest stored state (bsruncalc.wfns_store)
+        cross_seed: Start the OH runs from the converged state of the O run (bsruncalc.perform_calc)
+        backend_config: JDFTx settings used instead of the fake model (e.g. the replay backend)
+        elements: Elements, the first S of element_pool if None
+        positions_ordered: Ion lines, N synthetic sites if None
+        x0: Initial weights, random around the uniform composition if None
+        target: Target binding energy (Hartree) optimized toward and scored against, main.target if None
+
+    Returns:
+        res: Dict with evaluations, line-search failures, epochs, wall time and final entropy
+    """
+    if backend_config is None:
+        backend_config = {'backend': 'fake', 'cache': False, 'concurrent': False, 'fake': dict(models[model], seed=seed)}
+    bs.configure(dict(backend_config, wfns_store=wfns_store, cross_seed=cross_seed), config_file=None)
+    if target is None:
+        target = main.target
+    if elements is None:
+        elements = element_pool[:S]
+    if positions_ordered is None:
+        positions_ordered = synthetic_positions(N)
+    details_file_path = os.path.join(os.getcwd(), 'min_details.txt')
+    x = main.initial_weights(N, S, seed)
+    if x0 is not None:
+        x = np.array(x0, dtype=float).flatten()
+
+    start_time = time.time()
+    eta = 1e-5
+    unique_folder = main.initial_evaluation(x, eta, elements, positions_ordered)
+    controller = ea.Adaptive(factor=10) if annealing == 'adaptive' else ea.FixedFactor(10)
+    epoch_stats = []
+    x, eta, B, unique_folder = main.run_epochs(x, eta, unique_folder, elements, positions_ordered, controller, num_epochs, maxit, memory=memory, inexact=inexact, speculative_alphas=alphas, structured=structured, multi_secant=multi_secant, warm_start=warm_start, details_file_path=details_file_path, epoch_stats=epoch_stats, target_binding=target)
+    statuses = [stats['status'] for stats in epoch_stats]
+    wall_time = time.time() - start_time
+    evaluations = len([name for name in os.listdir('runs') if name.startswith('calc_')])
+    # evaluations that run at the same time count as one round of wall-clock time
+    rounds = evaluations
+    if alphas is not None:
+        with open(details_file_path, 'r') as file:
+            rounds -= (len(alphas) - 1) * sum(1 for line in file if 'in parallel' in line)
+
+    binding = main.binding(x, unique_folder, elements, target, 0, main.q)
+    return {
+        'model': model,
+        'N': N,
+        'S': S,
+        'evaluations': evaluations,
+        'rounds': rounds,
+        'scf_iterations': count_scf_iterations('runs'),
+        'line_search_failures': sum(stats['line_search_failures'] for stats in epoch_stats),
+        'epochs': len(epoch_stats),
+        'converged_epochs': statuses.count('converged'),
+        'wall_time': wall_time,
+        'final_entropy': tq.Tsallis(x, S=S, q=1),
+        'binding_error_eV': abs(main.h2eV(binding - target)),
+    }
+
+def main_bench(argv=None):
+    parser = argparse.ArgumentParser(description='DFT evaluations per converged design on synthetic binding models')
+    parser.add_argument('--models', nargs='+', default=list(models), choices=list(models))
+    parser.add_argument('--sites', nargs='+', type=int, default=[16, 64, 256, 1024])
+    parser.add_argument('--species', nargs='+', type=int, default=[4, 8])
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--maxit', type=int, default=12)
+    parser.add_argument('--memory', type=int, default=10, help='limited-memory pairs used above --dense-limit variables')
+    parser.add_argument('--dense-limit', type=int, default=1024, help='largest N*S solved with a dense quasi-Hessian')
+    parser.add_argument('--inexact', action='store_true', help='adaptive DFT thresholds (inexact-gradient mode)')
+    parser.add_argument('--alphas', nargs='+', type=float, default=None, help='speculative line search step sizes, e.g. 1 0.5 0.25')
+    parser.add_argument('--warm-start', action='store_true', help='carry the quasi-Hessian across epochs')
+    parser.add_argument('--structured', action='store_true', help='structured quasi-Newton with the exact entropy Hessian')
+    parser.add_argument('--anneal', default='fixed', choices=['fixed', 'adaptive'], help='eta schedule between epochs')
+    parser.add_argument('--multi-secant', type=int, default=None, help='earlier points used in every quasi-Hessian update')
+    parser.add_argument('--wfns-store', action='store_true', help='start every run from the nearest stored wavefunctions')
+    parser.add_argument('--cross-seed', action='store_true', help='start the OH runs from the converged O state')
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0])
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the run folders')
+    args = parser.parse_args(argv)
+
+    results = []
+    header = f"{'model':<16}{'N':>6}{'S':>4}{'seed':>6}{'evals':>8}{'rounds':>8}{'scf_it':>9}{'ls_fail':>9}{'epochs':>8}{'ev/ep':>7}{'wall[s]':>10}{'entropy':>12}{'|dE|[eV]':>11}"
+    print(header)
+    for model in args.models:
+        for N in args.sites:
+            for S in args.species:
+                for seed in args.seeds:
+                    memory = args.memory if N * S > args.dense_limit else None
+                    work_folder = tempfile.mkdtemp(prefix=f'bench_{model}_{N}_{S}_')
+                    cwd = os.getcwd()
+                    os.chdir(work_folder)
+                    try:
+                        # the folder helpers report every file they move, keep only the table
+                        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                            res = run_case(model, N, S, args.epochs, args.maxit, memory, seed, inexact=args.inexact, alphas=args.alphas, warm_start=args.warm_start, structured=args.structured, annealing=args.anneal, multi_secant=args.multi_secant, wfns_store=args.wfns_store, cross_seed=args.cross_seed)
+                    finally:
+                        os.chdir(cwd)
+                        if not args.keep:
+                            shutil.rmtree(work_folder, ignore_errors=True)
+                    res['seed'] = seed
+                    res['memory'] = memory
+                    res['inexact'] = args.inexact
+                    res['alphas'] = args.alphas
+                    res['warm_start'] = args.warm_start
+                    res['structured'] = args.structured
+                    res['annealing'] = args.anneal
+                    res['multi_secant'] = args.multi_secant
+                    res['wfns_store'] = args.wfns_store
+                    res['cross_seed'] = args.cross_seed
+                    results.append(res)
+                    print(f"{model:<16}{N:>6}{S:>4}{seed:>6}{res['evaluations']:>8}{res['rounds']:>8}{res['scf_iterations']:>9}{res['line_search_failures']:>9}{res['epochs']:>8}{res['evaluations'] / res['epochs']:>7.1f}{res['wall_time']:>10.2f}{res['final_entropy']:>12.3e}{res['binding_error_eV']:>11.2e}", flush=True)
+    print(f"Total evaluations: {sum(res['evaluations'] for res in results)}, rounds: {sum(res['rounds'] for res in results)}, SCF iterations: {sum(res['scf_iterations'] for res in results)}")
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=1)
+    return results
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,86 @@
+##################################################################################
+# Reruns the optimizer against recorded DFT results of the archived runs
+##################################################################################
+# Every archived run is restarted from its recorded initial weights with the replay backend, whose
+# store holds the other runs (--include-self adds the run itself). Both the recorded final design
+# and the replayed one are scored with the same store against the target of the run, so the |dE|
+# columns compare like with like.
+#   python3 benchmarks/bench_replay.py
+#   python3 benchmarks/bench_replay.py --root ../DFT/noRelax_noMag --structured --warm-start --inexact --anneal adaptive
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+import benchmarks.bench_optimizer as bo
+import modules.histread as hr
+import modules.replaystore as rp
+import modules.tqentropy as tq
+
+# ion lines of a run folder, mixed sites first as main.py orders them
+def read_positions(folder):
+    with open(os.path.join(folder, 'positions.txt'), 'r') as file:
+        lines = file.readlines()
+    return [line for line in lines if 'mix' in line] + [line for line in lines if 'mix' not in line and 'ion' in line]
+
+def main_bench(argv=None):
+    parser = argparse.ArgumentParser(description='Optimizer reruns against recorded DFT results')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'DFT', 'noRelax_noMag'))
+    parser.add_argument('--mode', default='linear', choices=['linear', 'nearest'])
+    parser.add_argument('--include-self', action='store_true', help='keep the replayed run in the store')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--maxit', type=int, default=12)
+    parser.add_argument('--inexact', action='store_true')
+    parser.add_argument('--alphas', nargs='+', type=float, default=None)
+    parser.add_argument('--warm-start', action='store_true')
+    parser.add_argument('--structured', action='store_true')
+    parser.add_argument('--anneal', default='fixed', choices=['fixed', 'adaptive'])
+    parser.add_argument('--multi-secant', type=int, default=None)
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args(argv)
+    # the runs are replayed in temporary folders, where a relative root would not resolve
+    args.root = os.path.abspath(args.root)
+
+    folders = [folder for folder in hr.find_histories(args.root) if hr.read_progress(os.path.join(folder, 'min_progress.txt'))['iterations']]
+    results = []
+    print(f"{'run':<14}{'rec evals':>10}{'rec |dE|':>10}{'evals':>7}{'epochs':>8}{'|dE|[eV]':>10}{'entropy':>11}{'wall[s]':>9}")
+    for folder in folders:
+        history = hr.read_history(folder)
+        store_runs = folders if args.include_self else [other for other in folders if other != folder]
+        store = rp.load_store(store_runs)
+        elements = history['elements']
+        x0 = history['iterations'][0]['weights']
+        recorded_final = history['iterations'][-1]['weights']
+        # every recorded epoch evaluates its line search trials, plus the first calculation
+        recorded_evaluations = 1 + sum(epoch['evaluations'] for epoch in history['epochs'])
+        recorded_error = abs(store.query(recorded_final, elements, args.mode)[0] - history['target'])
+        backend_config = {'backend': 'replay', 'cache': False, 'concurrent': False, 'replay': {'runs': store_runs, 'mode': args.mode}}
+        work_folder = tempfile.mkdtemp(prefix='bench_replay_')
+        cwd = os.getcwd()
+        os.chdir(work_folder)
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                res = bo.run_case('replay', x0.shape[0], len(elements), args.epochs, args.maxit, None, 0, inexact=args.inexact, alphas=args.alphas, warm_start=args.warm_start, structured=args.structured, annealing=args.anneal, multi_secant=args.multi_secant, backend_config=backend_config, elements=elements, positions_ordered=read_positions(folder), x0=x0, target=main.eV2h(history['target']))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_folder, ignore_errors=True)
+        run = os.path.basename(folder)
+        res.update({'run': run, 'recorded_evaluations': recorded_evaluations, 'recorded_binding_error_eV': recorded_error, 'recorded_entropy': tq.Tsallis(recorded_final, S=len(elements), q=1)})
+        results.append(res)
+        print(f"{run:<14}{recorded_evaluations:>10}{recorded_error:>10.3f}{res['evaluations']:>7}{res['epochs']:>8}{res['binding_error_eV']:>10.3f}{res['final_entropy']:>11.2e}{res['wall_time']:>9.2f}", flush=True)
+    print(f"Recorded: {sum(res['recorded_evaluations'] for res in results)} evaluations, mean |dE| {np.mean([res['recorded_binding_error_eV'] for res in results]):.3f} eV")
+    print(f"Replayed: {sum(res['evaluations'] for res in results)} evaluations, mean |dE| {np.mean([res['binding_error_eV'] for res in results]):.3f} eV, {sum(res['wall_time'] for res in results):.1f} s")
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=1)
+    return results
+
+if __name__ == '__main__':
+    main_bench()
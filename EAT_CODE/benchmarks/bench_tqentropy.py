@@ -0,0 +1,91 @@
+##################################################################################
+# Timing of the Tsallis entropy functions against the per-site loop they replaced
+##################################################################################
+# Every case first checks the vectorized values against the loop for all input layouts.
+#   python3 benchmarks/bench_tqentropy.py
+#   python3 benchmarks/bench_tqentropy.py --sites 16 1024 --species 4 8 --batch 1000
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import modules.tqentropy as tq
+
+# the per-site loops used before the module was vectorized, as reference
+def Tsallis_loop(w, S, q):
+    w_full = w.reshape(-1, S)
+    res = 0
+    for i in range(w_full.shape[0]):
+        if q==1:
+            res += -np.sum(w_full[i, :] * np.log(w_full[i, :]+1e-10))
+        else:
+            res += 1/(q-1) * (1-np.sum(w_full[i, :]**q))
+    return res
+
+def grad_Tsallis_loop(w, S, q):
+    w_full = w.reshape(-1, S)
+    grad_full = np.zeros(w_full.shape)
+    for i in range(w_full.shape[0]):
+        if q==1:
+            grad_full[i, :] = -(np.log(w_full[i, :] + 1e-10) + 1)
+        else:
+            grad_full[i, :] = -q/(q-1) * w_full[i, :]**(q-1)
+    return grad_full.flatten()
+
+# every input layout against the per-site loop: flat, (N, S), a batch of flat designs and (batch, N, S)
+def check_layouts(N, S, q, batch=3):
+    rng = np.random.default_rng(1)
+    # weights away from 0, where the loop (log(w + 1e-10)) and the module (log(max(w, 1e-12))) agree
+    W = 0.5 * rng.dirichlet(np.ones(S), size=(batch, N)) + 0.5 / S
+    expected = np.array([Tsallis_loop(W[b].flatten(), S, q) for b in range(batch)])
+    expected_grad = np.array([grad_Tsallis_loop(W[b].flatten(), S, q) for b in range(batch)])
+    cases = [(W[0].flatten(), expected[0], expected_grad[0]), (W[0], expected[0], expected_grad[0].reshape(N, S)), (W, expected, expected_grad.reshape(batch, N, S))]
+    # flat single-site designs (batch, S) read as one (N, S) design
+    if N > 1:
+        cases.append((W.reshape(batch, -1), expected, expected_grad))
+    for w, value, grad in cases:
+        res = tq.Tsallis(w, S, q)
+        assert np.shape(res) == np.shape(value), f'Tsallis of a {w.shape} input has shape {np.shape(res)}, expected {np.shape(value)}'
+        assert np.allclose(res, value, atol=1e-8), f'Tsallis of a {w.shape} input differs from the loop'
+        assert np.allclose(tq.grad_Tsallis(w, S, q), grad, atol=1e-6), f'grad_Tsallis of a {w.shape} input differs from the loop'
+
+# best time of repeats calls, in seconds per call
+def time_call(func, repeats=5, number=None):
+    if number is None:
+        start = time.perf_counter()
+        func()
+        number = max(1, int(0.05 / max(time.perf_counter() - start, 1e-7)))
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def main_bench(argv=None):
+    parser = argparse.ArgumentParser(description='Tsallis entropy timings, vectorized against the per-site loop')
+    parser.add_argument('--sites', nargs='+', type=int, default=[16, 64, 256, 1024])
+    parser.add_argument('--species', nargs='+', type=int, default=[4, 8])
+    parser.add_argument('--q', nargs='+', type=float, default=[1, 2])
+    parser.add_argument('--batch', type=int, default=256, help='designs per batched call')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    print(f"{'N':>6}{'S':>4}{'q':>5}{'loop f+g [us]':>16}{'vec f+g [us]':>15}{'speedup':>9}{'batch f+g+h [us/design]':>26}")
+    for N in args.sites:
+        for S in args.species:
+            for q in args.q:
+                check_layouts(N, S, q)
+                w = rng.dirichlet(np.ones(S), size=N).flatten()
+                W = rng.dirichlet(np.ones(S), size=(args.batch, N))
+                loop = time_call(lambda: (Tsallis_loop(w, S, q), grad_Tsallis_loop(w, S, q)))
+                vec = time_call(lambda: (tq.Tsallis(w, S, q), tq.grad_Tsallis(w, S, q)))
+                batch = time_call(lambda: tq.derivatives_Tsallis(W, S, q)) / args.batch
+                print(f"{N:>6}{S:>4}{q:>5g}{loop * 1e6:>16.1f}{vec * 1e6:>15.1f}{loop / vec:>9.1f}{batch * 1e6:>26.2f}")
+
+if __name__ == '__main__':
+    main_bench()
@@ -3,21 +3,58 @@
 ###############################################################################
 
 # imports
-import subprocess
 import os
 import numpy as np
 import shutil
 import time
+import json
 import modules.cdmfolders as cdm
+import modules.egread as eg
+import modules.jbbackend as jb
+import modules.rescache as rc
+import modules.wfnstore as ws
+import modules.outread as ot
+import modules.watchdog as wd
+import modules.jbretry as jr
+
+# backend settings, the backend that runs jdftx, the result cache and the wavefunction store, set from main.py through configure()
+config = None
+backend = None
+cache = None
+wfns_store = None
+
+# set the backend, rank count and binary path used for every following calculation
+def configure(user_config=None, config_file='jdftx_config.json'):
+    global config, backend, cache, wfns_store
+    config = jb.load_config(user_config, config_file=config_file)
+    backend = jb.make_backend(config)
+    if config['cache']:
+        cache = rc.ResultCache(config['cache_dir'], max_bytes=config['cache_max_bytes'], identity=rc.binary_identity(config))
+    else:
+        cache = None
+    if config['wfns_store']:
+        wfns_store = ws.WavefunctionStore(config['wfns_store_dir'], max_bytes=config['wfns_store_max_bytes'])
+    else:
+        wfns_store = None
+    return config
+
+# backend in use, falling back to the defaults if configure was never called
+def get_backend():
+    if backend is None:
+        configure()
+    return backend
 
 # writes the bulk input file for certain specified elements and weights
-def write_input_surface(weights, adsorbate, elements, folder, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos):
+def write_input_surface(weights, adsorbate, elements, folder, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos, tolerance=None):
     mix_count = weights.shape[0]
     num_species = weights.shape[1]
     prefix = f'{adsorbate}'
 
-    # generic input params
-    input_file_0 = generic_inputs(adsorbate)
+    # generic input params, with the electronic convergence threshold asked for by the optimizer if any
+    if tolerance is None:
+        input_file_0 = generic_inputs(adsorbate)
+    else:
+        input_file_0 = generic_inputs(adsorbate, tolerance)
 
     # initialize
     input_file_2 = []
@@ -110,35 +147,84 @@ def write_input_surface(weights, adsorbate, elements, folder, first_iteration, g
     except Exception as e:
         print(f"An error occurred: {e}")
 
-def run_jdftx(input_file, output_file):
-    cwd = os.getcwd()
-    # The --oversubscribe option is sometimes needed if Open MPI finds fewer slots than requested.
-    command = (
-        f"mpirun --oversubscribe --bind-to none -n 9 "
-        f"/data2/jt577/jdftx_eat_withLibXC/build/jdftx -i {cwd}/{input_file} | tee {cwd}/{output_file}"
-    )
-    subprocess.run(command, shell=True, check=True)
+# runs jdftx in working_folder through the configured backend; this will block until complete
+def run_jdftx(input_file, output_file, working_folder=None, ranks=None):
+    if working_folder is None:
+        working_folder = os.getcwd()
+    backend = get_backend()
+    job = backend.submit(input_file, output_file, working_folder, ranks=ranks)
+    return jr.wait_jobs(backend, [job], config['retry'])[0]
 
 
-def energy_surface(w, adsorbate, elements, folder, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos):
+# starts one run. seed_state is a converged state file to start from (e.g. the O run of the same
+# weights for OH), otherwise the wavefunction store picks one if it is enabled
+def energy_surface(w, adsorbate, elements, folder, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos, ranks=None, tolerance=None, seed_state=None):
     prefix = f'{adsorbate}'
     num_species = len(elements)
     weights = w.reshape(-1, num_species)
 
-    write_input_surface(weights, adsorbate, elements, folder, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos)
-    original_cwd = os.getcwd()
+    write_input_surface(weights, adsorbate, elements, folder, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos, tolerance=tolerance)
+    working_folder = os.path.join(folder, prefix)
+    backend = get_backend()
+    # identical inputs were already computed, copy their outputs instead of running
+    if cache is not None and cache.fetch(os.path.join(working_folder, f'{prefix}.in')):
+        return None
+    if seed_state is not None and os.path.exists(seed_state):
+        shutil.copy(seed_state, os.path.join(working_folder, f'{prefix}.wfns'))
+        print(f"Initial state of '{working_folder}' taken from '{seed_state}'.")
+    # start from the nearest stored state rather than the one of the last adopted evaluation
+    elif wfns_store is not None:
+        wfns_store.seed(os.path.join(working_folder, f'{prefix}.in'))
+    # submit without waiting and return the job so the caller decides when to wait
+    return backend.submit(f'{adsorbate}.in', f'{adsorbate}.out', working_folder, ranks=ranks)
+
+
+# split the available ranks as evenly as possible between num_runs simultaneous runs
+def split_ranks(total_ranks, num_runs):
+    base, extra = divmod(total_ranks, num_runs)
+    ranks = [base + 1 if i < extra else base for i in range(num_runs)]
+    return [max(r, 1) for r in ranks]
+
+# wait for all jobs, cancelling the rest as soon as one of them fails for good. Runs that fail for a
+# transient reason are resubmitted (see jbretry.py), the others fail the trial (TrialFailed). Jobs
+# that are None were served from the result cache, finished runs are added to it and to the
+# wavefunction store. With the watchdog enabled, runs that diverge or stall are stopped as well
+def wait_all(jobs):
+    backend = get_backend()
+    jobs = [job for job in jobs if job is not None]
     try:
-        working_folder = os.path.join(folder, prefix)
-        os.chdir(working_folder)
-        # Run the DFT calc; this will block until complete.
-        run_jdftx(f'{adsorbate}.in', f'{adsorbate}.out')
-    finally:
-        os.chdir(original_cwd)
-    # No job_id to return since the call was synchronous.
-    return None
+        jr.wait_jobs(backend, jobs, config['retry'], supervise=watch_jobs if config['watchdog']['enabled'] else None)
+    except Exception:
+        for job in jobs:
+            backend.cancel(job)
+        raise
+    for job in jobs:
+        if cache is not None:
+            cache.store(os.path.join(job.folder, job.input_file))
+        if wfns_store is not None:
+            wfns_store.store(os.path.join(job.folder, job.input_file))
+
+# watchdog pass of wait_all: stopped runs are replaced in jobs by their resubmissions, the ones it
+# gives up fail the trial
+def watch_jobs(jobs):
+    res, failures = wd.supervise(get_backend(), jobs, config['watchdog'])
+    jobs[:] = res
+    if failures:
+        raise jb.TrialFailed('; '.join(f"'{os.path.join(job.folder, job.input_file)}' {reason}" for job, reason in failures))
+
 
+# ranks of the O and OH runs of one evaluation when num_calcs evaluations run at the same time. Local
+# runs share the node and split the ranks, batch jobs each get their own allocation
+def calc_ranks(num_calcs=1):
+    if config['backend'] == 'local':
+        return split_ranks(config['num_ranks'], 2 * num_calcs)[:2]
+    return [config['num_ranks']] * 2
 
-def perform_calc(w, elements, target, eta, q, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos):
+# starts the O and OH calculations for weights w without waiting for them. With copy_wfns the
+# shared wavefunctions are copied instead of moved, so several trials can start from them. Only the
+# runs of adsorbates are started (with the ranks in the same order), the caller submits the others
+def submit_calc(w, elements, target, eta, q, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos, tolerance=None, ranks=None, copy_wfns=False, adsorbates=('O', 'OH')):
+    start_time = time.time()
     base_path = os.getcwd()
     run_folder = cdm.create_subfolder(folder_path=base_path, subfolder_name='runs')
     unique_folder = cdm.create_unique_folder(base_path=run_folder, prefix='calc_')
@@ -146,16 +232,120 @@ def perform_calc(w, elements, target, eta, q, first_iteration, generic_inputs, l
     O_path = cdm.create_subfolder(folder_path=unique_folder, subfolder_name='O')
     OH_path = cdm.create_subfolder(folder_path=unique_folder, subfolder_name='OH')
     wfns_path = cdm.create_subfolder(folder_path=run_folder, subfolder_name='wavefunctions')
-    cdm.mv_wfns_to_unique(source_folder=wfns_path, destination_folders=[O_path, OH_path])
+    if copy_wfns:
+        cdm.cp_wfns_to_unique(source_folder=wfns_path, destination_folders=[O_path, OH_path])
+    else:
+        cdm.mv_wfns_to_unique(source_folder=wfns_path, destination_folders=[O_path, OH_path])
+
+    if ranks is None:
+        ranks = calc_ranks()
+    backend = get_backend()
+    jobs = []
+    try:
+        for i, adsorbate in enumerate(adsorbates):
+            jobs.append(energy_surface(w, adsorbate=adsorbate, elements=elements, folder=unique_folder, first_iteration=first_iteration, generic_inputs=generic_inputs, lattice=lattice, positions_ordered=positions_ordered, ads_O_pos=ads_O_pos, ads_OH_pos=ads_OH_pos, ranks=ranks[i], tolerance=tolerance))
+    except Exception:
+        for job in jobs:
+            if job is not None:
+                backend.cancel(job)
+        raise
+    return {'folder': unique_folder, 'jobs': jobs, 'elements': tuple(elements), 'start_time': start_time}
 
-    # Each energy calculation now blocks until finished.
-    energy_surface(w, adsorbate='O', elements=elements, folder=unique_folder, first_iteration=first_iteration, generic_inputs=generic_inputs, lattice=lattice, positions_ordered=positions_ordered, ads_O_pos=ads_O_pos, ads_OH_pos=ads_OH_pos)
-    energy_surface(w, adsorbate='OH', elements=elements, folder=unique_folder, first_iteration=first_iteration, generic_inputs=generic_inputs, lattice=lattice, positions_ordered=positions_ordered, ads_O_pos=ads_O_pos, ads_OH_pos=ads_OH_pos)
+# wall time and electronic iterations of the O and OH runs of an evaluation (None for cached runs)
+def write_timing(unique_folder, start_time):
+    elec_iterations = {}
+    for adsorbate in ['O', 'OH']:
+        out_path = os.path.join(unique_folder, adsorbate, f'{adsorbate}.out')
+        elec_iterations[adsorbate] = ot.summarize_file(out_path)['elec_iterations'] if os.path.exists(out_path) else None
+    with open(os.path.join(unique_folder, 'timing.json'), 'w') as file:
+        json.dump({'wall_time': time.time() - start_time, 'elec_iterations': elec_iterations}, file)
+
+# electronic iterations of the O and OH runs of all evaluations below run_folder
+def elec_iteration_totals(run_folder='runs'):
+    res = {'evaluations': 0, 'O': 0, 'OH': 0}
+    for name in sorted(os.listdir(run_folder)) if os.path.isdir(run_folder) else []:
+        timing_file = os.path.join(run_folder, name, 'timing.json')
+        if not os.path.exists(timing_file):
+            continue
+        with open(timing_file, 'r') as file:
+            elec_iterations = json.load(file).get('elec_iterations', {})
+        res['evaluations'] += 1
+        for adsorbate in ['O', 'OH']:
+            res[adsorbate] += elec_iterations.get(adsorbate) or 0
+    return res
+
+# waits for a submitted calculation and returns its evaluation record. With adopt its wavefunctions
+# and relaxed positions become the starting point of the following calculations
+def collect_calc(pending, adopt=True):
+    try:
+        wait_all(pending['jobs'])
+    except jb.TrialFailed:
+        # the wavefunctions the runs started from go back, or away if they were copies
+        if adopt:
+            restore_wfns(pending['folder'])
+        else:
+            discard_wfns(pending['folder'])
+        raise
+    write_timing(pending['folder'], pending['start_time'])
+    if adopt:
+        adopt_calc(pending['folder'])
+    return eg.load_evaluation(pending['folder'], pending['elements'])
 
+# make the wavefunctions and positions of a finished calculation the shared starting point
+def adopt_calc(unique_folder):
+    run_folder = os.path.dirname(unique_folder)
     wfns_path = cdm.create_subfolder(folder_path=run_folder, subfolder_name='wavefunctions')
     cdm.mv_wfns_from_unique(source_folder=unique_folder, destination_folder=wfns_path)
 
     pos_path = cdm.create_subfolder(folder_path=run_folder, subfolder_name='positions')
     cdm.mv_pos_surface(source_folder=unique_folder, destination_folder=pos_path)
 
-    return unique_folder
\ No newline at end of file
+# stop a submitted calculation that is no longer needed. Runs that already finished are kept in the
+# cache and the wavefunction store
+def cancel_calc(pending):
+    backend = get_backend()
+    for job in pending['jobs']:
+        if job is None:
+            continue
+        if backend.poll(job) == 'done':
+            if cache is not None:
+                cache.store(os.path.join(job.folder, job.input_file))
+            if wfns_store is not None:
+                wfns_store.store(os.path.join(job.folder, job.input_file))
+        else:
+            backend.cancel(job)
+    discard_wfns(pending['folder'])
+
+# remove the wavefunctions of a calculation that was not adopted, they are not needed again
+def discard_wfns(unique_folder):
+    for adsorbate in ['O', 'OH']:
+        file_path = os.path.join(unique_folder, adsorbate, f'{adsorbate}.wfns')
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+# return the wavefunctions of a failed calculation to the shared starting point. Stopped runs never
+# dump theirs, so the files still hold the states they started from
+def restore_wfns(unique_folder):
+    wfns_path = cdm.create_subfolder(folder_path=os.path.dirname(unique_folder), subfolder_name='wavefunctions')
+    cdm.mv_wfns_from_unique(source_folder=unique_folder, destination_folder=wfns_path)
+
+# runs the O and OH calculations for weights w and returns the parsed evaluation record. tolerance
+# is the electronic energy threshold (Hartree) to converge to, None keeps the one of generic_inputs.
+# With cross_seed the O run goes first and the OH run starts from its converged state, the slabs
+# only differ by the H atom
+def perform_calc(w, elements, target, eta, q, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos, tolerance=None):
+    if config['concurrent'] and not config['cross_seed']:
+        # O and OH are independent, so launch both at once and return once both have finished
+        pending = submit_calc(w, elements, target, eta, q, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos, tolerance=tolerance)
+        return collect_calc(pending)
+
+    # O first with all ranks, then OH
+    pending = submit_calc(w, elements, target, eta, q, first_iteration, generic_inputs, lattice, positions_ordered, ads_O_pos, ads_OH_pos, tolerance=tolerance, ranks=[None], adsorbates=['O'])
+    try:
+        wait_all(pending['jobs'])
+    except jb.TrialFailed:
+        restore_wfns(pending['folder'])
+        raise
+    seed_state = os.path.join(pending['folder'], 'O', 'O.wfns') if config['cross_seed'] else None
+    pending['jobs'] = [energy_surface(w, adsorbate='OH', elements=elements, folder=pending['folder'], first_iteration=first_iteration, generic_inputs=generic_inputs, lattice=lattice, positions_ordered=positions_ordered, ads_O_pos=ads_O_pos, ads_OH_pos=ads_OH_pos, tolerance=tolerance, seed_state=seed_state)]
+    return collect_calc(pending)
@@ -16,13 +16,19 @@ def create_subfolder(folder_path, subfolder_name):
     
     return subfolder_path
 
-# creates unique folder based on current timestamp
+# creates unique folder based on current timestamp, adding a counter if several are made within one second
 def create_unique_folder(base_path, prefix="calc_"):
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     folder_name = f"{prefix}{timestamp}"
     unique_folder_path = os.path.join(base_path, folder_name)
-    os.makedirs(unique_folder_path)
-    return unique_folder_path
+    counter = 1
+    while True:
+        try:
+            os.makedirs(unique_folder_path)
+            return unique_folder_path
+        except FileExistsError:
+            unique_folder_path = os.path.join(base_path, f"{folder_name}-{counter}")
+            counter += 1
 
 # removes folder
 def remove_folder(folder):
@@ -73,6 +79,21 @@ def mv_wfns_to_unique(source_folder, destination_folders):
             print(f"File '{file_path}' does not exist and cannot be copied.")
             numit += 1
 
+# copy wavefunctions from wavefn folder to unique folder, leaving them in place for other runs
+def cp_wfns_to_unique(source_folder, destination_folders):
+    wf_files = [
+        os.path.join(source_folder, f'O.wfns'),
+        os.path.join(source_folder, f'OH.wfns')
+    ]
+
+    for file_path, destination_folder in zip(wf_files, destination_folders):
+        if os.path.exists(file_path):
+            dest_path = os.path.join(destination_folder, os.path.basename(file_path))
+            shutil.copy(file_path, dest_path)
+            print(f"File '{file_path}' has been copied to '{dest_path}'.")
+        else:
+            print(f"File '{file_path}' does not exist and cannot be copied.")
+
 # move wavefns from unique folder to wavefn folder
 def mv_wfns_from_unique(source_folder, destination_folder):   
     # Ensure the destination folder exists, if not, create it
@@ -0,0 +1,20 @@
+#####################################################################
+# Saving and loading the optimizer state so a killed run can resume
+#####################################################################
+# imports
+import os
+import pickle
+
+# write the state atomically: a crash while writing leaves the previous checkpoint intact
+def save_checkpoint(path, state):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+# read the state written by save_checkpoint
+def load_checkpoint(path):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
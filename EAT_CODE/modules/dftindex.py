@@ -0,0 +1,285 @@
+###############################################################################
+# Incremental SQLite index of the DFT archive
+###############################################################################
+# Scans an archive (e.g. ../DFT) once and keeps one row per recorded iteration, epoch, JDFTx run
+# and Lowdin moment, so analyses can query instead of walking the tree and parsing text again.
+# Every row remembers the file it came from. A rescan only parses files whose size or modification
+# time changed, and drops the rows of files that are gone.
+#   python3 -m modules.dftindex scan ../DFT --db dft_index.sqlite
+#   python3 -m modules.dftindex runs --db dft_index.sqlite
+#   python3 -m modules.dftindex sql "SELECT run, AVG(duration_s) FROM outs GROUP BY run" --db dft_index.sqlite
+
+# imports
+import os
+import re
+import sys
+import json
+import sqlite3
+import argparse
+import numpy as np
+import modules.histread as hr
+import modules.outread as ot
+
+# tables, every one with the file its rows were read from
+schema = [
+    "CREATE TABLE IF NOT EXISTS files (file TEXT PRIMARY KEY, size INTEGER, mtime REAL, kind TEXT, run TEXT)",
+    "CREATE TABLE IF NOT EXISTS runs (file TEXT, run TEXT PRIMARY KEY, elements TEXT, target REAL, iterations INTEGER)",
+    "CREATE TABLE IF NOT EXISTS iterations (file TEXT, run TEXT, iteration INTEGER, eta REAL, binding REAL, entropy REAL, n_sites INTEGER, n_species INTEGER, weights BLOB)",
+    "CREATE TABLE IF NOT EXISTS epochs (file TEXT, run TEXT, epoch INTEGER, eta REAL, loss REAL, entropy REAL, status TEXT, evaluations INTEGER, pbfgs_iterations INTEGER)",
+    "CREATE TABLE IF NOT EXISTS finals (file TEXT, run TEXT, loss REAL, entropy REAL, eta REAL)",
+    "CREATE TABLE IF NOT EXISTS bindings (file TEXT, run TEXT, dG REAL)",
+    "CREATE TABLE IF NOT EXISTS designs (file TEXT, run TEXT, adsorbate TEXT, elements TEXT, n_sites INTEGER, n_species INTEGER, weights BLOB)",
+    "CREATE TABLE IF NOT EXISTS energies (file TEXT, run TEXT, calc TEXT, adsorbate TEXT, F REAL)",
+    "CREATE TABLE IF NOT EXISTS lattices (file TEXT, run TEXT, calc TEXT, adsorbate TEXT, vectors TEXT)",
+    "CREATE TABLE IF NOT EXISTS positions (file TEXT, run TEXT, calc TEXT, adsorbate TEXT, ion INTEGER, species TEXT, x REAL, y REAL, z REAL, moves INTEGER)",
+    "CREATE TABLE IF NOT EXISTS outs (file TEXT, run TEXT, calc TEXT, adsorbate TEXT, elec_iterations INTEGER, ionic_iterations INTEGER, F REAL, duration_s REAL, finished INTEGER, error TEXT)",
+    "CREATE TABLE IF NOT EXISTS moments (file TEXT, run TEXT, calc TEXT, adsorbate TEXT, species TEXT, ion INTEGER, oxidation REAL, magnetic REAL)",
+]
+data_tables = ['runs', 'iterations', 'epochs', 'finals', 'bindings', 'designs', 'energies', 'lattices', 'positions', 'outs', 'moments']
+
+# kind of an archive file from its name, None for files that are not indexed
+def file_kind(name):
+    if name in ['min_progress.txt', 'min_details.txt', 'dG_O-dG_OH.txt', 'weights.txt']:
+        return name.split('.')[0]
+    if name.startswith('slurm_out.o'):
+        return 'out'
+    extension = os.path.splitext(name)[1]
+    if extension in ['.out', '.Ecomponents', '.ionpos', '.lattice']:
+        return extension[1:]
+    return None
+
+# folders holding one optimization: the ones with a min_progress.txt or a dG_O-dG_OH.txt
+def is_run_folder(files):
+    return 'min_progress.txt' in files or 'dG_O-dG_OH.txt' in files
+
+# adsorbate of a JDFTx file, from its name (O.out) or from an O/ or OH/ folder above it
+def file_adsorbate(relative_path):
+    parts = relative_path.split(os.sep)
+    stem = os.path.splitext(parts[-1])[0]
+    if stem in ['O', 'OH']:
+        return stem
+    for part in reversed(parts[:-1]):
+        if part in ['O', 'OH']:
+            return part
+    return None
+
+# weights of 'Atom i weights: w El w El ...' lines, with the element order
+def read_weights(file_name):
+    weights = []
+    elements = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            if line.startswith('Atom '):
+                values = line.split(':')[1].split()
+                weights.append([float(v) for v in values[0::2]])
+                elements = values[1::2]
+    return elements, np.array(weights)
+
+def read_lattice(file_name):
+    vectors = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            values = line.replace('\\', ' ').split('#')[0].split()
+            if len(values) == 3:
+                vectors.append([float(v) for v in values])
+    return vectors
+
+def read_ionpos(file_name):
+    res = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) >= 5 and parts[0] == 'ion':
+                res.append((parts[1], float(parts[2]), float(parts[3]), float(parts[4]), int(parts[5]) if len(parts) > 5 else None))
+    return res
+
+class ArchiveIndex:
+    """
+    SQLite index of an archive of optimization runs
+
+    Args:
+        db_path: SQLite file, created if missing
+    """
+    def __init__(self, db_path='dft_index.sqlite'):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        for statement in schema:
+            self.connection.execute(statement)
+        for table in ['files'] + data_tables:
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_run ON {table} (run)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def scan(self, root, processes=None):
+        """
+        Brings the index up to date with the archive below root
+
+        Args:
+            root: Archive folder, paths in the index are relative to it
+            processes: Processes parsing the new or changed JDFTx logs, None for all cores
+
+        Returns:
+            res: Dict with the numbers of files 'seen', 'parsed' (new or changed) and 'removed'
+        """
+        root = os.path.abspath(root)
+        known = {row[0]: (row[1], row[2]) for row in self.connection.execute("SELECT file, size, mtime FROM files")}
+        seen = set()
+        changed = []
+        run = None
+        run_stack = []
+        for folder, folders, files in os.walk(root):
+            folders.sort()
+            relative_folder = os.path.relpath(folder, root)
+            # the run of a folder is the closest folder above it (or itself) that holds one
+            while run_stack and not (relative_folder + os.sep).startswith(run_stack[-1] + os.sep):
+                run_stack.pop()
+            if is_run_folder(files):
+                run_stack.append(relative_folder)
+            run = run_stack[-1] if run_stack else None
+            for name in sorted(files):
+                kind = file_kind(name)
+                if kind is None:
+                    continue
+                path = os.path.join(folder, name)
+                relative_path = os.path.relpath(path, root)
+                stat = os.stat(path)
+                seen.add(relative_path)
+                if known.get(relative_path) == (stat.st_size, stat.st_mtime):
+                    continue
+                changed.append((path, relative_path, kind, run, stat))
+        # the logs are most of the archive, they are parsed in parallel before indexing
+        outs = ot.summarize_files([path for path, relative_path, kind, run, stat in changed if kind == 'out'], processes)
+        for path, relative_path, kind, run, stat in changed:
+            self.forget(relative_path)
+            self.index_file(path, relative_path, kind, run, outs.get(path))
+            self.connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?)", (relative_path, stat.st_size, stat.st_mtime, kind, run))
+        removed = [path for path in known if path not in seen]
+        for relative_path in removed:
+            self.forget(relative_path)
+        self.connection.commit()
+        return {'seen': len(seen), 'parsed': len(changed), 'removed': len(removed)}
+
+    # drop the rows of one file
+    def forget(self, relative_path):
+        for table in ['files'] + data_tables:
+            self.connection.execute(f"DELETE FROM {table} WHERE file = ?", (relative_path,))
+
+    def index_file(self, path, relative_path, kind, run, out=None):
+        execute = self.connection.execute
+        calc = os.path.dirname(relative_path)
+        adsorbate = file_adsorbate(relative_path)
+        if kind == 'min_progress':
+            progress = hr.read_progress(path)
+            execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)", (relative_path, run, ' '.join(progress['elements']), progress['target'], len(progress['iterations'])))
+            rows = [(relative_path, run, it['iteration'], it['eta'], it['binding'], it['entropy'], it['weights'].shape[0], it['weights'].shape[1] if it['weights'].ndim == 2 else 0, it['weights'].astype(float).tobytes()) for it in progress['iterations']]
+            self.connection.executemany("INSERT INTO iterations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        elif kind == 'min_details':
+            epochs = hr.read_details(path)
+            self.connection.executemany("INSERT INTO epochs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [(relative_path, run, e['epoch'], e['eta'], e['loss'], e['entropy'], e['status'], e['evaluations'], len(e['iterations'])) for e in epochs])
+            if epochs and 'final' in epochs[-1]:
+                final = epochs[-1]['final']
+                execute("INSERT INTO finals VALUES (?, ?, ?, ?, ?)", (relative_path, run, final['loss'], final['entropy'], final['eta']))
+        elif kind == 'dG_O-dG_OH':
+            with open(path, 'r') as file:
+                text = file.read().strip()
+            try:
+                execute("INSERT INTO bindings VALUES (?, ?, ?)", (relative_path, run, float(text)))
+            except ValueError:
+                pass
+        elif kind == 'weights':
+            elements, weights = read_weights(path)
+            if weights.size:
+                execute("INSERT INTO designs VALUES (?, ?, ?, ?, ?, ?, ?)", (relative_path, run, adsorbate, ' '.join(elements), weights.shape[0], weights.shape[1], weights.astype(float).tobytes()))
+        elif kind == 'Ecomponents':
+            with open(path, 'r') as file:
+                match = re.search(r'^\s*F =\s*(\S+)', file.read(), re.MULTILINE)
+            if match is not None:
+                execute("INSERT INTO energies VALUES (?, ?, ?, ?, ?)", (relative_path, run, calc, adsorbate, float(match.group(1))))
+        elif kind == 'lattice':
+            execute("INSERT INTO lattices VALUES (?, ?, ?, ?, ?)", (relative_path, run, calc, adsorbate, json.dumps(read_lattice(path))))
+        elif kind == 'ionpos':
+            self.connection.executemany("INSERT INTO positions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [(relative_path, run, calc, adsorbate, i + 1) + ion for i, ion in enumerate(read_ionpos(path))])
+        elif kind == 'out':
+            if out is None:
+                out = ot.summarize_file(path)
+            execute("INSERT INTO outs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (relative_path, run, calc, adsorbate, out['elec_iterations'], out['ionic_iterations'], out['F'], out['duration_s'], int(out['finished']), out['error']))
+            self.connection.executemany("INSERT INTO moments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(relative_path, run, calc, adsorbate) + moment for moment in out['moments']])
+
+    # rows of any query as dicts
+    def sql(self, query, params=()):
+        cursor = self.connection.execute(query, params)
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    # one dict per run with its final state and measured binding energy
+    def runs(self, campaign=None):
+        query = ("SELECT folders.run, runs.elements, runs.target, runs.iterations, finals.loss, finals.entropy, finals.eta, bindings.dG,"
+                 " (SELECT COUNT(*) FROM epochs WHERE epochs.run = folders.run) AS epochs,"
+                 " (SELECT SUM(evaluations) FROM epochs WHERE epochs.run = folders.run) AS evaluations"
+                 " FROM (SELECT DISTINCT run FROM files WHERE run IS NOT NULL) AS folders LEFT JOIN runs ON runs.run = folders.run"
+                 " LEFT JOIN finals ON finals.run = folders.run LEFT JOIN bindings ON bindings.run = folders.run ORDER BY folders.run")
+        res = []
+        for row in self.sql(query):
+            row = dict(run=row['run'], campaign=row['run'].split(os.sep)[0], **{key: value for key, value in row.items() if key != 'run'})
+            if campaign is None or row['campaign'] == campaign:
+                res.append(row)
+        return res
+
+    def iterations(self, run):
+        """
+        Recorded iterations of one run as arrays
+
+        Args:
+            run: Run folder relative to the archive root
+
+        Returns:
+            res: Dict of arrays 'iteration', 'eta', 'binding' (eV), 'entropy' and 'weights' (M, N, S). For a
+                run without iterations M is 0, N that of its weights.txt (0 without one) and S the number of
+                its elements
+        """
+        rows = self.connection.execute("SELECT iteration, eta, binding, entropy, n_sites, n_species, weights FROM iterations WHERE run = ? ORDER BY iteration", (run,)).fetchall()
+        res = {key: np.array([row[j] for row in rows], dtype=float) for j, key in enumerate(['iteration', 'eta', 'binding', 'entropy'])}
+        if not rows:
+            design = self.connection.execute("SELECT n_sites, n_species FROM designs WHERE run = ? LIMIT 1", (run,)).fetchone()
+            elements = self.connection.execute("SELECT elements FROM runs WHERE run = ?", (run,)).fetchone()
+            shape = design if design is not None else (0, len(elements[0].split()) if elements is not None and elements[0] else 0)
+            res['weights'] = np.zeros((0,) + tuple(shape))
+            return res
+        res['weights'] = np.array([np.frombuffer(row[6], dtype=float).reshape(row[4], row[5]) for row in rows])
+        return res
+
+    # final weights of every run, from the last recorded iteration or from weights.txt
+    def final_designs(self, campaign=None):
+        res = {}
+        for row in self.runs(campaign):
+            last = self.connection.execute("SELECT n_sites, n_species, weights FROM iterations WHERE run = ? ORDER BY iteration DESC LIMIT 1", (row['run'],)).fetchone()
+            if last is None:
+                last = self.connection.execute("SELECT n_sites, n_species, weights FROM designs WHERE run = ? LIMIT 1", (row['run'],)).fetchone()
+            if last is not None:
+                res[row['run']] = np.frombuffer(last[2], dtype=float).reshape(last[0], last[1])
+        return res
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Incremental SQLite index of the DFT archive')
+    parser.add_argument('command', choices=['scan', 'runs', 'sql'])
+    parser.add_argument('argument', nargs='?', default=None, help='archive folder for scan, query for sql')
+    parser.add_argument('--db', default='dft_index.sqlite')
+    parser.add_argument('--processes', type=int, default=None, help='processes parsing JDFTx logs in a scan')
+    args = parser.parse_args(argv)
+    index = ArchiveIndex(args.db)
+    if args.command == 'scan':
+        res = index.scan(args.argument or '.', args.processes)
+        print(f"{res['seen']} files, {res['parsed']} parsed, {res['removed']} removed")
+    else:
+        rows = index.runs() if args.command == 'runs' else index.sql(args.argument)
+        if rows:
+            print('\t'.join(rows[0]))
+            for row in rows:
+                print('\t'.join('' if value is None else f'{value:.6g}' if isinstance(value, float) else str(value) for value in row.values()))
+    index.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
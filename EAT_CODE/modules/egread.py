@@ -4,7 +4,15 @@
 
 # imports
 import os
+import json
 import numpy as np
+from collections import namedtuple
+from functools import lru_cache
+
+# everything parsed from the O and OH runs of one evaluation
+Evaluation = namedtuple('Evaluation', ['folder', 'energy_O', 'energy_OH', 'grad_O', 'grad_OH', 'species_O', 'positions_O', 'species_OH', 'positions_OH', 'lattice_O', 'lattice_OH', 'wall_time', 'elec_iterations'])
+# electronic iterations of the O and OH runs of one evaluation
+ElecIterations = namedtuple('ElecIterations', ['O', 'OH'])
 
 # read energy file and extract free energy value
 def read_energy(adsorbate, folder):
@@ -21,33 +29,127 @@ def read_energy(adsorbate, folder):
 
     return float(energy)
 
-# gradient of energy wrt weights corr to atom #i
-def gradient_per_atom(file_name, i, elements):
+# element order of every mixed site, from the add-mix lines of the input file
+def read_mix_elements(input_file):
+    mixes = {}
+    if not os.path.exists(input_file):
+        return mixes
+    with open(input_file, 'r') as file:
+        for line in file:
+            split_line = line.split()
+            if len(split_line) > 2 and split_line[0] == 'add-mix':
+                mixes[split_line[1]] = split_line[2:]
+    return mixes
+
+# reads a .mixgrad file in a single pass
+def read_mixgrad(file_name, elements, mixes=None):
+    """
+    Reads the gradient of the free energy wrt the weights of every mixed site
+
+    Args:
+        file_name: Path to the .mixgrad file
+        elements: Element order of the returned columns
+        mixes: Element order of each site as given by add-mix (default: same as elements)
+
+    Returns:
+        grad: (N, S) array, one row per site in file order
+        rows: Dict from exact site label (e.g. 'mix10') to its row in grad
+    """
     num_species = len(elements)
-    grad = np.zeros(num_species)
-    with open(file_name, "r") as file:
-        for line_number, line in enumerate(file, 1):
-            stripped_line = line.strip()
-            if f'mix{i}' in stripped_line:
-                split_line = stripped_line.split()
-                for j in range(num_species):
-                    grad[j] = float(split_line[2+j])
-                break
-    return grad
+    labels = []
+    values = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            split_line = line.split()
+            # skip the 'mix name | atom | parameters' header and blank lines
+            if len(split_line) < 2 + num_species or not split_line[1].isdigit():
+                continue
+            labels.append(split_line[0])
+            values.append(split_line[2:2+num_species])
+    grad = np.array(values, dtype=float).reshape(len(labels), num_species)
+    rows = {label: i for i, label in enumerate(labels)}
 
+    # reorder columns by element name wherever add-mix listed the elements differently
+    if mixes:
+        element_index = {element: j for j, element in enumerate(elements)}
+        orders = {}
+        for i, label in enumerate(labels):
+            order = tuple(mixes.get(label, elements))
+            if order != tuple(elements):
+                orders.setdefault(order, []).append(i)
+        for order, site_rows in orders.items():
+            perm = np.array([order.index(element) for element in elements])
+            grad[site_rows] = grad[np.ix_(site_rows, perm)]
+    return grad, rows
 
-# gradient of energy wrt weights
-def read_gradient(w, adsorbate, elements, folder):
+# species and positions of every ion in a .ionpos file
+def read_ionpos(file_name):
+    species = []
+    positions = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            split_line = line.split()
+            if len(split_line) >= 5 and split_line[0] == 'ion':
+                species.append(split_line[1])
+                positions.append([float(v) for v in split_line[-4:-1]])
+    return tuple(species), np.array(positions).reshape(-1, 3)
+
+# lattice vectors (as columns, like the lattice command) from a .lattice file
+def read_lattice(file_name):
+    rows = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            split_line = line.replace('\\', ' ').split('#')[0].split()
+            if len(split_line) >= 3 and split_line[0] != 'lattice':
+                rows.append([float(v) for v in split_line[:3]])
+    return np.array(rows).reshape(-1, 3)
+
+# gradient rows of sites mix1 ... mixN of one adsorbate run
+def read_site_gradient(adsorbate, elements, folder):
     prefix = f'{adsorbate}'
-    num_species = len(elements)
-    weights = w.reshape(-1, num_species)
-    # extract gradient
-    num_atoms = weights.shape[0]
-    grad_w = np.zeros((num_atoms, num_species))
-    grad_file = os.path.join(folder, prefix, f'{prefix}.mixgrad')
-    for i in range(num_atoms):
-        grad_w[i, :] = gradient_per_atom(grad_file, i+1, elements)
-    # vectorize
-    res = grad_w.flatten()
-
-    return res
+    mixes = read_mix_elements(os.path.join(folder, prefix, f'{prefix}.in'))
+    grad, rows = read_mixgrad(os.path.join(folder, prefix, f'{prefix}.mixgrad'), elements, mixes)
+    order = np.array([rows[f'mix{i+1}'] for i in range(len(rows))], dtype=int)
+    return grad[order].flatten()
+
+# parse every output file of an evaluation exactly once; folders never change after their run
+@lru_cache(maxsize=64)
+def load_evaluation(folder, elements):
+    """
+    Reads the energies, gradients, geometry, timing and electronic iterations of one evaluation
+
+    Args:
+        folder: Unique folder of the evaluation (holding O/ and OH/)
+        elements: Tuple of elements giving the gradient column order
+
+    Returns:
+        res: Evaluation record. Arrays in it are read-only
+    """
+    fields = {'folder': folder}
+    for adsorbate in ['O', 'OH']:
+        fields[f'energy_{adsorbate}'] = read_energy(adsorbate=adsorbate, folder=folder)
+        fields[f'grad_{adsorbate}'] = read_site_gradient(adsorbate, elements, folder)
+        ionpos_file = os.path.join(folder, adsorbate, f'{adsorbate}.ionpos')
+        lattice_file = os.path.join(folder, adsorbate, f'{adsorbate}.lattice')
+        fields[f'species_{adsorbate}'], fields[f'positions_{adsorbate}'] = read_ionpos(ionpos_file) if os.path.exists(ionpos_file) else ((), np.zeros((0, 3)))
+        fields[f'lattice_{adsorbate}'] = read_lattice(lattice_file) if os.path.exists(lattice_file) else np.zeros((0, 3))
+    timing_file = os.path.join(folder, 'timing.json')
+    timing = {}
+    if os.path.exists(timing_file):
+        with open(timing_file, 'r') as file:
+            timing = json.load(file)
+    fields['wall_time'] = timing.get('wall_time')
+    # electronic iterations of the O and OH runs, None for runs served from the result cache. Immutable
+    # like the arrays, since lru_cache hands the same record to every caller
+    elec_iterations = timing.get('elec_iterations', {})
+    fields['elec_iterations'] = ElecIterations(O=elec_iterations.get('O'), OH=elec_iterations.get('OH'))
+    for value in fields.values():
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+    return Evaluation(**fields)
+
+# record of an evaluation given either the record itself or its folder
+def as_evaluation(evaluation, elements):
+    if isinstance(evaluation, Evaluation):
+        return evaluation
+    return load_evaluation(evaluation, tuple(elements))
@@ -0,0 +1,120 @@
+###############################################################################
+# Size-bounded folder of entries, shared by the result cache and the wavefunction store
+###############################################################################
+# Every entry is a folder <root>/<key[:2]>/<key> that is complete once its meta.json exists. Entries
+# are written to a temporary folder and renamed into place, so a killed run never leaves half an
+# entry. The modification time of an entry marks when it was last used, and the least recently used
+# entries are evicted beyond max_bytes. Counters across sessions are kept in <root>/stats.json.
+
+# imports
+import os
+import json
+import shutil
+import time
+
+class EntryStore:
+    """
+    Folder of entries with size-bounded LRU eviction and running totals
+
+    Args:
+        root: Folder holding the entries. Keep it outside runs/ so that it survives delete_progress
+        max_bytes: Size bound, least recently used entries are evicted beyond it
+        label: Name of the store in messages
+    """
+    def __init__(self, root, max_bytes, label='Store'):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.label = label
+        os.makedirs(self.root, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    # True once the entry of key is complete
+    def has(self, key):
+        return os.path.exists(os.path.join(self.entry_path(key), 'meta.json'))
+
+    # mark an entry as used now
+    def touch(self, entry):
+        os.utime(entry)
+
+    def put(self, key, files, meta):
+        """
+        Writes an entry atomically and evicts beyond max_bytes
+
+        Args:
+            key: Key of the entry
+            files: Dict of the name in the entry and the path of every file to copy in, missing ones are skipped
+            meta: Dict written to meta.json
+
+        Returns:
+            res: Path to the entry
+        """
+        entry = self.entry_path(key)
+        tmp_entry = f'{entry}.tmp{os.getpid()}'
+        os.makedirs(tmp_entry, exist_ok=True)
+        for name, file_path in files.items():
+            if os.path.exists(file_path):
+                shutil.copy(file_path, os.path.join(tmp_entry, name))
+        with open(os.path.join(tmp_entry, 'meta.json'), 'w') as file:
+            json.dump(dict(meta, key=key, created=time.time()), file)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+        return entry
+
+    # list of (last used, size, path) for every complete entry
+    def entries(self):
+        res = []
+        for shard in os.listdir(self.root):
+            shard_path = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                entry = os.path.join(shard_path, name)
+                if '.tmp' in name or not os.path.exists(os.path.join(entry, 'meta.json')):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                res.append((os.path.getmtime(entry), size, entry))
+        return res
+
+    # called with every evicted entry, e.g. to drop what was read from it
+    def forget(self, entry):
+        pass
+
+    # remove least recently used entries until the store fits in max_bytes
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            self.forget(entry)
+            total -= size
+            print(f"{self.label} entry '{entry}' has been evicted.")
+
+    # running totals across sessions, defaults for the counters not written yet
+    def totals(self, defaults=None):
+        res = dict(defaults or {})
+        try:
+            with open(os.path.join(self.root, 'stats.json'), 'r') as file:
+                res.update(json.load(file))
+        except (OSError, ValueError):
+            pass
+        return res
+
+    def save_totals(self, totals):
+        stats_path = os.path.join(self.root, 'stats.json')
+        tmp_path = f'{stats_path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as file:
+            json.dump(totals, file)
+        os.replace(tmp_path, stats_path)
+
+    # number of entries and their bytes
+    def usage(self):
+        entries = self.entries()
+        return {'entries': len(entries), 'bytes': sum(size for _, size, _ in entries)}
@@ -0,0 +1,121 @@
+###############################################################################
+# Annealing of the entropy parameter eta between epochs
+###############################################################################
+# A controller gets a summary of every finished epoch and chooses the eta of the next one. The summary
+# is a dict with
+#   'eta': eta of the epoch
+#   'status': PBFGS status, 'converged', 'maxit' or 'line_search_failed'
+#   'entropy_start', 'entropy_end': Shannon entropy of the weights before and after the epoch
+#   'weights': weights after the epoch, shaped (N, S)
+#   'grad_binding', 'grad_entropy': gradients of the binding term of the cost and of the Tsallis
+#       entropy (without eta) after the epoch, flat, or None when they are not known
+# Controllers are pickled into the checkpoint, so they keep all of their state in attributes.
+import numpy as np
+
+# weights at or below this count as zero, i.e. as an active bound of the simplex
+active_tol = 1e-8
+
+# component of the gradient g along the simplex of every site, restricted to the free weights
+def simplex_gradient(g, weights):
+    g = np.asarray(g, dtype=float).reshape(weights.shape)
+    free = weights > active_tol
+    mean = np.sum(np.where(free, g, 0), axis=1, keepdims=True) / np.maximum(np.sum(free, axis=1, keepdims=True), 1)
+    return np.where(free, g - mean, 0)
+
+# eta times the entropy gradient against the binding gradient, both along the simplex. None if unknown
+# or if the binding gradient vanishes
+def gradient_balance(summary):
+    if summary.get('grad_binding') is None or summary.get('grad_entropy') is None:
+        return None
+    weights = np.asarray(summary['weights'])
+    binding_norm = np.linalg.norm(simplex_gradient(summary['grad_binding'], weights))
+    # no free weights left, e.g. on pure sites
+    if binding_norm < 1e-12:
+        return None
+    entropy_norm = summary['eta'] * np.linalg.norm(simplex_gradient(summary['grad_entropy'], weights))
+    return entropy_norm / max(binding_norm, 1e-12)
+
+class FixedFactor:
+    """
+    Multiplies eta by a fixed factor after every epoch and stops at a small entropy (the original schedule)
+
+    Args:
+        factor: Factor eta grows by per epoch
+        stop_entropy: Shannon entropy below which no more epochs are run
+    """
+    def __init__(self, factor=10, stop_entropy=1e-2):
+        self.factor = factor
+        self.stop_entropy = stop_entropy
+        self.stopped = False
+        self.reason = ''
+
+    def next_eta(self, summary):
+        self.reason = f'factor {self.factor:g}'
+        return summary['eta'] * self.factor
+
+    def should_stop(self, summary):
+        self.stopped = summary['entropy_end'] < self.stop_entropy
+        return self.stopped
+
+class Adaptive(FixedFactor):
+    """
+    Chooses the factor eta grows by from the last epoch, and stops once the active set is stable
+
+    After a failed line search the factor is halved, since the jump in eta was too large for the
+    quasi-Hessian. After a converged epoch whose relative entropy drop was below target_drop it is
+    doubled. While eta times the entropy gradient is below balance times the binding gradient the
+    entropy does not steer the weights yet, and eta jumps to where the two are balanced. The factor
+    always stays between min_factor and max_factor.
+
+    Args:
+        factor: Factor of the first epoch
+        min_factor: Smallest factor
+        max_factor: Largest factor
+        target_drop: Relative entropy drop per epoch below which the factor grows
+        balance: Ratio of the entropy to the binding gradient eta jumps to while below it
+        patience: Number of epochs the active set has to be unchanged before stopping
+        purity: Smallest weight of the dominant element on every site needed to stop early
+        stop_entropy: Shannon entropy below which no more epochs are run
+    """
+    def __init__(self, factor=10, min_factor=2, max_factor=100, target_drop=0.5, balance=0.1, patience=2, purity=0.9, stop_entropy=1e-2):
+        super().__init__(factor, stop_entropy)
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.target_drop = target_drop
+        self.balance = balance
+        self.patience = patience
+        self.purity = purity
+        self.active_set = None
+        self.stable_epochs = 0
+
+    def next_eta(self, summary):
+        reasons = []
+        factor = self.factor
+        drop = (summary['entropy_start'] - summary['entropy_end']) / max(summary['entropy_start'], 1e-12)
+        if summary['status'] == 'line_search_failed':
+            factor /= 2
+            reasons.append('line search failed')
+        elif summary['status'] == 'converged' and drop < self.target_drop:
+            factor *= 2
+            reasons.append(f'entropy drop {drop:.2f}')
+        self.factor = min(max(factor, self.min_factor), self.max_factor)
+        step = self.factor
+        ratio = gradient_balance(summary)
+        if ratio is not None and ratio < self.balance and summary['status'] != 'line_search_failed':
+            step = min(max(step, self.balance / max(ratio, 1e-12)), self.max_factor)
+            reasons.append(f'gradient balance {ratio:.2e}')
+        self.reason = f"factor {step:g}" + (f" ({', '.join(reasons)})" if reasons else '')
+        return summary['eta'] * step
+
+    def should_stop(self, summary):
+        if super().should_stop(summary):
+            return True
+        weights = np.asarray(summary['weights'])
+        active_set = weights <= active_tol
+        if self.active_set is not None and np.array_equal(active_set, self.active_set):
+            self.stable_epochs += 1
+        else:
+            self.stable_epochs = 0
+        self.active_set = active_set
+        self.stopped = self.stable_epochs >= self.patience and np.min(np.max(weights, axis=1)) >= self.purity
+        return self.stopped
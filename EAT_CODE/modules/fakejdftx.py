@@ -0,0 +1,316 @@
+###############################################################################
+# Stand-in for JDFTx that writes outputs from an analytic model of the weights
+###############################################################################
+# Usable in-process through the 'fake' backend, or as a drop-in executable:
+#   python3 modules/fakejdftx.py [--config fake.json] -i O.in
+# e.g. with jdftx_config = {'backend': 'local', 'mpirun': '', 'jdftx': 'python3 /path/to/modules/fakejdftx.py'}
+
+# imports
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+
+# settings of the fake runs; a json file given with --config or FAKE_JDFTX_CONFIG overrides them
+default_fake_config = {
+    'model': 'linear', # 'linear', 'quadratic' or 'random_feature'
+    'seed': 0, # seed of the model coefficients
+    'scale': 0.02, # size (Hartree) of the composition dependent energy per unit weight
+    'binding_offset': 0.01, # binding energy (Hartree) above the target at the uniform composition
+    'rank': 8, # rank of the quadratic coupling
+    'features': 32, # number of random features
+    'length_scale': 0.5, # length scale of the random features in weight space
+    'energy_noise': 0.0, # std (Hartree) of the noise added to the energy
+    'grad_noise': 0.0, # std (Hartree) of the noise added to every gradient entry
+    'latency': 0.0, # seconds per run
+    'iteration_time': 0.0, # additional seconds per electronic iteration
+    'fail_prob': 0.0, # probability that a run fails
+    'fail_mode': 'crash', # 'crash' (MPI abort), 'scf' (electronic minimization does not converge), 'diverge' (F rises
+                          # with failing line search steps) or 'stall' (|grad|_K barely falls), the last two for fail_iterations
+    'fail_iterations': 1000, # electronic iterations of a diverging or stalled run before it gives up
+    'fail_seed': None, # None draws failures at random, an integer makes them a fixed function of the input
+    'wfns_bytes': 64, # size of the dumped .wfns file
+    'cross_adsorbate_error': 0.01, # added to the starting error of a run whose initial state was converged with the other adsorbate
+}
+
+# binding energy of main.py is E_O - E_OH + 1/2 E_H2O... - 0.36 eV; this puts the uniform composition
+# binding_offset above the 1.6 eV target
+binding_shift = 1/2 * 1.1781008671071755 + 0.36/27.2114 + 0.058798885761114826
+
+def load_fake_config(config=None, config_file=None):
+    res = dict(default_fake_config)
+    if config_file is None:
+        config_file = os.environ.get('FAKE_JDFTX_CONFIG')
+    if config_file is not None and os.path.exists(config_file):
+        with open(config_file, 'r') as file:
+            res.update(json.load(file))
+    if config:
+        res.update(config)
+    return res
+
+# reads the pieces of a jdftx input file that the fake run needs
+def parse_input(input_path):
+    mixes = {}
+    weights = {}
+    ion_lines = []
+    lattice_lines = []
+    dump_name = None
+    initial_state = None
+    dumps = []
+    elec_threshold = 1e-8
+    ionic_threshold = None
+    with open(input_path, 'r') as file:
+        lines = file.readlines()
+    reading_lattice = False
+    for line in lines:
+        stripped_line = line.strip()
+        split_line = stripped_line.split()
+        if reading_lattice:
+            lattice_lines.append(stripped_line.rstrip('\\').strip())
+            reading_lattice = stripped_line.endswith('\\')
+            continue
+        if not split_line:
+            continue
+        if split_line[0] == 'lattice':
+            reading_lattice = stripped_line.endswith('\\')
+        elif split_line[0] == 'add-mix':
+            mixes[split_line[1]] = split_line[2:]
+        elif split_line[0] == 'ion':
+            ion_lines.append(stripped_line)
+            if split_line[1] in mixes:
+                num_species = len(mixes[split_line[1]])
+                weights[split_line[1]] = np.array([float(v) for v in split_line[2:2+num_species]])
+        elif split_line[0] == 'dump-name':
+            dump_name = split_line[1]
+        elif split_line[0] == 'initial-state':
+            initial_state = split_line[1]
+        elif split_line[0] == 'dump':
+            dumps += split_line[2:]
+        elif split_line[0] == 'electronic-minimize' and 'energyDiffThreshold' in split_line:
+            elec_threshold = float(split_line[split_line.index('energyDiffThreshold')+1])
+        elif split_line[0] == 'ionic-minimize' and 'energyDiffThreshold' in split_line:
+            ionic_threshold = float(split_line[split_line.index('energyDiffThreshold')+1])
+    return {'mixes': mixes, 'weights': weights, 'ion_lines': ion_lines, 'lattice_lines': lattice_lines, 'dump_name': dump_name, 'initial_state': initial_state, 'dumps': dumps, 'elec_threshold': elec_threshold, 'ionic_threshold': ionic_threshold}
+
+# weights of all sites as one (N, S) array with the elements sorted by name, so the model does
+# not depend on the order add-mix lists them in
+def site_matrix(inputs):
+    labels = sorted(inputs['weights'], key=lambda label: int(label[3:]) if label[3:].isdigit() else label)
+    elements = sorted(set(element for label in labels for element in inputs['mixes'][label]))
+    w = np.zeros((len(labels), len(elements)))
+    for i, label in enumerate(labels):
+        for j, element in enumerate(inputs['mixes'][label]):
+            w[i, elements.index(element)] = inputs['weights'][label][j]
+    return labels, elements, w
+
+# model coefficients depend only on the config, the adsorbate and the problem size, so separate
+# processes agree on the same energy surface
+def model_rng(config, adsorbate, shape):
+    digest = hashlib.sha256(f"{config['seed']}:{adsorbate}:{shape}".encode()).digest()
+    return np.random.default_rng(int.from_bytes(digest[:8], 'little'))
+
+def model_energy(w, adsorbate, config):
+    """
+    Composition dependent part of the energy of one adsorbate run and its gradient
+
+    Args:
+        w: (N, S) weights
+        adsorbate: 'O' or 'OH'
+        config: Fake run settings
+
+    Returns:
+        energy: Energy (Hartree)
+        grad: (N, S) gradient wrt w
+    """
+    rng = model_rng(config, adsorbate, w.shape)
+    x = w.flatten()
+    n = len(x)
+    scale = config['scale'] * (1.0 if adsorbate == 'O' else 0.5)
+    c = scale * rng.normal(size=n)
+    energy = c @ x
+    grad = c.copy()
+    if config['model'] == 'quadratic':
+        U = rng.normal(size=(n, config['rank'])) / np.sqrt(n)
+        d = scale * rng.uniform(0.5, 2.0, config['rank'])
+        Ux = U.T @ x
+        energy += 0.5 * Ux @ (d * Ux)
+        grad += U @ (d * Ux)
+    elif config['model'] == 'random_feature':
+        omega = rng.normal(size=(config['features'], n)) / config['length_scale']
+        phase = rng.uniform(0, 2*np.pi, config['features'])
+        alpha = scale * rng.normal(size=config['features']) / np.sqrt(config['features'])
+        arg = omega @ x + phase
+        energy += alpha @ np.cos(arg)
+        grad += -omega.T @ (alpha * np.sin(arg))
+    elif config['model'] != 'linear':
+        raise ValueError(f"Unknown fake JDFTx model '{config['model']}'")
+    return energy, grad.reshape(w.shape)
+
+# reproducible noise for a given input, so a repeated point gives the same answer
+def point_rng(input_text):
+    digest = hashlib.sha256(input_text.encode()).digest()
+    return np.random.default_rng(int.from_bytes(digest[:8], 'little'))
+
+def run(input_path, config=None, stream=None):
+    """
+    Performs one fake JDFTx run: writes the dumped files next to input_path
+
+    Args:
+        input_path: Path to the .in file
+        config: Fake run settings
+        stream: Called with every piece of the log as the run produces it, e.g. to write it to stdout
+
+    Returns:
+        log: Text jdftx would print (written to the .out file)
+        returncode: Exit code (0 on success)
+    """
+    config = load_fake_config(config)
+    start_time = time.time()
+    with open(input_path, 'r') as file:
+        input_text = file.read()
+    inputs = parse_input(input_path)
+    folder = os.path.dirname(os.path.abspath(input_path))
+    prefix = os.path.splitext(os.path.basename(input_path))[0]
+    name = inputs['dump_name'].replace('.$VAR', '') if inputs['dump_name'] else prefix
+    adsorbate = 'OH' if 'OH' in name else 'O'
+    labels, elements, w = site_matrix(inputs)
+    rng = point_rng(input_text)
+    log = []
+    def write(text):
+        log.append(text)
+        if stream is not None:
+            stream(text)
+    write(f"*************** JDFTx 1.7.0 (fake)  ***************\n\nStart date and time: {time.ctime(start_time)}\nExecutable fakejdftx with command-line: -i {os.path.abspath(input_path)}\n\n")
+
+    # electronic iterations: the error starts at 1 from scratch, or grows with the distance to the
+    # weights stored in the initial state, and halves every iteration
+    start_error = 1.0
+    if inputs['initial_state'] is not None:
+        state_path = os.path.join(folder, inputs['initial_state'].replace('$VAR', 'wfns'))
+        stored = read_wfns(state_path)
+        if stored is not None and stored['weights'].shape == w.shape:
+            start_error = 1e-3 + 0.5 * np.abs(stored['weights'] - w).sum()
+            # a state converged with the other adsorbate still has to adapt to the H atom
+            if stored['adsorbate'] not in [None, adsorbate]:
+                start_error += config['cross_adsorbate_error']
+            start_error = min(1.0, start_error)
+    num_elec = max(1, int(np.ceil(np.log2(start_error / inputs['elec_threshold']))))
+    num_ionic = 0
+    if inputs['ionic_threshold'] is not None:
+        num_ionic = max(1, int(np.ceil(np.log10(1e-2 / inputs['ionic_threshold']))))
+
+    time.sleep(config['latency'])
+
+    energy = 0.0
+    grad = np.zeros(w.shape)
+    if len(labels) > 0:
+        energy, grad = model_energy(w, adsorbate, config)
+    energy += -2700.0 + (binding_shift + config['binding_offset'] if adsorbate == 'O' else 0.0)
+    energy += config['energy_noise'] * rng.normal()
+    grad = grad + config['grad_noise'] * rng.normal(size=grad.shape)
+
+    if config['fail_seed'] is None:
+        failed = np.random.default_rng().uniform() < config['fail_prob']
+    else:
+        failed = point_rng(f"{config['fail_seed']}:{input_text}").uniform() < config['fail_prob']
+    t = 0.0
+    dt = 0.5 + config['iteration_time']
+    for ionic in range(num_ionic + 1):
+        F = energy + start_error
+        if failed and config['fail_mode'] in ['diverge', 'stall']:
+            for it in range(config['fail_iterations'] + 1):
+                if it > 0:
+                    time.sleep(config['iteration_time'])
+                t += dt
+                if config['fail_mode'] == 'diverge':
+                    # the error grows while alternating, every step overshoots
+                    F = energy + start_error * (1 + 0.05 * it) * (1.5 if it % 2 else 1.0)
+                    write(f"ElecMinimize: \tStep increased F by {0.5 * start_error:.3e}, reducing alpha to {0.5 ** (it % 10 + 1):.6e}.\n")
+                else:
+                    F = energy + start_error / (1 + 1e-3 * it)
+                write(f"ElecMinimize: Iter: {it:3d}  F: {F:.15f}  |grad|_K:  {abs(F - energy) * 1e-2 + 1e-9:.3e}  alpha:  1.000e+00  linmin:  0.000e+00  t[s]: {t:10.2f}\n")
+            write(f"ElecMinimize: None of the convergence criteria satisfied after {config['fail_iterations']} iterations.\n")
+            return ''.join(log), 1
+        for it in range(num_elec + 1):
+            if it > 0:
+                time.sleep(config['iteration_time'])
+            t += dt
+            write(f"ElecMinimize: Iter: {it:3d}  F: {F:.15f}  |grad|_K:  {abs(F - energy) * 1e-2 + 1e-9:.3e}  alpha:  1.000e+00  linmin:  0.000e+00  t[s]: {t:10.2f}\n")
+            F = energy + (F - energy) / 2
+        if failed and config['fail_mode'] == 'scf':
+            write(f"ElecMinimize: None of the convergence criteria satisfied after {num_elec} iterations.\n")
+            return ''.join(log), 1
+        write(f"ElecMinimize: Converged (|Delta F|<{inputs['elec_threshold']:e} for 5 iters).\n")
+        if num_ionic > 0:
+            write(f"IonicMinimize: Iter: {ionic:3d}  F: {energy:.15f}  |grad|_K:  {1e-3 / (ionic + 1):.3e}  alpha:  1.000e+00  linmin:  0.000e+00  t[s]: {t:10.2f}\n")
+        if failed and config['fail_mode'] == 'crash':
+            write("MPI_ABORT was invoked on rank 0 in communicator MPI_COMM_WORLD\n")
+            return ''.join(log), 1
+    if num_ionic > 0:
+        write(f"IonicMinimize: Converged (|Delta F|<{inputs['ionic_threshold']:e} for 3 iters).\n")
+
+    write_outputs(folder, name, inputs, labels, elements, w, energy, grad, config)
+    for extension in ['ionpos', 'lattice', 'mixgrad', 'Ecomponents'] + (['wfns'] if 'State' in inputs['dumps'] else []):
+        write(f"Dumping '{name}.{extension}' ... done\n")
+    elapsed = time.time() - start_time
+    write(f"End date and time: {time.ctime()}  (Duration: 0-{int(elapsed // 3600)}:{int(elapsed % 3600 // 60):02d}:{elapsed % 60:05.2f})\nDone!\n")
+    return ''.join(log), 0
+
+# the fake .wfns stores the weights and adsorbate of the run, so later runs can tell how close their
+# initial state is. Older files only hold the weights
+def read_wfns(file_name):
+    if not os.path.exists(file_name):
+        return None
+    try:
+        with open(file_name, 'rb') as file:
+            header = json.loads(file.readline().decode())
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if isinstance(header, list):
+        header = {'weights': header, 'adsorbate': None}
+    return {'weights': np.array(header['weights']), 'adsorbate': header.get('adsorbate')}
+
+# writes the files jdftx would dump
+def write_outputs(folder, name, inputs, labels, elements, w, energy, grad, config):
+    with open(os.path.join(folder, f'{name}.Ecomponents'), 'w') as file:
+        file.write(f"-------------------------------------\n        F =  {energy:25.16f}\n")
+    with open(os.path.join(folder, f'{name}.mixgrad'), 'w') as file:
+        file.write('mix name | atom | parameters\n')
+        for i, label in enumerate(labels):
+            # columns in the order add-mix listed the elements
+            grad_string = '    '.join(f'{grad[i, elements.index(element)]:.12f}' for element in inputs['mixes'][label])
+            file.write(f'{label}    0    {grad_string}\n')
+    with open(os.path.join(folder, f'{name}.ionpos'), 'w') as file:
+        file.write('# Ionic positions in lattice coordinates:\n')
+        for line in inputs['ion_lines']:
+            file.write(line + '\n')
+    with open(os.path.join(folder, f'{name}.lattice'), 'w') as file:
+        file.write('lattice \\\n')
+        for i, line in enumerate(inputs['lattice_lines']):
+            file.write(f'\t{line}  \\\n' if i < len(inputs['lattice_lines'])-1 else f'\t{line}\n')
+    if 'State' in inputs['dumps']:
+        header = (json.dumps({'weights': w.tolist(), 'adsorbate': 'OH' if 'OH' in name else 'O'}) + '\n').encode()
+        with open(os.path.join(folder, f'{name}.wfns'), 'wb') as file:
+            file.write(header + b'\0' * max(0, config['wfns_bytes'] - len(header)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake JDFTx run from an analytic model')
+    parser.add_argument('-i', '--input', required=True)
+    parser.add_argument('--config', default=None)
+    args, _ = parser.parse_known_args(argv)
+    # under mpirun only the first rank does the work
+    rank = int(os.environ.get('OMPI_COMM_WORLD_RANK', os.environ.get('PMI_RANK', '0')))
+    if rank != 0:
+        return 0
+    # the log goes out as it is produced, like jdftx, so it can be followed while the run goes on
+    def stream(text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    _, returncode = run(args.input, load_fake_config(config_file=args.config), stream=stream)
+    return returncode
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+###############################################################################
+# Reading recorded minimization histories (min_progress.txt and min_details.txt)
+###############################################################################
+
+# imports
+import os
+import re
+import numpy as np
+
+# relative difference up to which an eta of min_progress.txt and one of min_details.txt are the same
+eta_rtol = 1e-6
+
+float_pattern = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan|inf'
+
+def read_progress(file_name):
+    """
+    Reads min_progress.txt
+
+    Args:
+        file_name: Path to min_progress.txt
+
+    Returns:
+        res: Dict with 'elements', 'target' (eV) and 'iterations', a list of dicts with 'iteration',
+            'eta', 'weights' (N, S), 'binding' (eV) and 'entropy'
+    """
+    res = {'elements': [], 'target': None, 'iterations': []}
+    current = None
+    weights = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            if line.startswith('Initilizing minimization for species'):
+                res['elements'] = line.split('species')[1].split()
+            elif line.startswith('Target:'):
+                res['target'] = float(line.split()[1])
+            elif line.startswith('Iteration '):
+                match = re.match(rf'Iteration (\d+), eta = ({float_pattern})', line)
+                current = {'iteration': int(match.group(1)), 'eta': float(match.group(2)), 'weights': None, 'binding': None, 'entropy': None}
+                weights = []
+            elif current is None:
+                continue
+            elif line.startswith('Atom '):
+                values = line.split(':')[1].split()
+                weights.append([float(v) for v in values[0::2]])
+            elif line.startswith('HEA binding free energy:'):
+                current['binding'] = float(line.split(':')[1].split()[0])
+            elif line.startswith('Entropy:'):
+                current['entropy'] = float(line.split()[1])
+                current['weights'] = np.array(weights)
+                res['iterations'].append(current)
+                current = None
+    return res
+
+def read_details(file_name):
+    """
+    Reads min_details.txt
+
+    Args:
+        file_name: Path to min_details.txt
+
+    Returns:
+        res: List with one dict per epoch: 'epoch', 'loss', 'entropy' and 'eta' at its start, 'status'
+            ('converged', 'maxit', 'line_search_failed' or 'running'), 'iterations' (PBFGS iterations
+            with 'fun' and 'tol') and 'evaluations' (DFT evaluations
+            of the line searches)
+    """
+    res = []
+    epoch = None
+    with open(file_name, 'r') as file:
+        for line in file:
+            stripped_line = line.strip()
+            if stripped_line.startswith('Epoch ') or stripped_line.startswith('FINAL:'):
+                match = re.search(rf'Loss = ({float_pattern}), Entropy = ({float_pattern}), eta = ({float_pattern})', stripped_line)
+                if stripped_line.startswith('FINAL:'):
+                    epoch = None
+                    if match is not None and res:
+                        res[-1]['final'] = {'loss': float(match.group(1)), 'entropy': float(match.group(2)), 'eta': float(match.group(3))}
+                    continue
+                epoch = {'epoch': int(stripped_line.split()[1].rstrip(':')), 'loss': None, 'entropy': None, 'eta': None, 'status': 'running', 'iterations': [], 'evaluations': 0}
+                if match is not None:
+                    epoch['loss'] = float(match.group(1))
+                    epoch['entropy'] = float(match.group(2))
+                    epoch['eta'] = float(match.group(3))
+                res.append(epoch)
+            elif epoch is None:
+                continue
+            elif stripped_line.startswith('PBFGS iteration'):
+                match = re.search(rf'fun = ({float_pattern}), tol = ({float_pattern})', stripped_line)
+                epoch['iterations'].append({'fun': float(match.group(1)), 'tol': float(match.group(2))})
+            elif stripped_line.startswith('->Iterations') and 'in parallel' in stripped_line:
+                # speculative round, 'alpha = [1, 0.5, 0.25]'
+                epoch['evaluations'] += len(stripped_line.split('[')[1].split(','))
+            elif stripped_line.startswith('->Iteration'):
+                epoch['evaluations'] += 1
+            elif stripped_line.startswith('PBFGS converged'):
+                epoch['status'] = 'converged'
+            elif stripped_line.startswith('PBFGS did not converge'):
+                epoch['status'] = 'maxit'
+            elif stripped_line.startswith('Line search failed'):
+                epoch['status'] = 'line_search_failed'
+    return res
+
+def read_history(folder):
+    """
+    Reads the recorded history of one run folder and splits the progress into epochs
+
+    Args:
+        folder: Folder with min_progress.txt and min_details.txt
+
+    Returns:
+        res: Dict of read_progress plus 'folder' and 'epochs' (read_details), where every epoch has
+            the indices of its progress 'iterations'
+    """
+    res = read_progress(os.path.join(folder, 'min_progress.txt'))
+    res['folder'] = folder
+    details_path = os.path.join(folder, 'min_details.txt')
+    res['epochs'] = read_details(details_path) if os.path.exists(details_path) else []
+    # every epoch has its own eta, an epoch without an accepted step has no progress iterations. Both
+    # files print eta in their own format, so it is compared with a relative tolerance
+    for epoch in res['epochs']:
+        epoch['progress'] = [i for i, iteration in enumerate(res['iterations']) if epoch['eta'] is not None and np.isclose(iteration['eta'], epoch['eta'], rtol=eta_rtol, atol=0)]
+    return res
+
+# run folders below root that have a recorded history with at least one iteration
+def find_histories(root):
+    res = []
+    for folder, _, files in sorted(os.walk(root)):
+        if 'min_progress.txt' in files and 'min_details.txt' in files:
+            res.append(folder)
+    return res
@@ -0,0 +1,295 @@
+###############################################################################
+# Backends that launch JDFTx jobs: local mpirun, Slurm, an in-process fake or a replay of recorded runs
+###############################################################################
+
+# imports
+import os
+import copy
+import json
+import signal
+import subprocess
+import time
+import modules.fakejdftx as fk
+import modules.replaystore as rp
+import modules.nodepack as nk
+
+# default settings, overridden by the config passed from main.py and then by jdftx_config.json
+default_config = {
+    'backend': 'local', # 'local', 'slurm', 'fake' or 'replay'
+    'num_ranks': 9, # MPI ranks for one evaluation
+    'concurrent': False, # run O and OH at the same time
+    'cross_seed': False, # run O first and start OH from its converged state, instead of at the same time (perform_calc only)
+    'jdftx': '/data2/jt577/jdftx_eat_withLibXC/build/jdftx', # path to the JDFTx_EAT binary
+    'mpirun': 'mpirun --oversubscribe --bind-to none', # launcher, ranks are appended with -n. Empty runs jdftx directly
+    'poll_interval': 10, # seconds between status checks while waiting
+    'cache': False, # reuse results of identical input files
+    'cache_dir': 'dft_cache', # result cache folder, kept outside runs/ so restarts can use it
+    'cache_max_bytes': 2 * 1024**3, # size bound of the result cache
+    'wfns_store': False, # start every run from the nearest stored state (weights and geometry) instead of the last adopted one
+    'wfns_store_dir': 'wfns_store', # wavefunction store folder, kept outside runs/ like the cache
+    'wfns_store_max_bytes': 8 * 1024**3, # disk budget of the wavefunction store
+    'retry': {}, # resubmission of runs that fail for a transient reason, see jbretry.default_policy
+    'pack': {'enabled': False}, # pack local runs on the cores and memory of the node with core binding, see nodepack.default_pack_config
+    'watchdog': {'enabled': False}, # policy of the watchdog that stops diverging or stalled runs, see watchdog.default_policy
+    'fake': {}, # settings of the fake backend, see fakejdftx.default_fake_config
+    'replay': {}, # settings of the replay backend, see replaystore.default_replay_config
+    'slurm': {
+        'partition': 'hi_mem2',
+        'cpus_per_task': 7,
+        'time': '999:00:00',
+        'job_name': 'EAT',
+        'modules': ['mpi/openmpi-x86_64', 'intel-mkl'],
+    },
+}
+
+# merge user settings into the defaults. A json file in the run folder takes precedence so the
+# same main.py can be moved between machines by only changing the json file
+def load_config(config=None, config_file='jdftx_config.json'):
+    res = copy.deepcopy(default_config)
+    overrides = [config or {}]
+    if config_file is not None and os.path.exists(config_file):
+        with open(config_file, 'r') as file:
+            overrides.append(json.load(file))
+    for override in overrides:
+        for key, value in override.items():
+            if isinstance(value, dict) and isinstance(res.get(key), dict):
+                res[key].update(value)
+            else:
+                res[key] = value
+    return res
+
+# create the backend named in the config
+def make_backend(config):
+    backends = {'local': LocalBackend, 'slurm': SlurmBackend, 'fake': FakeBackend, 'replay': ReplayBackend}
+    name = config['backend']
+    if name not in backends:
+        raise ValueError(f"Unknown JDFTx backend '{name}', expected one of {list(backends)}")
+    return backends[name](config)
+
+
+# a trial evaluation that cannot be completed (e.g. its runs were stopped by the watchdog). The
+# optimizer treats the trial as rejected instead of ending the optimization
+class TrialFailed(Exception):
+    pass
+
+
+# launcher prefix of the jdftx command
+def launcher(config, ranks):
+    if not config['mpirun']:
+        return ''
+    return f"{config['mpirun']} -n {ranks} "
+
+
+class Job:
+    """
+    Handle of one submitted JDFTx run
+
+    Args:
+        input_file: Name of the .in file
+        output_file: Name of the .out file
+        folder: Folder the run works in
+        ranks: Number of MPI ranks
+    """
+    def __init__(self, input_file, output_file, folder, ranks):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.folder = os.path.abspath(folder)
+        self.ranks = ranks
+        self.id = None
+        self.process = None
+        self.command = None
+        self.status = 'pending'
+        self.returncode = None
+        # how the scheduler says the job ended (Slurm state), None if it does not tell
+        self.state = None
+        # cores a packed local run is bound to
+        self.cores = None
+
+
+class LocalBackend:
+    """
+    Runs JDFTx with mpirun on the current node. With 'pack' enabled the runs queue for the cores and
+    memory of the node and are bound to their own cores (see nodepack.py)
+    """
+    def __init__(self, config):
+        self.config = config
+        self.pack_config = dict(nk.default_pack_config, **config.get('pack', {}))
+        self.scheduler = nk.NodeScheduler(self.pack_config) if self.pack_config['enabled'] else None
+
+    def command(self, job):
+        if self.scheduler is None:
+            return (
+                f"set -o pipefail; {launcher(self.config, job.ranks)}"
+                f"{self.config['jdftx']} -i {job.folder}/{job.input_file} 2>&1 | tee {job.folder}/{job.output_file}"
+            )
+        return (
+            f"set -o pipefail; {nk.launcher(self.config['mpirun'], job.ranks, job.cores, self.pack_config['bind'])}"
+            f"{self.config['jdftx']} -c {self.pack_config['threads_per_rank']} -i {job.folder}/{job.input_file} 2>&1 | tee {job.folder}/{job.output_file}"
+        )
+
+    def submit(self, input_file, output_file, folder, ranks=None):
+        job = Job(input_file, output_file, folder, ranks or self.config['num_ranks'])
+        if self.scheduler is not None:
+            # started by the scheduler once its cores are free
+            self.scheduler.submit(job)
+            return job
+        self.start(job)
+        return job
+
+    def start(self, job):
+        job.command = self.command(job)
+        # new session so cancel can signal mpirun and all of its ranks together
+        job.process = subprocess.Popen(job.command, shell=True, cwd=job.folder, executable='/bin/bash', start_new_session=True)
+        job.id = job.process.pid
+        job.status = 'running'
+
+    def poll(self, job):
+        if self.scheduler is not None:
+            self.scheduler.dispatch(self.start)
+        if job.status == 'running':
+            returncode = job.process.poll()
+            if returncode is not None:
+                job.returncode = returncode
+                job.status = 'done' if returncode == 0 else 'failed'
+        return job.status
+
+    def wait(self, job):
+        if self.scheduler is not None:
+            # keep starting queued runs while this one waits or runs
+            while self.poll(job) in ['pending', 'running']:
+                time.sleep(self.pack_config['interval'])
+        elif job.status == 'running':
+            job.process.wait()
+            self.poll(job)
+        if job.status != 'done':
+            raise subprocess.CalledProcessError(job.returncode, job.command)
+        return job
+
+    def cancel(self, job):
+        if job.status == 'pending':
+            self.scheduler.remove(job)
+            job.status = 'cancelled'
+        elif self.poll(job) == 'running':
+            try:
+                os.killpg(job.process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            job.process.wait()
+            job.returncode = job.process.returncode
+            job.status = 'cancelled'
+
+
+class SlurmBackend:
+    """
+    Submits every JDFTx run as its own sbatch job
+    """
+    def __init__(self, config):
+        self.config = config
+
+    def write_script(self, job):
+        slurm = self.config['slurm']
+        module_lines = ''.join(f"module load {module}\n" for module in slurm.get('modules', []))
+        script_path = os.path.join(job.folder, f'slurm_{job.input_file}')
+        with open(script_path, 'w') as file:
+            file.write(f"""#!/bin/bash
+#SBATCH -N 1               # Request 1 node
+#SBATCH -n {job.ranks} # Request tasks (processes) on the node
+#SBATCH -c {slurm['cpus_per_task']}              # Request CPUs per task
+#SBATCH -p {slurm['partition']}         # Partition
+#SBATCH -J {slurm['job_name']}           # Job name
+#SBATCH -o slurm_out.o%j   # Output file
+#SBATCH --time={slurm['time']}   # Max run time
+set -o pipefail
+{module_lines}{launcher(self.config, job.ranks)}{self.config['jdftx']} -i {job.folder}/{job.input_file} | tee {job.folder}/{job.output_file}""")
+        return script_path
+
+    def submit(self, input_file, output_file, folder, ranks=None):
+        job = Job(input_file, output_file, folder, ranks or self.config['num_ranks'])
+        script_path = self.write_script(job)
+        job.command = f'sbatch {script_path}'
+        result = subprocess.run(['sbatch', script_path], cwd=job.folder, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        # Output is something like 'Submitted batch job 12345'
+        job.id = result.stdout.strip().split()[-1]
+        job.status = 'running'
+        return job
+
+    def poll(self, job):
+        if job.status != 'running':
+            return job.status
+        result = subprocess.run(['squeue', '-h', '-j', job.id, '-o', '%T'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        if result.stdout.strip():
+            return job.status
+        # job left the queue, ask the accounting database how it ended
+        result = subprocess.run(['sacct', '-n', '-X', '-j', job.id, '-o', 'State,ExitCode'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        split_line = result.stdout.split()
+        state = split_line[0] if split_line else 'COMPLETED'
+        job.state = state
+        if len(split_line) > 1:
+            job.returncode = int(split_line[1].split(':')[0])
+        if state.startswith('COMPLETED'):
+            job.status = 'done'
+        elif state in ['PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'REQUEUED']:
+            job.status = 'running'
+        else:
+            job.status = 'failed'
+        return job.status
+
+    def wait(self, job):
+        while self.poll(job) == 'running':
+            time.sleep(self.config['poll_interval'])
+        if job.status != 'done':
+            raise subprocess.CalledProcessError(job.returncode if job.returncode is not None else 1, job.command)
+        return job
+
+    def cancel(self, job):
+        if self.poll(job) == 'running':
+            subprocess.run(['scancel', job.id], check=False)
+            job.status = 'cancelled'
+
+
+class FakeBackend:
+    """
+    Writes JDFTx outputs from an analytic model in-process, for fast test runs without JDFTx
+    """
+    def __init__(self, config):
+        self.config = config
+        self.fake_config = fk.load_fake_config(config.get('fake'))
+
+    def submit(self, input_file, output_file, folder, ranks=None):
+        job = Job(input_file, output_file, folder, ranks or self.config['num_ranks'])
+        job.command = f'fake jdftx -i {job.folder}/{input_file}'
+        log, job.returncode = fk.run(os.path.join(job.folder, input_file), self.fake_config)
+        with open(os.path.join(job.folder, output_file), 'w') as file:
+            file.write(log)
+        job.status = 'done' if job.returncode == 0 else 'failed'
+        return job
+
+    def poll(self, job):
+        return job.status
+
+    def wait(self, job):
+        if job.status != 'done':
+            raise subprocess.CalledProcessError(job.returncode, job.command)
+        return job
+
+    def cancel(self, job):
+        pass
+
+
+class ReplayBackend(FakeBackend):
+    """
+    Answers JDFTx runs from the recorded results of archived runs (see replaystore.py)
+    """
+    def __init__(self, config):
+        self.config = config
+        self.replay_config = dict(rp.default_replay_config, **config.get('replay', {}))
+        self.store = rp.load_store(self.replay_config['runs'])
+
+    def submit(self, input_file, output_file, folder, ranks=None):
+        job = Job(input_file, output_file, folder, ranks or self.config['num_ranks'])
+        job.command = f'replay jdftx -i {job.folder}/{input_file}'
+        log, job.returncode = rp.run(os.path.join(job.folder, input_file), self.store, self.replay_config)
+        with open(os.path.join(job.folder, output_file), 'w') as file:
+            file.write(log)
+        job.status = 'done' if job.returncode == 0 else 'failed'
+        return job
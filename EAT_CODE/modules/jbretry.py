@@ -0,0 +1,146 @@
+###############################################################################
+# Classification and retry of failed JDFTx runs
+###############################################################################
+# A run that exits with an error is classified from the Slurm state, the exit code and the tail of
+# its logs. Transient failures (out of memory, time limit, MPI or node trouble) are resubmitted after
+# a backoff, permanent ones (missing pseudopotential, input error, electronic minimization that does
+# not converge, cancelled by hand) and runs out of retries fail the trial (jbbackend.TrialFailed) instead of main.py.
+# The inputs read their initial state from the file they dump to, so a resubmitted run continues from
+# the last state the failed one dumped (with e.g. 'dump Ionic State' it dumps during the run).
+
+# imports
+import os
+import re
+import time
+import subprocess
+import modules.jbbackend as jb
+import modules.watchdog as wd
+
+# default policy, entries of jdftx_config['retry'] override it
+default_policy = {
+    'max_retries': 2, # resubmissions of a run that failed for a transient reason
+    'backoff': 60.0, # seconds before the first resubmission, multiplied by backoff_factor for every further one
+    'backoff_factor': 2.0,
+    'max_backoff': 900.0,
+    'transient': ['oom', 'walltime', 'mpi', 'unknown'], # failure kinds that are retried, the others fail the trial at once
+    'tail_bytes': 65536, # bytes read from the end of the logs
+}
+
+# failure kinds and the log lines that mark them, first match wins. JDFTx prints a stack trace and
+# aborts MPI after every fatal error, so the causes come before the MPI markers
+failure_patterns = [
+    ('pseudopotential', re.compile(r'.*(pseudopotential.*(could not|cannot|unable|not found|no such)|(could not|cannot|unable to) (open|find|read).*\.(upf|fhi|psp8|uspp)).*', re.IGNORECASE)),
+    ('input', re.compile(r'.*(Input parse error|Error in input|Unrecognized command|Input error).*')),
+    ('oom', re.compile(r'.*(oom-kill|Out Of Memory|out of memory|std::bad_alloc|Cannot allocate memory).*')),
+    ('walltime', re.compile(r'.*TIME LIMIT.*')),
+    ('cancelled', re.compile(r'.*CANCELLED AT.*')),
+    ('mpi', re.compile(r'.*(MPI_ABORT|orte_init failed|ORTE_ERROR_LOG|mpirun noticed|Segmentation fault|Bus error|Stack trace|slurmstepd[^:]*: error|No space left on device).*')),
+    ('scf', re.compile(r'.*(Elec|Ionic)Minimize: None of the convergence criteria satisfied.*')),
+]
+
+# failure kinds of Slurm job states
+slurm_states = {'OUT_OF_MEMORY': 'oom', 'TIMEOUT': 'walltime', 'NODE_FAIL': 'mpi', 'PREEMPTED': 'mpi', 'BOOT_FAIL': 'mpi'}
+
+# last tail_bytes of a file, '' if it does not exist
+def read_tail(file_name, tail_bytes):
+    if not os.path.exists(file_name):
+        return ''
+    with open(file_name, 'rb') as file:
+        file.seek(max(0, os.path.getsize(file_name) - tail_bytes))
+        return file.read().decode(errors='replace')
+
+def classify(job, policy=None):
+    """
+    Kind of failure of a run that exited with an error
+
+    Args:
+        job: Failed job
+        policy: Retry policy (tail_bytes)
+
+    Returns:
+        kind: 'pseudopotential', 'input', 'oom', 'walltime', 'cancelled' (scancel), 'mpi', 'scf' or 'unknown'
+        reason: The log line or job state the kind was read from
+    """
+    policy = dict(default_policy, **(policy or {}))
+    if job.state in slurm_states:
+        return slurm_states[job.state], f'Slurm state {job.state}'
+    # the tee'd log and, for batch jobs, the output of the job script with the messages of Slurm and MPI
+    text = read_tail(os.path.join(job.folder, job.output_file), policy['tail_bytes'])
+    if job.id is not None:
+        text += read_tail(os.path.join(job.folder, f'slurm_out.o{job.id}'), policy['tail_bytes'])
+    for kind, pattern in failure_patterns:
+        match = pattern.search(text)
+        if match is not None:
+            return kind, match.group(0).strip()
+    # killed by SIGKILL without a message, usually the out of memory killer
+    if job.returncode in [137, -9]:
+        return 'oom', f'exit code {job.returncode}'
+    return 'unknown', f'exit code {job.returncode}'
+
+# bytes of the state file an input starts from, None if it has none
+def state_bytes(input_path):
+    folder = os.path.dirname(os.path.abspath(input_path))
+    with open(input_path, 'r') as file:
+        for line in file:
+            split_line = line.split()
+            if split_line and split_line[0] == 'initial-state':
+                state_path = os.path.join(folder, split_line[1].replace('$VAR', 'wfns'))
+                return os.path.getsize(state_path) if os.path.exists(state_path) else None
+    return None
+
+def wait_jobs(backend, jobs, policy, supervise=None, log=print):
+    """
+    Waits for jobs, resubmitting the ones that fail for a transient reason
+
+    Args:
+        backend: Backend the jobs run on
+        jobs: List of submitted jobs, resubmitted ones are replaced in it so the caller can cancel them
+        policy: Retry policy (see default_policy)
+        supervise: Called with jobs before every wait, e.g. the watchdog. Replaces stopped runs in
+            jobs and raises jb.TrialFailed for the ones it gives up
+        log: Called with a message for every failed run
+
+    Returns:
+        jobs: The finished jobs
+
+    Raises:
+        jb.TrialFailed: A run failed for a permanent reason or ran out of retries
+    """
+    policy = dict(default_policy, **policy)
+    attempts = {}
+    # size of the initial states at the start, a run killed while dumping leaves a shorter one
+    sizes = {os.path.join(job.folder, job.input_file): state_bytes(os.path.join(job.folder, job.input_file)) for job in jobs}
+    while True:
+        if supervise is not None:
+            supervise(jobs)
+        failed = None
+        for job in jobs:
+            try:
+                backend.wait(job)
+            except subprocess.CalledProcessError:
+                failed = job
+                break
+        if failed is None:
+            return jobs
+        input_path = os.path.join(failed.folder, failed.input_file)
+        kind, reason = classify(failed, policy)
+        count = attempts.get(input_path, 0)
+        log(f"Run '{input_path}' failed ({kind}): {reason}")
+        # keep the log of the failed run next to the new one
+        output_path = os.path.join(failed.folder, failed.output_file)
+        if os.path.exists(output_path):
+            os.replace(output_path, f'{output_path}.failed{count + 1}')
+        if kind not in policy['transient']:
+            raise jb.TrialFailed(f"'{input_path}' {kind}: {reason}")
+        if count >= policy['max_retries']:
+            raise jb.TrialFailed(f"'{input_path}' {kind} after {count + 1} attempts: {reason}")
+        current = state_bytes(input_path)
+        if current is not None and sizes.get(input_path) is not None and current < sizes[input_path]:
+            # a truncated state cannot be read, start over
+            wd.adjust_input(input_path, {'initial-state': None})
+            log(f"State of '{input_path}' was cut short, the run starts over.")
+        backoff = min(policy['max_backoff'], policy['backoff'] * policy['backoff_factor']**count)
+        time.sleep(backoff)
+        attempts[input_path] = count + 1
+        jobs[jobs.index(failed)] = backend.submit(failed.input_file, failed.output_file, failed.folder, ranks=failed.ranks)
+        log(f"Run '{input_path}' resubmitted after {backoff:.1f} s (attempt {count + 2}).")
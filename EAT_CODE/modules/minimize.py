@@ -5,6 +5,7 @@
 # imports
 import numpy as np
 import modules.bsruncalc as bs
+import modules.jbbackend as jb
 
 
 def create_diagonal_vectors(N, S):
@@ -26,7 +27,8 @@ def solve_linear_system(M, Hx0, g, N):
     lambd = z[-N:]
     return x, lambd
 
-def solve_quadratic_form(x0, g, H, N, S, details_file_path, max_iter=10000):
+# reference active-set solver that rebuilds and solves the full KKT system at every step
+def solve_quadratic_form_dense(x0, g, H, N, S, details_file_path, max_iter=10000):
     with open(details_file_path, 'a') as file:
         file.write(f"Optimizing BFGS quadratic form subproblem...\n")
     H = 0.5 * (H + H.T)
@@ -94,6 +96,342 @@ def solve_quadratic_form(x0, g, H, N, S, details_file_path, max_iter=10000):
     return x
 
 
+# H restricted to the variables in A is symmetric positive definite, so its inverse can be kept
+# up to date with rank-one updates when a single variable enters or leaves A
+def inverse_remove(Hinv, k):
+    keep = np.r_[0:k, k+1:Hinv.shape[0]]
+    col = Hinv[keep, k]
+    return Hinv[np.ix_(keep, keep)] - np.outer(col, col) / Hinv[k, k]
+
+def inverse_add(Hinv, b, c):
+    # b: column of H between the old variables and the new one, c: its diagonal entry
+    u = Hinv @ b
+    s = c - b @ u
+    n = Hinv.shape[0]
+    res = np.empty((n+1, n+1))
+    res[:n, :n] = Hinv + np.outer(u, u) / s
+    res[:n, n] = -u / s
+    res[n, :n] = -u / s
+    res[n, n] = 1 / s
+    return res
+
+def solve_active_set(Hinv, r_A, site_A, N):
+    """
+    Solves the equality constrained problem on the free variables through a Schur complement on
+    the N simplex multipliers, using that every free variable belongs to exactly one site
+
+    Args:
+        Hinv: Inverse of H restricted to the free variables
+        r_A: (H x0 - g) restricted to the free variables
+        site_A: Site index of every free variable
+        N: Number of sites
+
+    Returns:
+        x_A: Free variables
+        lambd: Multipliers of the simplex constraints
+    """
+    # group free variables by site so that sums over a site are contiguous slices
+    perm = np.argsort(site_A, kind='stable')
+    starts = np.searchsorted(site_A[perm], np.arange(N))
+    Y = np.add.reduceat(Hinv[:, perm], starts, axis=1) # Hinv @ I_A
+    K = np.add.reduceat(Y[perm], starts, axis=0) # I_A^T Hinv I_A
+    u = Hinv @ r_A
+    b = np.add.reduceat(u[perm], starts) - 1
+    lambd = np.linalg.solve(K, b)
+    x_A = u - Y @ lambd
+    return x_A, lambd
+
+def solve_quadratic_form(x0, g, H, N, S, details_file_path, max_iter=10000, refresh=50):
+    """
+    Minimizes the quadratic model g.(x-x0) + 1/2 (x-x0).H.(x-x0) with every site on the simplex.
+    Same active-set steps as solve_quadratic_form_dense, but the inverse of H on the free
+    variables is updated when one index moves and the KKT system is reduced to N multipliers
+
+    Args:
+        x0: Current point
+        g: Gradient at x0
+        H: Quasi-Hessian
+        N: Number of sites
+        S: Number of species
+        details_file_path: Path to details file
+        max_iter: Maximum active-set changes
+        refresh: Recompute the inverse from scratch after this many updates
+
+    Returns:
+        x: Minimizer
+    """
+    with open(details_file_path, 'a') as file:
+        file.write(f"Optimizing BFGS quadratic form subproblem...\n")
+    H = 0.5 * (H + H.T)
+    try:
+        # the damped BFGS update keeps H positive definite, so the eigendecomposition is rarely needed
+        np.linalg.cholesky(H)
+    except np.linalg.LinAlgError:
+        eigenvalues, eigenvectors = np.linalg.eigh(H)
+        eigenvalues[eigenvalues <= 0] = 1e-10
+        H = eigenvectors @ np.diag(eigenvalues) @ eigenvectors.T
+
+    n = N * S
+    site = np.arange(n) // S
+    r = H @ x0 - g
+    # free variables, kept in the same order as the rows of Hinv
+    A = np.arange(n)
+    Hinv = np.linalg.inv(H)
+    updates = 0
+    numit = 1
+    converged = False
+    tolerance = 1e-6  # Adjusted tolerance
+
+    while not converged and numit <= max_iter:
+        x_A, lambd = solve_active_set(Hinv, r[A], site[A], N)
+
+        x = np.zeros(n)
+        x[A] = x_A
+
+        grad_L = H @ (x - x0) + g + lambd[site]
+        mu = grad_L
+        mu[A] = 0
+
+        in_A = np.zeros(n, dtype=bool)
+        in_A[A] = True
+        not_in_A = np.flatnonzero(~in_A)
+        mu_not_in_A = mu[not_in_A]
+
+        indices_to_add = not_in_A[mu_not_in_A < -tolerance]
+        A_sorted = np.flatnonzero(in_A)
+        x_A = x[A_sorted]
+        indices_to_remove = A_sorted[x_A < -tolerance]
+
+        if len(indices_to_add) == 0 and len(indices_to_remove) == 0:
+            converged = True
+        else:
+            if len(indices_to_remove) > 0:
+                min_x_index = indices_to_remove[np.argmin(x_A[x_A < -tolerance])]
+                with open(details_file_path, 'a') as file:
+                    file.write(f"    Iteration {numit}: Removing variable {min_x_index} from active set.\n")
+                x[min_x_index] = 0
+                k = np.flatnonzero(A == min_x_index)[0]
+                Hinv = inverse_remove(Hinv, k)
+                A = np.delete(A, k)
+                updates += 1
+            if len(indices_to_add) > 0:
+                min_mu_index = indices_to_add[np.argmin(mu_not_in_A[mu_not_in_A < -tolerance])]
+                with open(details_file_path, 'a') as file:
+                    file.write(f"    Iteration {numit}: Adding variable {min_mu_index} to active set.\n")
+                Hinv = inverse_add(Hinv, H[A, min_mu_index], H[min_mu_index, min_mu_index])
+                A = np.append(A, min_mu_index)
+                updates += 1
+            # limit the round-off accumulated by the rank-one updates
+            if updates >= refresh:
+                Hinv = np.linalg.inv(H[np.ix_(A, A)])
+                updates = 0
+            numit += 1
+
+    if not converged:
+        with open(details_file_path, 'a') as file:
+            file.write("    Warning: Maximum iterations reached without convergence.\n")
+
+    value = 0.5 * (x - x0).T @ H @ (x - x0) + g.T @ (x - x0)
+    with open(details_file_path, 'a') as file:
+        file.write(f'    Successfully optimized after {numit - 1} iterations.\n    Df (must be < 0) = {value}\n')
+
+    return x
+
+
+class LimitedMemoryHessian:
+    """
+    Quasi-Hessian kept as the last m (s, y) pairs in compact form (Byrd, Nocedal & Schnabel 1994),
+    B = D - W M W^T with diagonal D, W = [D S, Y] and M the inverse of [[S^T D S, L], [L^T, -diag(S^T Y)]].
+    Storage is O(m NS) and B is never formed
+
+    Args:
+        n: Number of variables
+        m: Number of pairs kept
+        diag: Initial diagonal D (scalar or vector)
+    """
+    def __init__(self, n, m=5, diag=1.0):
+        self.n = n
+        self.m = m
+        self.d = np.full(n, diag, dtype=float)
+        self.S = np.zeros((n, 0))
+        self.Y = np.zeros((n, 0))
+        self.build()
+
+    def build(self):
+        self.W = np.hstack((self.d[:, np.newaxis] * self.S, self.Y))
+        SY = self.S.T @ self.Y
+        L = np.tril(SY, -1)
+        self.Minv = np.block([[self.S.T @ (self.d[:, np.newaxis] * self.S), L], [L.T, -np.diag(np.diag(SY))]])
+
+    def update(self, s, y):
+        self.S = np.hstack((self.S, s[:, np.newaxis]))[:, -self.m:]
+        self.Y = np.hstack((self.Y, y[:, np.newaxis]))[:, -self.m:]
+        self.build()
+
+    def dot(self, v):
+        if self.W.shape[1] == 0:
+            return self.d * v
+        return self.d * v - self.W @ np.linalg.solve(self.Minv, self.W.T @ v)
+
+    def dense(self):
+        if self.W.shape[1] == 0:
+            return np.diag(self.d)
+        return np.diag(self.d) - self.W @ np.linalg.solve(self.Minv, self.W.T)
+
+def shift_quasi_hessian(B, h, floor=1e-3):
+    """
+    Adds a known diagonal change of the Hessian to the quasi-Hessian, e.g. of the entropy term when eta
+    changes, and keeps the result positive definite
+
+    Args:
+        B: Quasi-Hessian (array or LimitedMemoryHessian), None is returned unchanged
+        h: Diagonal added to the Hessian
+        floor: Smallest eigenvalue (dense) or diagonal entry (limited memory) kept, relative to the largest
+
+    Returns:
+        B: Shifted quasi-Hessian
+    """
+    if B is None:
+        return None
+    if isinstance(B, LimitedMemoryHessian):
+        # shift the diagonal and the curvature pairs, the rebuilt B meets the secant equations of the shifted Hessian
+        d = B.d + h
+        B.d = np.maximum(d, floor * np.max(np.abs(d)))
+        B.Y = B.Y + h[:, np.newaxis] * B.S
+        # pairs with lost curvature cannot be kept in a positive definite B
+        keep = np.einsum('ij,ij->j', B.S, B.Y) > 0
+        B.S = B.S[:, keep]
+        B.Y = B.Y[:, keep]
+        B.build()
+        return B
+    return positive_definite(B + np.diag(h), floor)
+
+# symmetric B with its eigenvalues clamped to at least floor times the largest magnitude
+def positive_definite(B, floor=1e-3):
+    eigvals, eigvecs = np.linalg.eigh((B + B.T) / 2)
+    if eigvals[0] >= floor * eigvals[-1] and eigvals[-1] > 0:
+        return B
+    eigvals = np.maximum(eigvals, floor * np.max(np.abs(eigvals)))
+    return (eigvecs * eigvals) @ eigvecs.T
+
+# product of the quasi-Hessian with a vector, for dense or limited-memory B
+def hessian_dot(B, v):
+    if isinstance(B, LimitedMemoryHessian):
+        return B.dot(v)
+    return B @ v
+
+def solve_active_set_lm(B, A, r_A, site_A, N):
+    """
+    Same as solve_active_set for a limited-memory B. By Woodbury, (B_AA)^-1 = D^-1 + D^-1 W C W^T D^-1
+    with C^-1 = M^-1 - W^T D^-1 W, and the Schur complement on the multipliers is a diagonal plus
+    a rank-2m term, so one solve costs O(|A| m + N m^2 + m^3)
+
+    Args:
+        B: LimitedMemoryHessian
+        A: Free variables
+        r_A: (B x0 - g) restricted to the free variables
+        site_A: Site index of every free variable
+        N: Number of sites
+
+    Returns:
+        x_A: Free variables
+        lambd: Multipliers of the simplex constraints
+    """
+    dinv = 1 / B.d[A]
+    W = B.W[A]
+    Cinv = B.Minv - W.T @ (dinv[:, np.newaxis] * W)
+    # per-site sums of D^-1, D^-1 W and D^-1 r
+    delta = np.bincount(site_A, weights=dinv, minlength=N)
+    DW = dinv[:, np.newaxis] * W
+    U = np.zeros((N, W.shape[1]))
+    for j in range(W.shape[1]):
+        U[:, j] = np.bincount(site_A, weights=DW[:, j], minlength=N)
+    # u = (B_AA)^-1 r_A
+    dr = dinv * r_A
+    u = dr + dinv * (W @ np.linalg.solve(Cinv, W.T @ dr))
+    b = np.bincount(site_A, weights=u, minlength=N) - 1
+    # K = diag(delta) + U C U^T, solved with Woodbury once more
+    if W.shape[1] > 0:
+        core = Cinv + U.T @ (U / delta[:, np.newaxis])
+        lambd = b / delta - (U @ np.linalg.solve(core, U.T @ (b / delta))) / delta
+    else:
+        lambd = b / delta
+    # x_A = (B_AA)^-1 (r_A - I_A lambd)
+    v = r_A - lambd[site_A]
+    dv = dinv * v
+    x_A = dv + dinv * (W @ np.linalg.solve(Cinv, W.T @ dv))
+    return x_A, lambd
+
+def solve_quadratic_form_lm(x0, g, B, N, S, details_file_path, max_iter=10000):
+    """
+    solve_quadratic_form for a LimitedMemoryHessian: the same active-set steps, with every
+    step linear in the number of variables
+
+    Args:
+        x0: Current point
+        g: Gradient at x0
+        B: LimitedMemoryHessian
+        N: Number of sites
+        S: Number of species
+        details_file_path: Path to details file
+        max_iter: Maximum active-set changes
+
+    Returns:
+        x: Minimizer
+    """
+    with open(details_file_path, 'a') as file:
+        file.write(f"Optimizing L-BFGS quadratic form subproblem...\n")
+    n = N * S
+    site = np.arange(n) // S
+    r = B.dot(x0) - g
+    in_A = np.ones(n, dtype=bool)
+    numit = 1
+    converged = False
+    tolerance = 1e-6  # Adjusted tolerance
+
+    while not converged and numit <= max_iter:
+        A = np.flatnonzero(in_A)
+        x_A, lambd = solve_active_set_lm(B, A, r[A], site[A], N)
+
+        x = np.zeros(n)
+        x[A] = x_A
+
+        grad_L = B.dot(x - x0) + g + lambd[site]
+        mu = grad_L
+        mu[A] = 0
+
+        not_in_A = np.flatnonzero(~in_A)
+        mu_not_in_A = mu[not_in_A]
+
+        indices_to_add = not_in_A[mu_not_in_A < -tolerance]
+        indices_to_remove = A[x_A < -tolerance]
+
+        if len(indices_to_add) == 0 and len(indices_to_remove) == 0:
+            converged = True
+        else:
+            if len(indices_to_remove) > 0:
+                min_x_index = indices_to_remove[np.argmin(x_A[x_A < -tolerance])]
+                with open(details_file_path, 'a') as file:
+                    file.write(f"    Iteration {numit}: Removing variable {min_x_index} from active set.\n")
+                x[min_x_index] = 0
+                in_A[min_x_index] = False
+            if len(indices_to_add) > 0:
+                min_mu_index = indices_to_add[np.argmin(mu_not_in_A[mu_not_in_A < -tolerance])]
+                with open(details_file_path, 'a') as file:
+                    file.write(f"    Iteration {numit}: Adding variable {min_mu_index} to active set.\n")
+                in_A[min_mu_index] = True
+            numit += 1
+
+    if not converged:
+        with open(details_file_path, 'a') as file:
+            file.write("    Warning: Maximum iterations reached without convergence.\n")
+
+    value = 0.5 * (x - x0) @ B.dot(x - x0) + g @ (x - x0)
+    with open(details_file_path, 'a') as file:
+        file.write(f'    Successfully optimized after {numit - 1} iterations.\n    Df (must be < 0) = {value}\n')
+
+    return x
+
 def project_to_simplex_fast(x, N):
     phi = x.reshape(N, -1)
     # Sort phi in descending order
@@ -121,7 +459,78 @@ def project_to_simplex_fast(x, N):
     
     return phi_projected.reshape(-1)
 
-def PBFGS(fun, x0, jac, args, S,  folder, progress_file_path, details_file_path, callback, B=None, project=project_to_simplex_fast, maxit=10, tol=1e-3):
+def inexact_tolerance(pg_norm, decrease, sensitivity, bounds=(1e-6, 1e-4), kappa=0.1):
+    """
+    Electronic energy threshold for the next DFT evaluation in inexact mode
+
+    Args:
+        pg_norm: Projected gradient norm at the current point, None if not known yet
+        decrease: Decrease of the objective predicted for the trial step, None for no step
+        sensitivity: Change of the objective per Hartree of error in the DFT energies
+        bounds: Tightest and loosest threshold (Hartree)
+        kappa: Fraction of pg_norm and of decrease the energy error may reach
+
+    Returns:
+        res: Threshold (Hartree)
+    """
+    # unknown progress, be exact
+    if pg_norm is None:
+        return bounds[0]
+    sensitivity = max(sensitivity, 1e-12)
+    # gradient error well below the stationarity measure, so the convergence test stays meaningful
+    res = kappa * pg_norm / sensitivity
+    # energy error well below the predicted decrease, so an accepted step still decreases the true objective
+    if decrease is not None:
+        res = min(res, kappa * abs(decrease) / sensitivity)
+    return float(np.clip(res, bounds[0], bounds[1]))
+
+# smallest part of a step outside the span of the others, relative to its length, for a multi-secant pair
+secant_tol = 0.1
+
+# evaluated points the multi-secant update keeps per call, as a multiple of its number of pairs
+secant_history = 4
+
+# point of the multi-secant history, with the residual gradients J in structured mode
+def secant_point(x, g, record, residual, args):
+    J = None
+    if residual is not None and record is not None:
+        J = residual(x, record, *args)[1]
+    return {'x': x, 'g': g, 'J': J}
+
+# damped BFGS update of B (array or LimitedMemoryHessian) with the step s and gradient change y
+def damped_update(B, s, y):
+    Bs = hessian_dot(B, s)
+    sBs = s @ Bs
+    if sBs <= 0:
+        return B
+    if np.dot(s, y) >= 0.2 * sBs:
+        theta = 1
+    else:
+        theta = 0.8 * sBs / (sBs - np.dot(s, y))
+    r = theta * y + (1-theta) * Bs
+    if isinstance(B, LimitedMemoryHessian):
+        B.update(s, r)
+        return B
+    return B - np.outer(Bs, Bs) / sBs + np.outer(r, r) / np.dot(s, r)
+
+# indices of the steps, in the given order, that are not close to the span of s and of the steps chosen
+# before them (their component outside the span is at least tol times their length), at most max_steps
+def independent_steps(steps, s, max_steps, tol=secant_tol):
+    basis = [s / np.linalg.norm(s)]
+    res = []
+    for j, step in enumerate(steps):
+        if len(res) >= max_steps:
+            break
+        norm = np.linalg.norm(step)
+        if norm == 0:
+            continue
+        v = step - sum(np.dot(q, step) * q for q in basis)
+        if np.linalg.norm(v) >= tol * norm:
+            basis.append(v / np.linalg.norm(v))
+            res.append(j)
+    return res
+
+def PBFGS(fun, x0, jac, args, S,  folder, progress_file_path, details_file_path, callback, B=None, project=project_to_simplex_fast, maxit=10, tol=1e-3, checkpoint=None, resume=None, memory=None, stats=None, precision=None, speculative_alphas=None, residual=None, reg_hess=None, multi_secant=None):
     """
     Perform projected BFGS
 
@@ -131,76 +540,197 @@ def PBFGS(fun, x0, jac, args, S,  folder, progress_file_path, details_file_path,
         jac: Gradient of function
         args: Extra args passed to fun and jac
         S: Number of species
-        folder: Folder from which we extract energies and gradients
+        folder: Evaluation record from which we extract energies and gradients
         progress_file_path: Path to progress file
         details_file_path: Path to details file
         callback: Callback function
-        B: Initial quasi-Hessian
+        B: Initial quasi-Hessian (array or LimitedMemoryHessian)
         project: Projection back onto nearest point on valid domain
         maxit: Maximum iterations
         tol: Tolerance of convergence
+        checkpoint: Called with the optimizer state after every DFT evaluation
+        resume: State given to checkpoint by an interrupted run, to continue from the same step
+        memory: If set, keep only this many (s, y) pairs (limited-memory mode) instead of a dense B
+        stats: Dict filled with the outcome: status ('converged', 'maxit' or 'line_search_failed'),
+            iterations, line_search_failures and the final projected gradient norm pg_norm
+        precision: Inexact mode, called as precision(pg_norm, decrease, f) for the electronic threshold
+            of every DFT evaluation (see inexact_tolerance). None keeps the threshold of the inputs
+        speculative_alphas: Step sizes the line search submits at once, e.g. (1, 0.5, 0.25), None for serial trials
+        residual: Structured mode for fun = 1/2 |r|^2 + reg. Called like jac, returns the residuals r (m,)
+            and their gradients J (m, n). The model Hessian is then J^T J + reg_hess + A, and B holds only
+            the correction A for the curvature of r, learned from y# = J_new^T r_new - J_old^T r_new
+        reg_hess: Diagonal of the exact Hessian of the regularizer, called as reg_hess(x, *args)
+        multi_secant: If set, every DFT evaluation of this call (rejected line search trials included) is
+            kept, and each update first applies the secant pairs from up to this many earlier points to
+            the new one, newest first among those whose steps are not close to the span of the others
 
     Returns:
         x: Final solution
         B: Final Hessian
-        unique_folder: Folder from which we extract energies and gradients
+        unique_folder: Evaluation record from which we extract energies and gradients
     """
     unique_folder = folder
+    if residual is not None and memory is not None:
+        raise ValueError('Structured quasi-Newton (residual) needs a dense B, set memory=None')
+    if stats is None:
+        stats = {}
+    stats.update({'status': 'maxit', 'iterations': 0, 'line_search_failures': 0, 'pg_norm': None, 'secant_pairs': 0})
     x_full = x0.reshape(-1, S)
     N = x_full.shape[0]
     x = x0
-    I = np.eye(len(x))
     f_new = None
     g_new = None
     k = 1
+    line_state = None
+    skip_callback = False
+    pg_norm = None
+    # evaluated points with their gradients (and residual gradients) for the multi-secant update
+    history = []
+    if resume is not None:
+        history = resume.get('history', [])
+        x = resume['x'].copy()
+        B = resume['B']
+        k = resume['k']
+        unique_folder = resume['unique_folder']
+        f_new = resume['f']
+        g_new = resume['g']
+        # the callback already ran for this point
+        skip_callback = resume['stage'] == 'top'
+        if resume['stage'] == 'line':
+            line_state = resume['line']
+            f = resume['f']
+            g = resume['g']
+            d = resume['d']
+            x_folder = resume.get('x_folder')
+            if x_folder is None:
+                # checkpoints written before the record of x was kept only have the one of the last trial,
+                # which the structured mode cannot use for J at x
+                if residual is not None:
+                    raise ValueError('Line search checkpoint has no evaluation record of x, resume it without structured quasi-Newton (residual)')
+                x_folder = resume['unique_folder']
+            if residual is not None:
+                res, J = residual(x, x_folder, *args)
+        with open(details_file_path, 'a') as file:
+            file.write(f"\nResuming PBFGS at iteration {k} ({resume['stage']})\n")
     while k <= maxit:
-        if f_new is not None and g_new is not None:
-            f = f_new
-            g = g_new
-        else:
-            # Perform JDFTx calculation
-            unique_folder = bs.perform_calc(x, *args)
-            f = fun(x, unique_folder, *args)
-            g = jac(x, unique_folder, *args)
-        # Write to min_progress file
-        callback(x, unique_folder)
-        # Check for convergence
-        if np.linalg.norm(project(x-g, N) - x) < tol:
+        if line_state is None:
+            if f_new is not None and g_new is not None:
+                f = f_new
+                g = g_new
+            else:
+                # Perform JDFTx calculation
+                tolerance = None if precision is None else precision(pg_norm, None, None)
+                try:
+                    unique_folder = bs.perform_calc(x, *args, tolerance=tolerance)
+                except jb.TrialFailed as e:
+                    # x is still the point of the record passed in, carry on from that one
+                    if folder is None:
+                        raise
+                    with open(details_file_path, 'a') as file:
+                        file.write(f"\nEvaluation failed: {e}\nContinuing from the evaluation record '{folder}'\n")
+                    unique_folder = folder
+                f = fun(x, unique_folder, *args)
+                g = jac(x, unique_folder, *args)
+                if multi_secant is not None:
+                    history.append(secant_point(x.copy(), g, unique_folder, residual, args))
+            # Write to min_progress file
+            if not skip_callback:
+                callback(x, unique_folder)
+            skip_callback = False
+            if checkpoint is not None:
+                checkpoint({'stage': 'top', 'x': x, 'B': B, 'k': k, 'f': f, 'g': g, 'unique_folder': unique_folder, 'history': history})
+            stats['iterations'] = k
+            pg_norm = np.linalg.norm(project(x-g, N) - x)
+            stats['pg_norm'] = pg_norm
+            # Check for convergence
+            if np.linalg.norm(project(x-g, N) - x) < tol:
+                stats['status'] = 'converged'
+                with open(details_file_path, 'a') as file:
+                    file.write(f"\nPBFGS converged after {k} iterations: fun = {f}, tol = {np.linalg.norm(project(x-g, N) - x)}\nx = {x}\n")
+                break
+            # Print current iteration summary
             with open(details_file_path, 'a') as file:
-                file.write(f"\nPBFGS converged after {k} iterations: fun = {f}, tol = {np.linalg.norm(project(x-g, N) - x)}\nx = {x}\n")
-            break
-        # Print current iteration summary
-        with open(details_file_path, 'a') as file:
-            file.write(f"\nPBFGS iteration {k}: fun = {f}, tol = {np.linalg.norm(project(x-g, N) - x)}\n")
-        if B is None:
-            B = 5 *  np.linalg.norm(g) * I # Initial quasi-Hessian
-        # Obtain line search direction
-        x_star = solve_quadratic_form(x0=x, g=g, H=B, N=N, S=S, details_file_path=details_file_path)
-        x_star = project(x_star, N) # project result to be safe
-        d = x_star - x
+                file.write(f"\nPBFGS iteration {k}: fun = {f}, tol = {np.linalg.norm(project(x-g, N) - x)}\n")
+            x_folder = unique_folder
+            if residual is not None:
+                res, J = residual(x, x_folder, *args)
+            if B is None:
+                # Initial quasi-Hessian
+                if residual is not None:
+                    # only the curvature of the residuals is learned, start it small next to J^T J
+                    B = 1e-2 * max(np.sum(J**2), 1e-12) * np.eye(len(x))
+                elif memory is None:
+                    B = 5 *  np.linalg.norm(g) * np.eye(len(x))
+                else:
+                    B = LimitedMemoryHessian(len(x), m=memory, diag=5 * np.linalg.norm(g))
+            # Obtain line search direction
+            if residual is not None:
+                H = J.T @ J + B
+                if reg_hess is not None:
+                    H = H + np.diag(reg_hess(x, *args))
+                x_star = solve_quadratic_form(x0=x, g=g, H=positive_definite(H), N=N, S=S, details_file_path=details_file_path)
+            elif isinstance(B, LimitedMemoryHessian):
+                x_star = solve_quadratic_form_lm(x0=x, g=g, B=B, N=N, S=S, details_file_path=details_file_path)
+            else:
+                x_star = solve_quadratic_form(x0=x, g=g, H=B, N=N, S=S, details_file_path=details_file_path)
+            x_star = project(x_star, N) # project result to be safe
+            d = x_star - x
+        # save the line search bracket together with the state of this iteration
+        line_checkpoint = None
+        if checkpoint is not None:
+            line_checkpoint = lambda state: checkpoint({'stage': 'line', 'x': x, 'B': B, 'k': k, 'f': f, 'g': g, 'd': d, 'unique_folder': state['unique_folder'], 'x_folder': x_folder, 'history': history, 'line': state})
+        line_precision = None
+        if precision is not None:
+            if pg_norm is None:
+                pg_norm = np.linalg.norm(project(x-g, N) - x)
+            line_precision = lambda decrease: precision(pg_norm, decrease, f)
         # Choose step by line search
         alpha = 1
-        alpha, f_new, g_new, unique_folder = line_min(fun=fun, jac=jac, x0=x, f0=f, g0=g, p=d, args=args, folder=unique_folder, details_file_path=details_file_path, amax=alpha, c1=0.0, maxiter=4)
+        trials = [] if multi_secant is not None else None
+        alpha, f_new, g_new, unique_folder = line_min(fun=fun, jac=jac, x0=x, f0=f, g0=g, p=d, args=args, folder=unique_folder, details_file_path=details_file_path, amax=alpha, c1=0.0, maxiter=4, checkpoint=line_checkpoint, resume=line_state, precision=line_precision, alphas=speculative_alphas, trials=trials)
+        line_state = None
+        new_points = []
+        if multi_secant is not None:
+            new_points = [secant_point(x + a_trial * d, g_trial, record, residual, args) for a_trial, _, g_trial, record in trials]
         
         # If line search failed, reset Hessian
         if alpha is None:
             with open(details_file_path, 'a') as file:
                 file.write(f"Line search failed, presumably because of bad curvature. Increasing entropy parameter.\n")
-            return x, B, unique_folder
+            stats['status'] = 'line_search_failed'
+            stats['line_search_failures'] += 1
+            # x did not move, its own record goes back rather than the last rejected trial
+            return x, B, x_folder
         
         # Update parameters
         x += alpha * d
         x = project(x, N) # project again to make sure no negative values
         s = alpha * d
         y = g_new - g
+        if residual is not None:
+            # structured secant: the change of J^T r not explained by the Gauss-Newton term
+            res_new, J_new = residual(x, unique_folder, *args)
+            y = J_new.T @ res_new - J.T @ res_new
 
-        # Damped BFGS Update
-        if np.dot(s, y) >= 0.2 * s @ B @ s:
-            theta = 1
-        else:
-            theta = 0.8 * s @ B @ s / (s @ B @ s - np.dot(s, y))
-        r = theta * y + (1-theta) * B @ s
-        B = B - B @ np.outer(s, s) @ B / (s @ B @ s) + np.outer(r, r) / np.dot(s, r) 
+        if multi_secant is not None:
+            # rejected trials of this search lie on the line of s, they count from the next update on
+            candidates = [point for point in reversed(history + new_points[:-1]) if residual is None or point['J'] is not None]
+            chosen = independent_steps([x - point['x'] for point in candidates], s, multi_secant)
+            for j in reversed(chosen):
+                point = candidates[j]
+                if residual is not None:
+                    y_point = J_new.T @ res_new - point['J'].T @ res_new
+                else:
+                    y_point = g_new - point['g']
+                # pairs over longer distances are only kept where they need no damping
+                s_point = x - point['x']
+                if np.dot(s_point, y_point) >= 0.2 * (s_point @ hessian_dot(B, s_point)):
+                    B = damped_update(B, s_point, y_point)
+                    stats['secant_pairs'] += 1
+            history = (history + new_points)[-secant_history * multi_secant:]
+
+        # Damped BFGS Update, the pair of the accepted step comes last and weighs the most
+        B = damped_update(B, s, y)
         # Write result to file if at maximum iterations
         if k == maxit:
             with open(details_file_path, 'a') as file:
@@ -208,7 +738,7 @@ def PBFGS(fun, x0, jac, args, S,  folder, progress_file_path, details_file_path,
         k += 1
     return x, B, unique_folder
 
-def line_min(fun, jac, x0, f0, g0, p, args, folder, details_file_path, amax=1, c1=0.0001, maxiter=10):
+def line_min(fun, jac, x0, f0, g0, p, args, folder, details_file_path, amax=1, c1=0.0001, maxiter=10, checkpoint=None, resume=None, precision=None, alphas=None, trials=None):
     """
     Perfoms line minimization to find optimal step size
 
@@ -220,17 +750,25 @@ def line_min(fun, jac, x0, f0, g0, p, args, folder, details_file_path, amax=1, c
         g0: gradient value at x0
         p: search direction
         args: objective function arguments
-        folder: Folder from which we extract energies and gradients
+        folder: Evaluation record from which we extract energies and gradients
         details_file_path: Path to details file
         amax: maximum step size
         c1: Armijo condition parameter
         maxiter: maximum iterations
+        checkpoint: Called with the bracket after every DFT evaluation
+        resume: Bracket given to checkpoint by an interrupted run
+        precision: Called with the decrease predicted for a trial step, returns its electronic threshold
+        alphas: Step sizes evaluated at the same time in a first speculative round, in order of preference,
+            e.g. (1, 0.5, 0.25). The first that satisfies the Armijo test is taken and the rest cancelled.
+            If none does, the search continues serially by cubic interpolation from the smallest
+        trials: List extended with (alpha, f, g, record) of every trial evaluated, accepted or not. Trials that
+            failed (jb.TrialFailed) count as f = inf and are left out, the step is halved after them
 
     Returns:
         a: best step size
         f: objective function at best step size
         g: objective gradient at best step size
-        unique_folder: Folder from which we extract energies and gradients
+        unique_folder: Evaluation record from which we extract energies and gradients
 
     """
     unique_folder = folder
@@ -241,27 +779,128 @@ def line_min(fun, jac, x0, f0, g0, p, args, folder, details_file_path, amax=1, c
     f.append(f0)
     g = []
     g.append(g0)
+    records = [folder]
     i = 1
-    with open(details_file_path, 'a') as file:
-        file.write(f'Performing line minimization...\n')
-    while i<=maxiter:
-        # Perform JDFTx calculation
+    if resume is not None:
+        a = list(resume['a'])
+        f = list(resume['f'])
+        g = list(resume['g'])
+        records = list(resume.get('records', [None] * len(f)))
+        i = resume['i']
+        unique_folder = resume['unique_folder']
+    else:
         with open(details_file_path, 'a') as file:
-            file.write(f'   ->Iteration {i}\n')
-        unique_folder = bs.perform_calc(x0 + a[i] * p, *args)      
-        f.append(fun(x0 + a[i] * p, unique_folder, *args))
-        g.append(jac(x0 + a[i] * p, unique_folder, *args))
+            file.write(f'Performing line minimization...\n')
+        if alphas is not None and len(alphas) > 1:
+            a, f, g, unique_folder, records = speculative_round(fun, jac, x0, f0, g0, p, args, folder, details_file_path, c1, alphas[:maxiter], precision)
+            i = len(a) - 1
+            if checkpoint is not None:
+                checkpoint({'a': a, 'f': f, 'g': g, 'i': i, 'unique_folder': unique_folder, 'records': records})
+    while i<=maxiter:
+        # trial i may already have been evaluated before a restart
+        if len(f) <= i:
+            # Perform JDFTx calculation
+            tolerance = None if precision is None else precision(a[i] * np.dot(g0, p))
+            with open(details_file_path, 'a') as file:
+                file.write(f'   ->Iteration {i}' + ('' if tolerance is None else f' (energy threshold {tolerance:.1e})') + '\n')
+            try:
+                record = bs.perform_calc(x0 + a[i] * p, *args, tolerance=tolerance)
+            except jb.TrialFailed as e:
+                # a trial whose runs diverged or stalled counts as an infinite objective
+                with open(details_file_path, 'a') as file:
+                    file.write(f'      Trial failed: {e}\n')
+                f.append(np.inf)
+                g.append(None)
+                records.append(None)
+            else:
+                unique_folder = record
+                f.append(fun(x0 + a[i] * p, unique_folder, *args))
+                g.append(jac(x0 + a[i] * p, unique_folder, *args))
+                records.append(unique_folder)
+            if checkpoint is not None:
+                checkpoint({'a': a, 'f': f, 'g': g, 'i': i, 'unique_folder': unique_folder, 'records': records})
         if f[i] <= f[0] + c1 * a[i] * np.dot(g[0], p):
             with open(details_file_path, 'a') as file:
                 file.write(f'Line minimization succeded after {i} iterations.\n')
+            if trials is not None:
+                trials.extend(trial for trial in zip(a[1:i+1], f[1:i+1], g[1:i+1], records[1:i+1]) if trial[2] is not None)
             return a[i], f[i], g[i], unique_folder
+        elif g[i] is None:
+            # nothing to interpolate from a failed trial, halve the step
+            a.append(0.5 * a[i])
         else:
             a.append(cubic_interp(a[i], f[i], np.dot(g[i], p), a[0], f[0], np.dot(g[0], p)))
         i += 1
+    if trials is not None:
+        trials.extend(trial for trial in zip(a[1:len(f)], f[1:], g[1:], records[1:]) if trial[2] is not None)
     with open(details_file_path, 'a') as file:
         file.write(f'Line minimization failed to find minimizing step after {i} iterations\n')
         return None, f[maxiter], g[maxiter], unique_folder
 
+def speculative_round(fun, jac, x0, f0, g0, p, args, folder, details_file_path, c1, alphas, precision=None):
+    """
+    Evaluates several step sizes along p at the same time and keeps the first acceptable one
+
+    Args:
+        alphas: Step sizes in order of preference
+        Other args as in line_min
+
+    Returns:
+        a, f, g: Step sizes, function values and gradients evaluated, starting with 0. The last entry is
+            the accepted step if there is one
+        unique_folder: Evaluation record of the last entry
+        records: Evaluation records of all entries, starting with folder
+    """
+    ranks = bs.calc_ranks(len(alphas))
+    pending = []
+    with open(details_file_path, 'a') as file:
+        file.write(f'   ->Iterations 1-{len(alphas)} in parallel, alpha = {list(alphas)}\n')
+    try:
+        for alpha in alphas:
+            tolerance = None if precision is None else precision(alpha * np.dot(g0, p))
+            pending.append(bs.submit_calc(x0 + alpha * p, *args, tolerance=tolerance, ranks=ranks, copy_wfns=True))
+    except Exception:
+        for trial in pending:
+            bs.cancel_calc(trial)
+        raise
+    a = [0]
+    f = [f0]
+    g = [g0]
+    records = [folder]
+    unique_folder = folder
+    try:
+        for j, alpha in enumerate(alphas):
+            try:
+                record = bs.collect_calc(pending[j], adopt=False)
+            except jb.TrialFailed as e:
+                with open(details_file_path, 'a') as file:
+                    file.write(f'      Trial failed: {e}\n')
+                a.append(alpha)
+                f.append(np.inf)
+                g.append(None)
+                records.append(None)
+                continue
+            a.append(alpha)
+            f.append(fun(x0 + alpha * p, record, *args))
+            g.append(jac(x0 + alpha * p, record, *args))
+            records.append(record)
+            unique_folder = record
+            if f[-1] <= f[0] + c1 * alpha * np.dot(g[0], p):
+                # later trials are not needed, finished ones stay in the result cache
+                bs.adopt_calc(pending[j]['folder'])
+                for trial in pending[j+1:]:
+                    bs.cancel_calc(trial)
+                with open(details_file_path, 'a') as file:
+                    file.write(f'      Accepted alpha = {alpha}, cancelled {len(alphas) - j - 1} trials\n')
+                return a, f, g, unique_folder, records
+            bs.discard_wfns(pending[j]['folder'])
+    except Exception:
+        for trial in pending:
+            bs.cancel_calc(trial)
+        raise
+    # nothing adopted, the serial search continues from the wavefunctions and positions of x0
+    return a, f, g, unique_folder, records
+
 def cubic_interp(an, fn, gn, ao, fo, go):
     """
     Obtain new step size by cubic interpolation
@@ -0,0 +1,269 @@
+###############################################################################
+# Packing of several JDFTx runs on the cores and memory of one node
+###############################################################################
+# The local backend hands every run to a NodeScheduler instead of starting it at once. The scheduler
+# starts queued runs as cores and memory free up, gives each its own set of cores (bound with taskset
+# or the cpu set of Open MPI) and, with auto_ranks, picks the ranks of a run from the free cores, the
+# runs waiting for them and the measured scaling of earlier runs of the same system. Processes that
+# pack the same node (campaign runs) share their claims through state_file.
+
+# imports
+import os
+import re
+import json
+import time
+import fcntl
+import numpy as np
+import modules.outread as ot
+
+# default settings, entries of jdftx_config['pack'] override them
+default_pack_config = {
+    'enabled': False, # queue local runs and pack them on the node instead of starting them at once
+    'cores': None, # cores to pack runs on: None for all this process may run on, a number for the first ones, or a list of ids
+    'memory_fraction': 0.9, # share of the memory of the node the runs may reserve
+    'memory_per_rank': None, # bytes reserved for every rank, None does not limit by memory
+    'threads_per_rank': 1, # JDFTx threads (-c) of every rank, a run uses ranks * threads_per_rank cores
+    'auto_ranks': False, # choose the ranks of every run from the free cores and the measured scaling, instead of the ranks asked for
+    'max_ranks': None, # upper bound of the ranks of one run
+    'scaling_tolerance': 0.1, # auto_ranks takes the fewest cores whose expected time per iteration is within this of the fair share
+    'scaling_file': 'pack_scaling.json', # measured time per electronic iteration of every system and core count
+    'bind': 'taskset', # 'taskset' pins every run to its cores, 'mpirun' pins every rank (Open MPI --cpu-set), None does not pin
+    'state_file': None, # json shared by the processes packing the same node, e.g. '/dev/shm/eat_pack.json'. None packs this process only
+    'interval': 0.2, # seconds between checks while waiting for a run
+}
+
+# total memory of the node in bytes, None where /proc/meminfo cannot be read
+def node_memory():
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# cores runs may be packed on
+def node_cores(cores=None):
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    if cores is None:
+        return available
+    if isinstance(cores, int):
+        return available[:cores]
+    return sorted(cores)
+
+# system an input describes, runs of the same system share their scaling: dump name and ion count
+def system_key(input_path):
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    ions = 0
+    with open(input_path, 'r') as file:
+        for line in file:
+            split_line = line.split()
+            if not split_line:
+                continue
+            if split_line[0] == 'dump-name':
+                name = split_line[1].replace('.$VAR', '')
+            elif split_line[0] == 'ion':
+                ions += 1
+    return f'{name}:{ions}'
+
+# compact list of core ids for taskset and Open MPI, e.g. '0-3,8'
+def core_list(cores):
+    res = []
+    for core in sorted(cores):
+        if res and core == res[-1][1] + 1:
+            res[-1][1] = core
+        else:
+            res.append([core, core])
+    return ','.join(f'{first}' if first == last else f'{first}-{last}' for first, last in res)
+
+# Amdahl fit t(c) = a + b / c of the time per iteration, from {cores: [seconds, iterations]}. None
+# while fewer than two core counts were measured
+def fit_scaling(measurements):
+    cores = np.array([int(c) for c in measurements], dtype=float)
+    if len(cores) < 2:
+        return None
+    seconds = np.array([measurements[c][0] for c in measurements])
+    iterations = np.array([measurements[c][1] for c in measurements])
+    # every core count weighs with the square root of its iterations
+    weight = np.sqrt(iterations)
+    A = np.stack([np.ones_like(cores), 1 / cores], axis=1) * weight[:, None]
+    coefficients = np.linalg.lstsq(A, seconds / iterations * weight, rcond=None)[0]
+    return np.maximum(coefficients, 0.0)
+
+class NodeScheduler:
+    """
+    Queue of JDFTx runs packed on the cores and memory of one node
+
+    Args:
+        config: Packing settings (see default_pack_config)
+    """
+    def __init__(self, config):
+        self.config = dict(default_pack_config, **config)
+        self.cores = node_cores(self.config['cores'])
+        memory = node_memory()
+        self.memory = None if memory is None or self.config['memory_per_rank'] is None else self.config['memory_fraction'] * memory
+        self.queue = []
+        self.running = []
+        self.scaling = self.load_scaling()
+
+    def load_scaling(self):
+        try:
+            with open(self.config['scaling_file'], 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_scaling(self):
+        tmp_path = f"{self.config['scaling_file']}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.scaling, file, indent=1)
+        os.replace(tmp_path, self.config['scaling_file'])
+
+    # add a job to the queue, it starts on a later dispatch
+    def submit(self, job):
+        job.status = 'pending'
+        job.cores = None
+        self.queue.append(job)
+
+    # remove a job that has not started yet
+    def remove(self, job):
+        if job in self.queue:
+            self.queue.remove(job)
+
+    def dispatch(self, start):
+        """
+        Releases the cores of finished runs and starts queued runs that fit
+
+        Args:
+            start: Called with a job to launch it once its ranks and cores are set
+        """
+        finished = [job for job in self.running if job.process is None or job.process.poll() is not None]
+        for job in finished:
+            self.running.remove(job)
+            self.record(job)
+        if not finished and not self.queue:
+            return
+        waiting = max(len(self.queue), 1)
+        threads = self.config['threads_per_rank']
+        with SharedClaims(self.config['state_file']) as claims:
+            running = [self.claim_key(job) for job in self.running]
+            claims['jobs'] = {key: value for key, value in claims['jobs'].items() if value['pid'] != os.getpid() or key in running}
+            used = set(core for value in claims['jobs'].values() for core in value['cores'])
+            free = [core for core in self.cores if core not in used]
+            reserved = sum(value['memory'] for value in claims['jobs'].values())
+            # fair shares (in ranks) of the free cores, or of the node while all of them are taken
+            base, extra = divmod((len(free) if len(free) >= threads else len(self.cores)) // threads, waiting)
+            shares = [base + 1 if i < extra else base for i in range(len(self.queue))]
+            # first come first served, a run that does not fit holds back the ones behind it
+            for share in shares:
+                job = self.queue[0]
+                ranks = self.choose_ranks(job, max(share, 1))
+                # runs larger than the node get the whole node
+                needed = min(ranks * threads, len(self.cores))
+                memory = 0 if self.memory is None else self.config['memory_per_rank'] * ranks
+                # without a memory limit of its own this process ignores the claims of others
+                if needed > len(free) or (self.memory is not None and reserved > 0 and reserved + memory > self.memory):
+                    break
+                self.queue.pop(0)
+                job.cores = free[:needed]
+                free = free[needed:]
+                reserved += memory
+                job.ranks = max(1, needed // threads)
+                job.start_time = time.time()
+                start(job)
+                self.running.append(job)
+                claims['jobs'][self.claim_key(job)] = {'pid': os.getpid(), 'cores': job.cores, 'memory': memory}
+
+    def claim_key(self, job):
+        return f'{os.getpid()}:{job.folder}/{job.input_file}'
+
+    # ranks of a queued job: the ranks it asked for, or with auto_ranks the fewest ranks of its fair
+    # share whose expected time per iteration is about that of the whole share
+    def choose_ranks(self, job, share):
+        threads = self.config['threads_per_rank']
+        ranks = job.ranks
+        if self.config['auto_ranks']:
+            ranks = share
+            coefficients = fit_scaling(self.scaling.get(system_key(os.path.join(job.folder, job.input_file)), {}))
+            if coefficients is not None:
+                a, b = coefficients
+                expected = [a + b / (r * threads) for r in range(1, share + 1)]
+                ranks = next(r for r in range(1, share + 1) if expected[r - 1] <= (1 + self.config['scaling_tolerance']) * expected[-1])
+        if self.config['max_ranks'] is not None:
+            ranks = min(ranks, self.config['max_ranks'])
+        return max(1, min(ranks, len(self.cores) // threads))
+
+    # time per electronic iteration of a finished run, by system and core count
+    def record(self, job):
+        if job.process is None or job.process.returncode != 0 or job.cores is None:
+            return
+        out_path = os.path.join(job.folder, job.output_file)
+        if not os.path.exists(out_path):
+            return
+        iterations = ot.summarize_file(out_path)['elec_iterations']
+        if iterations == 0:
+            return
+        key = system_key(os.path.join(job.folder, job.input_file))
+        measurements = self.scaling.setdefault(key, {})
+        seconds, count = measurements.get(str(len(job.cores)), [0.0, 0])
+        measurements[str(len(job.cores))] = [seconds + time.time() - job.start_time, count + iterations]
+        self.save_scaling()
+
+class SharedClaims:
+    """
+    Claims of cores and memory, locked and kept in a json file when several processes pack one node
+
+    Args:
+        state_file: Path to the shared file, None keeps the claims in this process
+    """
+    local = {'jobs': {}}
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.file = None
+        self.claims = None
+
+    def __enter__(self):
+        if self.state_file is None:
+            self.claims = SharedClaims.local
+            return self.claims
+        self.file = open(self.state_file, 'a+')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.file.seek(0)
+        try:
+            self.claims = json.loads(self.file.read() or '{}')
+        except ValueError:
+            self.claims = {}
+        self.claims.setdefault('jobs', {})
+        # claims of processes that ended without releasing them
+        self.claims['jobs'] = {key: value for key, value in self.claims['jobs'].items() if pid_alive(value['pid'])}
+        return self.claims
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
+            json.dump(self.claims, self.file)
+            self.file.flush()
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+        return False
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# launcher of a packed run: mpirun with its ranks pinned to cores, or the whole run pinned with taskset
+def launcher(mpirun, ranks, cores, bind):
+    if bind == 'mpirun' and mpirun:
+        # the cpu set replaces whatever binding the configured launcher asks for
+        mpirun = re.sub(r'--bind-to\s+\S+', '', mpirun).strip()
+        return f'{mpirun} -n {ranks} --cpu-set {core_list(cores)} --bind-to core '
+    prefix = f'taskset -c {core_list(cores)} ' if bind == 'taskset' else ''
+    return prefix + (f'{mpirun} -n {ranks} ' if mpirun else '')
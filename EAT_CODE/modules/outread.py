@@ -0,0 +1,286 @@
+###############################################################################
+# Streaming parser of JDFTx logs (.out files and the slurm outputs holding them)
+###############################################################################
+# parse() yields one typed record per line of interest and keeps nothing else in memory, follow()
+# does the same for a log that is still being written, and parse_archive() summarizes every log of
+# an archive with a pool of processes.
+#   python3 -m modules.outread ../DFT/Relax_Mag/rel1+1_6/O/runs/calc_/run.out
+#   python3 -m modules.outread --follow runs/calc_.../O/O.out
+#   python3 -m modules.outread --archive ../DFT
+
+# imports
+import os
+import re
+import sys
+import time
+import argparse
+import collections
+import multiprocessing
+
+# records
+Start = collections.namedtuple('Start', ['version'])
+Iteration = collections.namedtuple('Iteration', ['minimizer', 'iteration', 'F', 'grad_K', 'alpha', 'linmin', 't'])
+Converged = collections.namedtuple('Converged', ['minimizer', 'converged', 'text'])
+StepEvent = collections.namedtuple('StepEvent', ['minimizer', 'kind', 'text'])
+Fillings = collections.namedtuple('Fillings', ['mu', 'n_electrons', 'magnetic_abs', 'magnetic_tot'])
+Lowdin = collections.namedtuple('Lowdin', ['species', 'oxidation', 'magnetic'])
+Dump = collections.namedtuple('Dump', ['name'])
+Duration = collections.namedtuple('Duration', ['seconds'])
+Done = collections.namedtuple('Done', [])
+Error = collections.namedtuple('Error', ['text'])
+
+# minimizers whose 'Name: Iter:' lines are parsed
+minimizers = ['ElecMinimize', 'IonicMinimize', 'LCAOMinimize', 'LatticeMinimize']
+
+# line search trouble reported by a minimizer between iterations, as StepEvent kinds
+step_events = {'Step increased F': 'increased', 'Step failed': 'failed', 'Undoing step': 'undone', 'Bad step direction': 'bad_direction'}
+
+duration_pattern = re.compile(r'Duration: (\d+)-(\d+):(\d+):([\d.]+)')
+
+# markers of failed runs: JDFTx stack traces, MPI and Slurm, and Python tracebacks in slurm outputs
+error_markers = ['Error', 'MPI_ABORT', 'slurmstepd: error', 'Killed', 'Stack trace', 'Bus error', 'Segmentation fault', 'CANCELLED', 'DUE TO TIME LIMIT', 'oom-kill', 'Out Of Memory']
+error_pattern = re.compile('|'.join(re.escape(marker) for marker in error_markers))
+
+# 'Name: Iter: i F: f |grad|_K: g alpha: a linmin: l t[s]: t', where alpha, linmin and t[s] may be missing
+def parse_iteration(minimizer, parts):
+    values = dict(zip(parts[1::2], parts[2::2]))
+    def value(key):
+        return float(values[key]) if key in values else None
+    return Iteration(minimizer, int(values['Iter:']), float(values['F:']), value('|grad|_K:'), value('alpha:'), value('linmin:'), value('t[s]:'))
+
+# '\tFillingsUpdate:  mu: m  nElectrons: n  magneticMoment: [ Abs: a  Tot: t ]'
+def parse_fillings(parts):
+    magnetic = parts[8:11:2] if len(parts) > 10 and parts[7] == 'Abs:' else [None, None]
+    return Fillings(float(parts[2]), float(parts[4]), *[None if value is None else float(value) for value in magnetic])
+
+# record of one line, or None. The first character picks the few checks a line needs, as logs are
+# mostly iteration, fillings, subspace rotation and force lines
+def parse_line(line):
+    first = line[:1]
+    if first == '#' or first == '\n':
+        return None
+    if first == '\t':
+        if line.startswith('\tFillingsUpdate:'):
+            try:
+                return parse_fillings(line.split())
+            except (ValueError, IndexError):
+                return None
+        if line.startswith('\tSubspaceRotation'):
+            return None
+    elif first in 'EILR' and 'Minimize:' in line[:20]:
+        parts = line.split()
+        minimizer = parts[0][:-1]
+        if minimizer not in minimizers:
+            return None
+        if len(parts) > 1 and parts[1] == 'Iter:':
+            try:
+                return parse_iteration(minimizer, parts)
+            except (ValueError, KeyError):
+                return None
+        for text, kind in step_events.items():
+            if text in line:
+                return StepEvent(minimizer, kind, line.strip())
+        if 'Converged' in line:
+            return Converged(minimizer, True, line.strip())
+        if 'None of the convergence criteria satisfied' in line:
+            return Converged(minimizer, False, line.strip())
+        return None
+    elif first == 'D':
+        if line.startswith('Dumping '):
+            return Dump(line.split("'")[1] if "'" in line else line.split()[1])
+        if line.startswith('Done!'):
+            return Done()
+    elif first == '*' and line.startswith('*************** JDFTx'):
+        return Start(line.strip('* \n'))
+    elif first == 'f' and line.startswith('force '):
+        return None
+    if 'Duration:' in line:
+        match = duration_pattern.search(line)
+        if match is not None:
+            days, hours, minutes, seconds = match.groups()
+            return Duration(((int(days) * 24 + int(hours)) * 60 + int(minutes)) * 60 + float(seconds))
+    if error_pattern.search(line):
+        return Error(line.strip())
+    return None
+
+def parse_lines(lines):
+    """
+    Turns lines of a JDFTx log into records
+
+    Args:
+        lines: Iterable of lines
+
+    Yields:
+        Start, Iteration, StepEvent, Converged, Fillings, Lowdin, Dump, Duration, Done and Error records in the
+        order of the log. A Lowdin record pairs the oxidation states of a species with the magnetic
+        moments of the next line (None in runs without spin)
+    """
+    pending = None
+    for line in lines:
+        if line.startswith('# magnetic-moments') and pending is not None:
+            parts = line.split()
+            if parts[2] == pending[0]:
+                yield Lowdin(pending[0], pending[1], tuple(float(value) for value in parts[3:]))
+                pending = None
+                continue
+        if pending is not None:
+            yield Lowdin(pending[0], pending[1], None)
+            pending = None
+        if line.startswith('# oxidation-state'):
+            parts = line.split()
+            pending = (parts[2], tuple(float(value) for value in parts[3:]))
+            continue
+        record = parse_line(line)
+        if record is not None:
+            yield record
+    if pending is not None:
+        yield Lowdin(pending[0], pending[1], None)
+
+# records of a log file
+def parse(file_name):
+    with open(file_name, 'r', errors='replace') as file:
+        yield from parse_lines(file)
+
+# lines of a file that is still being written, waiting for complete lines
+def follow_lines(file_name, poll_interval=1.0, timeout=None, stop=None):
+    while not os.path.exists(file_name):
+        if stop is not None and stop():
+            return
+        time.sleep(poll_interval)
+    with open(file_name, 'r', errors='replace') as file:
+        buffer = ''
+        last_growth = time.time()
+        while True:
+            line = file.readline()
+            if line:
+                last_growth = time.time()
+                buffer += line
+                if buffer.endswith('\n'):
+                    yield buffer
+                    buffer = ''
+                continue
+            if stop is not None and stop():
+                return
+            if timeout is not None and time.time() - last_growth > timeout:
+                return
+            time.sleep(poll_interval)
+
+def follow(file_name, poll_interval=1.0, timeout=None, stop=None):
+    """
+    Records of a log that is still being written, as they appear
+
+    Args:
+        file_name: Path to the log, which may not exist yet
+        poll_interval: Seconds between reads at the end of the file
+        timeout: Stop after this many seconds without new lines, None waits forever
+        stop: Called while waiting, the generator ends when it returns True (e.g. the job finished)
+
+    Yields:
+        Records as in parse_lines, until Done
+    """
+    for record in parse_lines(follow_lines(file_name, poll_interval, timeout, stop)):
+        yield record
+        if isinstance(record, Done):
+            return
+
+def summarize(records):
+    """
+    Summary of the records of one log
+
+    Args:
+        records: Iterable of records
+
+    Returns:
+        res: Dict with the number of electronic and ionic iterations, the last free energy F, the
+            duration (s), whether it finished, the last error line and the Lowdin moments of the last
+            analysis as a list of (species, ion, oxidation, magnetic)
+    """
+    res = {'elec_iterations': 0, 'ionic_iterations': 0, 'F': None, 'duration_s': None, 'finished': False, 'error': None, 'moments': []}
+    lowdin = []
+    lowdin_closed = False
+    for record in records:
+        if isinstance(record, Iteration):
+            if record.minimizer == 'ElecMinimize':
+                res['elec_iterations'] += 1
+            elif record.minimizer == 'IonicMinimize':
+                res['ionic_iterations'] += 1
+            if record.minimizer != 'LCAOMinimize':
+                res['F'] = record.F
+        if isinstance(record, Lowdin):
+            # consecutive Lowdin records form one analysis, a new one replaces the last
+            if lowdin_closed:
+                lowdin = []
+                lowdin_closed = False
+            lowdin.append(record)
+        else:
+            lowdin_closed = bool(lowdin)
+        if isinstance(record, Duration):
+            res['duration_s'] = record.seconds
+        elif isinstance(record, Done):
+            res['finished'] = True
+        elif isinstance(record, Error):
+            res['error'] = record.text
+    for record in lowdin:
+        for i, oxidation in enumerate(record.oxidation):
+            magnetic = record.magnetic[i] if record.magnetic is not None and i < len(record.magnetic) else None
+            res['moments'].append((record.species, i + 1, oxidation, magnetic))
+    return res
+
+# summary of one log file
+def summarize_file(file_name):
+    return summarize(parse(file_name))
+
+# JDFTx logs below root
+def find_logs(root):
+    res = []
+    for folder, folders, files in os.walk(root):
+        folders.sort()
+        for name in sorted(files):
+            if name.endswith('.out') or name.startswith('slurm_out.o'):
+                res.append(os.path.join(folder, name))
+    return res
+
+def summarize_files(file_names, processes=None):
+    """
+    Summaries of many logs, with a pool of processes
+
+    Args:
+        file_names: Paths to the logs
+        processes: Number of processes, None for all cores. 1 parses in this process
+
+    Returns:
+        res: Dict of path to summary (see summarize)
+    """
+    file_names = list(file_names)
+    if processes == 1 or len(file_names) < 2:
+        return {file_name: summarize_file(file_name) for file_name in file_names}
+    with multiprocessing.Pool(processes) as pool:
+        # the largest logs first, so that no single one is left at the end
+        ordered = sorted(file_names, key=lambda file_name: -os.path.getsize(file_name))
+        return dict(zip(ordered, pool.map(summarize_file, ordered, chunksize=1)))
+
+# summaries of all logs of an archive
+def parse_archive(root, processes=None):
+    return summarize_files(find_logs(root), processes)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Streaming parser of JDFTx logs')
+    parser.add_argument('path', help='log file, or archive folder with --archive')
+    parser.add_argument('--follow', action='store_true', help='keep reading while the log is written')
+    parser.add_argument('--archive', action='store_true', help='summarize every log below path')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+    if args.archive:
+        start_time = time.time()
+        summaries = parse_archive(args.path, args.processes)
+        for file_name, summary in sorted(summaries.items()):
+            print(f"{os.path.relpath(file_name, args.path)}\telec {summary['elec_iterations']}\tionic {summary['ionic_iterations']}\tF {summary['F']}\t{summary['duration_s']} s\t{'done' if summary['finished'] else 'unfinished'}\t{summary['error'] or ''}")
+        print(f"{len(summaries)} logs in {time.time() - start_time:.2f} s")
+        return 0
+    records = follow(args.path) if args.follow else parse(args.path)
+    for record in records:
+        print(record, flush=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
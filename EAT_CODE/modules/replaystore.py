@@ -0,0 +1,168 @@
+###############################################################################
+# Store of recorded DFT results for replaying an optimization without JDFTx
+###############################################################################
+# The archived runs record the weights and the binding energy of every accepted iteration in
+# min_progress.txt, but no gradients. A query is answered from its nearest recorded points: the
+# binding energy of the nearest one ('nearest') or of a weighted local linear fit ('linear'), and the
+# gradient of that fit. The 'replay' backend of jbbackend.py writes the outputs of these answers.
+
+# imports
+import os
+import time
+import numpy as np
+import modules.histread as hr
+import modules.fakejdftx as fk
+
+# default settings of the replay backend
+default_replay_config = {
+    'runs': [], # run folders with a min_progress.txt, or folders to search for them (e.g. '../DFT/noRelax_noMag')
+    'mode': 'linear', # 'linear' (local linear fit) or 'nearest' (energy of the nearest recorded point)
+    'neighbours': 24, # recorded points in the local fit
+    'ridge': 0.1, # ridge penalty of the fitted gradient
+}
+
+# E_O - E_OH of main.binding for a binding energy of 0
+binding_reference = 1/2 * 1.1781008671071755 + 0.36/27.2114
+
+class ReplayStore:
+    """
+    Binding energies of recorded weights, with lookup and local interpolation
+
+    Args:
+        weights: (M, N, S) recorded weights
+        binding: (M,) binding energies (eV)
+        elements: Element of every column of the weights
+        sources: (folder, iteration) of every point
+    """
+    def __init__(self, weights, binding, elements, sources=None):
+        self.weights = np.asarray(weights, dtype=float)
+        self.binding = np.asarray(binding, dtype=float)
+        self.elements = list(elements)
+        self.sources = sources if sources is not None else [None] * len(self.binding)
+        self.flat = self.weights.reshape(len(self.binding), -1)
+
+    def __len__(self):
+        return len(self.binding)
+
+    # weights of a query (N, S) with columns of elements, in the column order of the store
+    def align(self, w, elements):
+        if sorted(elements) != sorted(self.elements):
+            raise ValueError(f'Replay store has elements {self.elements}, the run uses {list(elements)}')
+        if w.shape != self.weights.shape[1:]:
+            raise ValueError(f'Replay store has {self.weights.shape[1]} sites, the run has {w.shape[0]}')
+        return w[:, [list(elements).index(element) for element in self.elements]]
+
+    def query(self, w, elements, mode='linear', neighbours=24, ridge=0.1):
+        """
+        Binding energy and its gradient at w
+
+        Args:
+            w: (N, S) weights
+            elements: Element of every column of w
+            mode: 'nearest' (recorded energy of the nearest point) or 'linear' (local linear fit)
+            neighbours: Number of nearest points in the fit
+            ridge: Ridge penalty of the fitted gradient
+
+        Returns:
+            binding: Binding energy (eV)
+            grad: (N, S) gradient (eV per unit weight), columns as in elements
+            distance: Distance to the nearest recorded point
+            source: (folder, iteration) of the nearest recorded point
+        """
+        if mode not in ['nearest', 'linear']:
+            raise ValueError(f"Unknown replay mode '{mode}', expected 'nearest' or 'linear'")
+        x = self.align(np.asarray(w, dtype=float), elements).flatten()
+        distances = np.linalg.norm(self.flat - x, axis=1)
+        order = np.argsort(distances)[:neighbours]
+        nearest = order[0]
+        # weighted fit b_i = b + g . (x_i - x) around the query, the kernel width is the distance of the
+        # farthest neighbour. Weights are on the simplex, so g is only determined along it
+        width = max(distances[order[-1]], 1e-12)
+        kernel = np.exp(-(distances[order] / width)**2)
+        X = np.hstack([np.ones((len(order), 1)), self.flat[order] - x]) * np.sqrt(kernel)[:, None]
+        b = self.binding[order] * np.sqrt(kernel)
+        penalty = np.sqrt(ridge) * np.eye(X.shape[1])[1:]
+        coef = np.linalg.lstsq(np.vstack([X, penalty]), np.concatenate([b, np.zeros(X.shape[1] - 1)]), rcond=None)[0]
+        binding = coef[0] if mode == 'linear' else self.binding[nearest]
+        grad_store = coef[1:].reshape(self.weights.shape[1:])
+        grad = grad_store[:, [self.elements.index(element) for element in elements]]
+        return binding, grad, distances[nearest], self.sources[nearest]
+
+# run folders given directly or found below the given folders
+def replay_folders(paths):
+    res = []
+    for path in paths:
+        if os.path.exists(os.path.join(path, 'min_progress.txt')):
+            res.append(path)
+        else:
+            res += hr.find_histories(path)
+    return res
+
+def load_store(paths):
+    """
+    Builds a store from archived runs
+
+    Args:
+        paths: Run folders with a min_progress.txt, or folders to search for them
+
+    Returns:
+        res: ReplayStore of all recorded iterations with the same elements and number of sites as the first run
+    """
+    weights = []
+    binding = []
+    sources = []
+    elements = None
+    for folder in replay_folders(paths):
+        progress = hr.read_progress(os.path.join(folder, 'min_progress.txt'))
+        for iteration in progress['iterations']:
+            if iteration['binding'] is None or iteration['weights'] is None:
+                continue
+            if elements is None:
+                elements = progress['elements']
+                shape = iteration['weights'].shape
+            if progress['elements'] != elements or iteration['weights'].shape != shape:
+                continue
+            weights.append(iteration['weights'])
+            binding.append(iteration['binding'])
+            sources.append((folder, iteration['iteration']))
+    if not weights:
+        raise ValueError(f'No recorded iterations found in {list(paths)}')
+    return ReplayStore(np.array(weights), np.array(binding), elements, sources)
+
+def run(input_path, store, config):
+    """
+    Performs one replayed JDFTx run: writes the dumped files next to input_path from the store
+
+    Args:
+        input_path: Path to the .in file
+        store: ReplayStore
+        config: Replay settings ('mode', 'neighbours', 'ridge')
+
+    Returns:
+        log: Text written to the .out file
+        returncode: Exit code (0 on success)
+    """
+    start_time = time.time()
+    inputs = fk.parse_input(input_path)
+    folder = os.path.dirname(os.path.abspath(input_path))
+    prefix = os.path.splitext(os.path.basename(input_path))[0]
+    name = inputs['dump_name'].replace('.$VAR', '') if inputs['dump_name'] else prefix
+    adsorbate = 'OH' if 'OH' in name else 'O'
+    labels, elements, w = fk.site_matrix(inputs)
+    binding, grad, distance, source = store.query(w, elements, config['mode'], config['neighbours'], config['ridge'])
+    # the whole binding energy goes to the O run, so that E_O - E_OH and grad_O - grad_OH are the replayed ones
+    energy = -2700.0
+    grad_h = np.zeros(w.shape)
+    if adsorbate == 'O':
+        energy += binding / 27.2114 + binding_reference
+        grad_h = grad / 27.2114
+    fk.write_outputs(folder, name, inputs, labels, elements, w, energy, grad_h, fk.default_fake_config)
+    log = [f"*************** JDFTx 1.7.0 (replay)  ***************\n\n", f"Start date and time: {time.ctime(start_time)}\n"]
+    log.append(f"Replayed from {source[0]} iteration {source[1]} at distance {distance:.3e} ({config['mode']})\n")
+    log.append(f"ElecMinimize: Iter:   0  F: {energy:.15f}  |grad|_K:  1.000e-09  alpha:  1.000e+00  linmin:  0.000e+00  t[s]:       0.00\n")
+    log.append(f"ElecMinimize: Converged (|Delta F|<{inputs['elec_threshold']:e} for 5 iters).\n")
+    for extension in ['ionpos', 'lattice', 'mixgrad', 'Ecomponents'] + (['wfns'] if 'State' in inputs['dumps'] else []):
+        log.append(f"Dumping '{name}.{extension}' ... done\n")
+    elapsed = time.time() - start_time
+    log.append(f"End date and time: {time.ctime()}  (Duration: 0-{int(elapsed // 3600)}:{int(elapsed % 3600 // 60):02d}:{elapsed % 60:05.2f})\nDone!\n")
+    return ''.join(log), 0
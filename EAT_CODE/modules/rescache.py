@@ -0,0 +1,102 @@
+###############################################################################
+# Persistent cache of JDFTx results keyed by the rendered input file
+###############################################################################
+
+# imports
+import os
+import json
+import shutil
+import hashlib
+import modules.entrystore as es
+
+# output files that are stored for every run
+cached_extensions = ['Ecomponents', 'mixgrad', 'ionpos', 'lattice']
+
+# identity of the JDFTx binary: its path plus size and modification time, so a rebuilt binary
+# does not reuse results from the old build. Every existing file in the command counts, so a
+# wrapper such as 'python3 fakejdftx.py --config fake.json' is identified by all of its parts
+def binary_identity(config):
+    if config['backend'] == 'fake':
+        return 'fake:' + json.dumps(config.get('fake', {}), sort_keys=True)
+    if config['backend'] == 'replay':
+        return 'replay:' + json.dumps(config.get('replay', {}), sort_keys=True)
+    res = []
+    for part in config['jdftx'].split():
+        if os.path.isfile(part):
+            stat = os.stat(part)
+            res.append(f'{part}:{stat.st_size}:{int(stat.st_mtime)}')
+        else:
+            res.append(part)
+    return ' '.join(res)
+
+class ResultCache(es.EntryStore):
+    """
+    Content-addressed store of JDFTx outputs
+
+    Args:
+        cache_dir: Folder holding the cache. Keep it outside runs/ so that it survives delete_progress
+        max_bytes: Size bound, least recently used entries are evicted beyond it
+        identity: Identity of the JDFTx binary, part of every key
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3, identity=''):
+        super().__init__(cache_dir, max_bytes, label='Result cache')
+        self.cache_dir = self.root
+        self.identity = identity
+        self.hits = 0
+        self.misses = 0
+
+    # hash of the input file contents and the binary identity
+    def key(self, input_path):
+        with open(input_path, 'rb') as file:
+            contents = file.read()
+        digest = hashlib.sha256()
+        digest.update(self.identity.encode())
+        digest.update(b'\0')
+        digest.update(contents)
+        return digest.hexdigest()
+
+    # copy the cached outputs into the run folder. Returns True on a hit
+    def fetch(self, input_path):
+        key = self.key(input_path)
+        if not self.has(key):
+            self.misses += 1
+            self.record('misses')
+            return False
+        entry = self.entry_path(key)
+        folder = os.path.dirname(os.path.abspath(input_path))
+        prefix = os.path.splitext(os.path.basename(input_path))[0]
+        for extension in cached_extensions:
+            file_path = os.path.join(entry, f'output.{extension}')
+            if os.path.exists(file_path):
+                shutil.copy(file_path, os.path.join(folder, f'{prefix}.{extension}'))
+        self.touch(entry)
+        self.hits += 1
+        self.record('hits')
+        print(f"Result cache hit for '{input_path}'.")
+        return True
+
+    # store the outputs of a finished run next to its input
+    def store(self, input_path):
+        key = self.key(input_path)
+        if self.has(key):
+            return
+        folder = os.path.dirname(os.path.abspath(input_path))
+        prefix = os.path.splitext(os.path.basename(input_path))[0]
+        files = {f'output.{extension}': os.path.join(folder, f'{prefix}.{extension}') for extension in cached_extensions}
+        files['input.in'] = input_path
+        self.put(key, files, {'identity': self.identity, 'source': os.path.abspath(input_path)})
+
+    # running totals across sessions
+    def record(self, counter):
+        totals = self.totals({'hits': 0, 'misses': 0})
+        totals[counter] += 1
+        self.save_totals(totals)
+
+    def stats(self):
+        totals = self.totals({'hits': 0, 'misses': 0})
+        return dict({
+            'hits': self.hits,
+            'misses': self.misses,
+            'total_hits': totals['hits'],
+            'total_misses': totals['misses'],
+        }, **self.usage())
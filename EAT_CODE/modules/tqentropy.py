@@ -1,51 +1,137 @@
 ###########################################################################
-# Tsallis q entropy and its gradient
+# Tsallis q entropy, its gradient and Hessian
 ###########################################################################
+# All functions take one design as a flat vector (N*S,) or shaped (N, S), a batch of flat designs
+# (batch, N*S) or weights shaped (..., N, S) with at least one batch axis, and work on every site and
+# design at once. A 2-D w whose last axis is S is one design, so a batch of single-site designs has to
+# be shaped (batch, 1, S). Values have the batch shape, derivatives the shape of w.
 import numpy as np
 
+# weights are clamped to this floor where a derivative diverges at w = 0 (log w for q = 1, w^(q-1)
+# for q < 1 and w^(q-2) for q < 2). Values are exact at w = 0
+w_floor = 1e-12
+
+# q closer to 1 than this is treated as Shannon entropy
+q_shannon = 1e-12
+
+# weights as (..., N, S)
+def site_view(w, S):
+    w = np.asarray(w, dtype=float)
+    if w.ndim == 2 and w.shape[-1] == S:
+        return w
+    if w.ndim <= 2:
+        return w.reshape(w.shape[:-1] + (-1, S))
+    return w
+
 def Tsallis(w, S, q):
     """
     Computes the Tsallis q-Entropy
 
     Args:
-        w: Probabilities (vectorized)
+        w: Probabilities (vectorized), a batch of them or shaped (..., N, S)
         S: Number of species
         q: q-factor for Entropy (q=1 is Shannon Entropy)
 
     Returns:
-        res: The entropy
+        res: The entropy (a float for one design, else one per design)
     """
-    w_full = w.reshape(-1, S)
-    N = w_full.shape[0]
-    w_full = w.reshape(N, -1)
-    res = 0
-    for i in range(N):
-        if q==1:
-            res += -np.sum(w_full[i, :] * np.log(w_full[i, :]+1e-10))
-        else: 
-            res += 1/(q-1) * (1-np.sum(w_full[i, :]**q))
-
-    return res
+    w_full = site_view(w, S)
+    if abs(q - 1) < q_shannon:
+        # w log w -> 0 as w -> 0
+        positive = w_full > 0
+        terms = np.where(positive, w_full * np.log(np.where(positive, w_full, 1)), 0)
+        res = -np.sum(terms, axis=(-2, -1))
+    else:
+        res = (w_full.shape[-2] - np.sum(np.maximum(w_full, 0)**q, axis=(-2, -1))) / (q - 1)
+    return res[()] if np.ndim(res) == 0 else res
 
 def grad_Tsallis(w, S, q):
     """
     Computes the gradient of the Tsallis q-Entropy
 
     Args:
-        w: Probabilities (vectorized)
+        w: Probabilities (vectorized), a batch of them or shaped (..., N, S)
+        S: Number of species
+        q: q-factor for Entropy (q=1 is Shannon Entropy)
+
+    Returns:
+        res: Gradient of the entropy, shaped like w
+    """
+    w = np.asarray(w, dtype=float)
+    w_full = site_view(w, S)
+    if abs(q - 1) < q_shannon:
+        grad_full = -(np.log(np.maximum(w_full, w_floor)) + 1)
+    elif q < 2:
+        grad_full = -q/(q-1) * np.maximum(w_full, w_floor)**(q-1)
+    else:
+        grad_full = -q/(q-1) * np.maximum(w_full, 0)**(q-1)
+    return grad_full.reshape(w.shape)
+
+def hess_Tsallis(w, S, q):
+    """
+    Computes the Hessian of the Tsallis q-Entropy, which is diagonal
+
+    Args:
+        w: Probabilities (vectorized), a batch of them or shaped (..., N, S)
+        S: Number of species
+        q: q-factor for Entropy (q=1 is Shannon Entropy)
+
+    Returns:
+        res: Diagonal of the Hessian of the entropy, shaped like w
+    """
+    w = np.asarray(w, dtype=float)
+    w_full = site_view(w, S)
+    if abs(q - 1) < q_shannon:
+        hess_full = -1/np.maximum(w_full, w_floor)
+    elif q < 2:
+        hess_full = -q * np.maximum(w_full, w_floor)**(q-2)
+    else:
+        hess_full = -q * np.maximum(w_full, 0)**(q-2)
+    return hess_full.reshape(w.shape)
+
+def hessvec_Tsallis(w, v, S, q):
+    """
+    Computes the product of the Hessian of the Tsallis q-Entropy with v
+
+    Args:
+        w: Probabilities (vectorized), a batch of them or shaped (..., N, S)
+        v: Vectors shaped like w
         S: Number of species
         q: q-factor for Entropy (q=1 is Shannon Entropy)
 
     Returns:
-        res: Gradient of the entropy
-    """
-    w_full = w.reshape(-1, S)
-    N = w_full.shape[0]
-    grad_full = np.zeros(w_full.shape)
-    for i in range(N):
-        if q==1:
-            grad_full[i, :] = -(np.log(w_full[i, :] + 1e-10) + 1)
-        else: 
-            grad_full[i, :] = -q/(q-1) * w_full[i, :]**(q-1)
-    res = grad_full.flatten()
-    return res
\ No newline at end of file
+        res: Hessian-vector products, shaped like w
+    """
+    return hess_Tsallis(w, S, q) * v
+
+def derivatives_Tsallis(w, S, q):
+    """
+    Computes the Tsallis q-Entropy with its gradient and Hessian diagonal, sharing the powers of w
+
+    Args:
+        w: Probabilities (vectorized), a batch of them or shaped (..., N, S)
+        S: Number of species
+        q: q-factor for Entropy (q=1 is Shannon Entropy)
+
+    Returns:
+        res: The entropy
+        grad: Gradient of the entropy, shaped like w
+        hess: Diagonal of the Hessian of the entropy, shaped like w
+    """
+    w = np.asarray(w, dtype=float)
+    w_full = site_view(w, S)
+    if abs(q - 1) < q_shannon:
+        w_safe = np.maximum(w_full, w_floor)
+        log_w = np.log(w_safe)
+        res = -np.sum(np.where(w_full > 0, w_full * log_w, 0), axis=(-2, -1))
+        grad_full = -(log_w + 1)
+        hess_full = -1/w_safe
+    else:
+        w_safe = np.maximum(w_full, w_floor if q < 2 else 0)
+        w_qm2 = w_safe**(q-2)
+        w_qm1 = w_qm2 * w_safe
+        res = (w_full.shape[-2] - np.sum(w_qm1 * np.maximum(w_full, 0), axis=(-2, -1))) / (q - 1)
+        grad_full = -q/(q-1) * w_qm1
+        hess_full = -q * w_qm2
+    res = res[()] if np.ndim(res) == 0 else res
+    return res, grad_full.reshape(w.shape), hess_full.reshape(w.shape)
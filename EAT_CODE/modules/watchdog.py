@@ -0,0 +1,250 @@
+###############################################################################
+# Watchdog that stops JDFTx runs whose minimization diverges or stalls
+###############################################################################
+# Tails the .out of every running job and classifies its progress from the F and |grad|_K of the
+# electronic and ionic iterations. A run that diverges or stalls is killed, then resubmitted with
+# the input changes of the policy or given up so the optimizer can reject the trial. The policy is
+# the 'watchdog' entry of jdftx_config, so every campaign (run folder) can set its own.
+#   python3 -m modules.watchdog ../DFT        # verdicts the policy would have given the archived logs
+
+# imports
+import os
+import sys
+import time
+import argparse
+import modules.outread as ot
+
+# default policy, entries of jdftx_config['watchdog'] override it
+default_policy = {
+    'enabled': False, # watch running jobs (local and slurm backends)
+    'poll_interval': None, # seconds between reads of the logs, None uses the poll_interval of the backend
+    'window': 20, # electronic iterations looked back at for divergence
+    'max_step_events': 16, # failed or F-increasing line search steps in the window that mean divergence
+    'max_rises': 12, # electronic iterations in the window whose F rose above the previous one
+    'max_elec_iterations': 750, # electronic iterations of one minimization after which a run counts as stalled
+    'ionic_window': 20, # ionic iterations over which F has to fall by ionic_min_decrease (Hartree)
+    'ionic_min_decrease': 1e-5,
+    'max_ionic_iterations': 300, # ionic iterations after which a run counts as stalled
+    'on_diverging': 'resubmit', # 'resubmit', 'fail' (reject the trial) or 'ignore'
+    'on_stalled': 'fail',
+    'resubmit_inputs': [{}], # input changes of every resubmission in turn, e.g. [{'elec-smearing': 'Fermi 0.003'}], None removes a command
+    'from_scratch': True, # resubmissions start from atomic orbitals instead of the initial state the stopped run was given
+}
+
+class LogTail:
+    """
+    Reads the complete lines a log gained since the last read, without blocking
+
+    Args:
+        file_name: Path to the log, which may not exist yet
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.offset = 0
+        self.buffer = ''
+
+    def lines(self):
+        if not os.path.exists(self.file_name):
+            return []
+        with open(self.file_name, 'r', errors='replace') as file:
+            file.seek(self.offset)
+            text = file.read()
+            self.offset = file.tell()
+        text = self.buffer + text
+        lines = text.split('\n')
+        self.buffer = lines.pop()
+        return [line + '\n' for line in lines]
+
+class RunMonitor:
+    """
+    Classifies the progress of one run from its log records
+
+    Args:
+        policy: Watchdog policy (see default_policy)
+
+    Attributes:
+        verdict: None while the run progresses, 'diverging' or 'stalled' once it does not
+        reason: Why the verdict was given
+        t: Time stamp (s into the run) of the last iteration seen
+    """
+    def __init__(self, policy):
+        self.policy = dict(default_policy, **policy)
+        # (F, |grad|_K) of the current electronic minimization and the iterations its step events came after
+        self.elec = []
+        self.events = []
+        self.ionic = []
+        self.verdict = None
+        self.reason = None
+        self.t = None
+
+    def feed_line(self, line):
+        record = ot.parse_line(line)
+        if record is not None:
+            self.feed(record)
+
+    def feed(self, record):
+        if isinstance(record, ot.Iteration):
+            if record.t is not None:
+                self.t = record.t
+            if record.minimizer == 'ElecMinimize':
+                self.elec.append((record.F, record.grad_K))
+            elif record.minimizer == 'IonicMinimize':
+                self.ionic.append(record.F)
+                self.elec = []
+                self.events = []
+        elif isinstance(record, ot.StepEvent) and record.minimizer == 'ElecMinimize' and record.kind in ['increased', 'failed']:
+            self.events.append(len(self.elec))
+        elif isinstance(record, ot.Converged) and record.minimizer == 'ElecMinimize':
+            self.elec = []
+            self.events = []
+        if self.verdict is None:
+            self.verdict, self.reason = self.classify()
+
+    # verdict and reason for the iterations seen so far
+    def classify(self):
+        policy = self.policy
+        window = policy['window']
+        recent = self.elec[-window:]
+        if recent and not all(abs(F) < float('inf') for F, _ in recent):
+            return 'diverging', 'F is not finite'
+        if len(self.elec) >= window:
+            events = sum(1 for i in self.events if i > len(self.elec) - window)
+            if events >= policy['max_step_events']:
+                return 'diverging', f'{events} failed or F-increasing steps in the last {window} electronic iterations'
+            rises = sum(1 for (F_old, _), (F_new, _) in zip(recent[:-1], recent[1:]) if F_new > F_old)
+            if rises >= policy['max_rises']:
+                return 'diverging', f'F rose in {rises} of the last {window} electronic iterations'
+        # |grad|_K and the F change of converging minimizations can plateau for hundreds of iterations,
+        # so only the length of one tells a stall apart
+        if len(self.elec) >= policy['max_elec_iterations']:
+            return 'stalled', f'{len(self.elec)} electronic iterations without convergence'
+        k = policy['ionic_window']
+        if len(self.ionic) > k and self.ionic[-k-1] - self.ionic[-1] < policy['ionic_min_decrease']:
+            return 'stalled', f'F fell by {self.ionic[-k-1] - self.ionic[-1]:.2e} Hartree in {k} ionic iterations'
+        if len(self.ionic) >= policy['max_ionic_iterations']:
+            return 'stalled', f'{len(self.ionic)} ionic iterations'
+        return None, None
+
+# replace, add (value) or remove (None) commands of a JDFTx input file
+def adjust_input(input_path, changes):
+    with open(input_path, 'r') as file:
+        lines = file.readlines()
+    res = []
+    for line in lines:
+        split_line = line.split()
+        if split_line and split_line[0] in changes:
+            continue
+        res.append(line)
+    header = [f'{command} {value}\n' for command, value in changes.items() if value is not None]
+    with open(input_path, 'w') as file:
+        file.writelines(header + res)
+
+def watch(backend, jobs, policy):
+    """
+    Follows the logs of running jobs until they end or one of them stops progressing
+
+    Args:
+        backend: Backend the jobs run on
+        jobs: Submitted jobs
+        policy: Watchdog policy
+
+    Returns:
+        res: List of (job, verdict, reason) of the jobs that were cancelled, empty once all jobs ended
+    """
+    policy = dict(default_policy, **policy)
+    poll_interval = policy['poll_interval'] if policy['poll_interval'] is not None else backend.config['poll_interval']
+    actions = {'diverging': policy['on_diverging'], 'stalled': policy['on_stalled']}
+    watched = [(job, LogTail(os.path.join(job.folder, job.output_file)), RunMonitor(policy)) for job in jobs]
+    while True:
+        running = False
+        res = []
+        for job, tail, monitor in watched:
+            status = backend.poll(job)
+            if status in ['pending', 'running']:
+                # runs queued by the node scheduler have no log yet
+                running = True
+            if status != 'running':
+                continue
+            for line in tail.lines():
+                monitor.feed_line(line)
+            if monitor.verdict is not None and actions[monitor.verdict] != 'ignore':
+                backend.cancel(job)
+                res.append((job, monitor.verdict, monitor.reason))
+        if res or not running:
+            return res
+        time.sleep(poll_interval)
+
+def supervise(backend, jobs, policy, log=print):
+    """
+    Watches jobs, resubmitting or giving up the ones that stop progressing as the policy says
+
+    Args:
+        backend: Backend the jobs run on
+        jobs: Submitted jobs
+        policy: Watchdog policy
+        log: Called with a message for every stopped run
+
+    Returns:
+        jobs: The jobs, resubmitted ones replaced by their new job
+        failures: List of (job, reason) of the runs that were given up. Returns as soon as there is
+            one, the other jobs may still be running
+    """
+    policy = dict(default_policy, **policy)
+    jobs = list(jobs)
+    failures = []
+    resubmits = {}
+    while True:
+        stopped = watch(backend, jobs, policy)
+        for job, verdict, reason in stopped:
+            input_path = os.path.join(job.folder, job.input_file)
+            count = resubmits.get(input_path, 0)
+            log(f"Watchdog stopped '{input_path}': {verdict}, {reason}.")
+            # keep the log of the stopped run next to the new one
+            output_path = os.path.join(job.folder, job.output_file)
+            if os.path.exists(output_path):
+                os.replace(output_path, f'{output_path}.stopped{count + 1}')
+            if policy[f'on_{verdict}'] != 'resubmit' or count >= len(policy['resubmit_inputs'] or []):
+                failures.append((job, f'{verdict}: {reason}'))
+                continue
+            changes = dict(policy['resubmit_inputs'][count])
+            # the state file stays in place (runs only dump it at the end), the input stops reading it
+            if policy['from_scratch']:
+                changes['initial-state'] = None
+            if changes:
+                adjust_input(input_path, changes)
+            resubmits[input_path] = count + 1
+            new_job = backend.submit(job.input_file, job.output_file, job.folder, ranks=job.ranks)
+            jobs[jobs.index(job)] = new_job
+            log(f"Watchdog resubmitted '{input_path}'" + (f' with {changes}' if changes else '') + '.')
+        if not stopped or failures:
+            return jobs, failures
+
+# verdict of a policy on a finished log: (verdict, reason, t[s] at the verdict, t[s] at the end)
+def replay_log(file_name, policy):
+    monitor = RunMonitor(policy)
+    verdict_t = None
+    for record in ot.parse(file_name):
+        monitor.feed(record)
+        if monitor.verdict is not None and verdict_t is None:
+            verdict_t = monitor.t
+    return monitor.verdict, monitor.reason, verdict_t, monitor.t
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watchdog verdicts on finished JDFTx logs')
+    parser.add_argument('root', help='log file or archive folder')
+    args = parser.parse_args(argv)
+    logs = [args.root] if os.path.isfile(args.root) else ot.find_logs(args.root)
+    saved = 0.0
+    flagged = 0
+    for file_name in logs:
+        verdict, reason, verdict_t, end_t = replay_log(file_name, {})
+        if verdict is None:
+            continue
+        flagged += 1
+        saved += (end_t or 0) - (verdict_t or 0)
+        print(f"{os.path.relpath(file_name, args.root) if file_name != args.root else file_name}\t{verdict}\tat {verdict_t} s of {end_t} s\t{reason}")
+    print(f"{flagged} of {len(logs)} logs stopped, {saved / 3600:.1f} run hours after the stops")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
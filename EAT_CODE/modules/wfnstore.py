@@ -0,0 +1,179 @@
+###############################################################################
+# Store of converged JDFTx states for starting new runs from the nearest earlier one
+###############################################################################
+# runs/wavefunctions only holds the state of the last adopted evaluation, so a line search trial
+# that backtracks starts from the rejected point that came before it. The store keeps the state of
+# every finished run, described by its weights and geometry, and copies the nearest one in as the
+# initial state of a new run. Entries are evicted least recently used beyond a disk budget.
+
+# imports
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import modules.fakejdftx as fk
+import modules.outread as ot
+import modules.entrystore as es
+
+# weights, elements and geometry of the run an input file describes
+def describe(input_path):
+    inputs = fk.parse_input(input_path)
+    labels, elements, w = fk.site_matrix(inputs)
+    name = inputs['dump_name'].replace('.$VAR', '') if inputs['dump_name'] else os.path.splitext(os.path.basename(input_path))[0]
+    # ion lines end in 'x y z moves', the lattice lines are three numbers each
+    positions = [[float(value) for value in line.split()[-4:-1]] for line in inputs['ion_lines']]
+    lattice = [float(value) for line in inputs['lattice_lines'] for value in line.split()[:3]]
+    species = [line.split()[1] for line in inputs['ion_lines']]
+    return {'name': name, 'elements': elements, 'weights': w.tolist(), 'species': species, 'positions': positions, 'lattice': lattice}
+
+# distance between two described runs, None if the state of one cannot start the other. Geometry
+# counts geometry_scale times its largest change in lattice coordinates and relative lattice change
+def distance(a, b, geometry_scale=10.0):
+    if a['name'] != b['name'] or a['elements'] != b['elements'] or a['species'] != b['species']:
+        return None
+    weights_a = np.array(a['weights'])
+    weights_b = np.array(b['weights'])
+    if weights_a.shape != weights_b.shape or len(a['lattice']) != len(b['lattice']):
+        return None
+    res = np.linalg.norm(weights_a - weights_b)
+    if a['positions']:
+        res += geometry_scale * np.max(np.abs(np.array(a['positions']) - np.array(b['positions'])))
+    if a['lattice']:
+        lattice_a = np.array(a['lattice'])
+        res += geometry_scale * np.max(np.abs(lattice_a - np.array(b['lattice']))) / max(np.max(np.abs(lattice_a)), 1e-12)
+    return res
+
+class WavefunctionStore(es.EntryStore):
+    """
+    Bounded store of converged JDFTx states, looked up by weights and geometry
+
+    Args:
+        store_dir: Folder holding the store. Keep it outside runs/ so that it survives delete_progress
+        max_bytes: Disk budget, least recently used entries are evicted beyond it
+        geometry_scale: Weight of geometry changes against weight changes in the distance
+    """
+    def __init__(self, store_dir, max_bytes=8 * 1024**3, geometry_scale=10.0):
+        super().__init__(store_dir, max_bytes, label='Wavefunction store')
+        self.store_dir = self.root
+        self.geometry_scale = geometry_scale
+        # descriptions of the entries, read once per entry
+        self.meta = {}
+        # (entry, distance) each input file was seeded from, None if the store had no match
+        self.seeds = {}
+        self.session = {'runs': 0, 'seeded': 0, 'elec_iterations_seeded': 0, 'elec_iterations_unseeded': 0, 'distance_seeded': 0.0}
+
+    # hash of the input file contents
+    def key(self, input_path):
+        with open(input_path, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    # description of an entry, None while it is incomplete
+    def entry_meta(self, entry):
+        if entry not in self.meta:
+            try:
+                with open(os.path.join(entry, 'meta.json'), 'r') as file:
+                    self.meta[entry] = json.load(file)
+            except (OSError, ValueError):
+                return None
+        return self.meta[entry]
+
+    # nearest entry to a described run as (entry, distance), (None, None) if none fits
+    def nearest(self, description):
+        res = (None, None)
+        for _, _, entry in self.entries():
+            meta = self.entry_meta(entry)
+            if meta is None:
+                continue
+            d = distance(description, meta, self.geometry_scale)
+            if d is not None and (res[1] is None or d < res[1]):
+                res = (entry, d)
+        return res
+
+    def seed(self, input_path):
+        """
+        Copies the nearest stored state in as the initial state of a run
+
+        Args:
+            input_path: Path to the written .in file, the state is copied next to it
+
+        Returns:
+            res: Distance of the copied state, None if the store had none that fits (the run keeps the
+                state it was given)
+        """
+        inputs = fk.parse_input(input_path)
+        input_path = os.path.abspath(input_path)
+        if inputs['initial_state'] is None:
+            return None
+        entry, d = self.nearest(describe(input_path))
+        self.seeds[input_path] = (entry, d)
+        if entry is None:
+            return None
+        state_path = os.path.join(os.path.dirname(input_path), inputs['initial_state'].replace('$VAR', 'wfns'))
+        shutil.copy(os.path.join(entry, 'state.wfns'), state_path)
+        self.touch(entry)
+        print(f"Initial state of '{input_path}' taken from '{entry}' at distance {d:.3e}.")
+        return d
+
+    # store the state a finished run dumped next to its input, and count its electronic iterations
+    def store(self, input_path):
+        input_path = os.path.abspath(input_path)
+        folder = os.path.dirname(input_path)
+        prefix = os.path.splitext(os.path.basename(input_path))[0]
+        description = describe(input_path)
+        state_path = os.path.join(folder, f"{description['name']}.wfns")
+        out_path = os.path.join(folder, f'{prefix}.out')
+        elec_iterations = ot.summarize_file(out_path)['elec_iterations'] if os.path.exists(out_path) else None
+        entry, d = self.seeds.pop(input_path, (None, None))
+        self.record(entry is not None, elec_iterations, d)
+        if not os.path.exists(state_path):
+            return
+        key = self.key(input_path)
+        if self.has(key):
+            self.touch(self.entry_path(key))
+            return
+        description.update({'source': input_path, 'elec_iterations': elec_iterations, 'seed_distance': d})
+        self.put(key, {'state.wfns': state_path}, description)
+
+    # electronic iterations of runs with and without a state from the store, in this session and across sessions
+    def record(self, seeded, elec_iterations, d):
+        if elec_iterations is None:
+            return
+        totals = self.totals(self.session_defaults())
+        for counts in [self.session, totals]:
+            counts['runs'] += 1
+            if seeded:
+                counts['seeded'] += 1
+                counts['elec_iterations_seeded'] += elec_iterations
+                counts['distance_seeded'] += d
+            else:
+                counts['elec_iterations_unseeded'] += elec_iterations
+        self.save_totals(totals)
+
+    # zero counts of every session counter
+    def session_defaults(self):
+        return {key: 0 for key in self.session}
+
+    # drop the description read from an evicted entry
+    def forget(self, entry):
+        self.meta.pop(entry, None)
+
+    def stats(self):
+        """
+        Electronic iterations of seeded and unseeded runs
+
+        Returns:
+            res: Dict with the session counts, the totals across sessions ('total_' prefix), the mean
+                electronic iterations of runs seeded from the store and of the others, the iterations
+                saved estimated from the difference of the two means, and the entries and bytes held
+        """
+        res = self.usage()
+        for prefix, counts in [('', self.session), ('total_', self.totals(self.session_defaults()))]:
+            unseeded = counts['runs'] - counts['seeded']
+            mean_seeded = counts['elec_iterations_seeded'] / counts['seeded'] if counts['seeded'] else None
+            mean_unseeded = counts['elec_iterations_unseeded'] / unseeded if unseeded else None
+            res.update({prefix + key: value for key, value in counts.items()})
+            res[prefix + 'mean_elec_iterations_seeded'] = mean_seeded
+            res[prefix + 'mean_elec_iterations_unseeded'] = mean_unseeded
+            res[prefix + 'elec_iterations_saved'] = None if mean_seeded is None or mean_unseeded is None else counts['seeded'] * (mean_unseeded - mean_seeded)
+        return res
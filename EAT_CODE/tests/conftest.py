@@ -0,0 +1,5 @@
+# make 'import modules.x' and 'import main' work from the tests, like the benchmarks do
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
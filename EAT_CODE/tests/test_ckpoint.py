@@ -0,0 +1,96 @@
+##################################################################################
+# Tests of the checkpoint: atomic round-trips and main.py --resume after a killed run
+##################################################################################
+
+import os
+import sys
+import pickle
+import subprocess
+import numpy as np
+import modules.ckpoint as ck
+import modules.etaanneal as ea
+import modules.minimize as mn
+
+code_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs main.py in the working folder and kills it right after its stop_after-th checkpoint (never if 0)
+driver = '''
+import os, sys, runpy
+code_dir = sys.argv[1]
+sys.path.insert(0, code_dir)
+import modules.ckpoint as ck
+stop_after = int(sys.argv[2])
+save_checkpoint = ck.save_checkpoint
+saves = []
+def save_and_stop(path, state):
+    save_checkpoint(path, state)
+    saves.append(path)
+    if len(saves) == stop_after:
+        os._exit(9)
+ck.save_checkpoint = save_and_stop
+sys.argv = ['main.py'] + sys.argv[3:]
+runpy.run_path(os.path.join(code_dir, 'main.py'), run_name='__main__')
+'''
+
+def run_main(folder, stop_after=0, resume=False):
+    args = [sys.executable, '-c', driver, code_dir, str(stop_after)] + (['--resume'] if resume else [])
+    return subprocess.run(args, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+# folder with 8 mixed sites and the fake backend
+def make_folder(folder):
+    os.makedirs(folder)
+    lines = [f'ion mix{i+1}  {0.25 * (i % 4):.3f}   {0.5 * (i // 4):.3f}    0.150 0' for i in range(8)]
+    lines.append('ion O     0.250   0.250    0.150 0')
+    with open(os.path.join(folder, 'positions.txt'), 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    with open(os.path.join(folder, 'jdftx_config.json'), 'w') as file:
+        file.write('{"backend": "fake", "cache": false}')
+    return folder
+
+# FINAL line, number of iterations in the progress file and final weights of a finished run
+def outcome(folder):
+    with open(os.path.join(folder, 'min_details.txt'), 'r') as file:
+        final = [line for line in file if line.startswith('FINAL')]
+    with open(os.path.join(folder, 'min_progress.txt'), 'r') as file:
+        iterations = sum(line.startswith('Iteration') for line in file)
+    return final, iterations, ck.load_checkpoint(os.path.join(folder, 'checkpoint.pkl'))['x']
+
+def test_round_trip(tmp_path):
+    B = mn.LimitedMemoryHessian(6, m=3, diag=2.0)
+    B.update(np.arange(6.0), np.arange(6.0) + 1)
+    state = {'epoch': 2, 'eta': 100.0, 'x': np.linspace(0, 1, 6), 'quasi_Hessian': B, 'annealing': ea.FixedFactor(10), 'opt': {'stage': 'line', 'k': 3}}
+    path = os.path.join(tmp_path, 'checkpoint.pkl')
+    ck.save_checkpoint(path, {'epoch': 1})
+    ck.save_checkpoint(path, state)
+    res = ck.load_checkpoint(path)
+    assert os.listdir(tmp_path) == ['checkpoint.pkl']
+    assert res['epoch'] == 2 and res['eta'] == 100.0 and res['opt'] == state['opt']
+    assert np.array_equal(res['x'], state['x'])
+    assert np.array_equal(res['quasi_Hessian'].dense(), B.dense())
+    assert vars(res['annealing']) == vars(state['annealing'])
+
+def test_failed_write_keeps_previous_checkpoint(tmp_path):
+    path = os.path.join(tmp_path, 'checkpoint.pkl')
+    ck.save_checkpoint(path, {'epoch': 1})
+    try:
+        ck.save_checkpoint(path, {'epoch': 2, 'unpicklable': lambda: None})
+    except (pickle.PicklingError, AttributeError):
+        pass
+    assert ck.load_checkpoint(path) == {'epoch': 1}
+
+def test_resume_matches_uninterrupted_run(tmp_path):
+    reference = make_folder(os.path.join(tmp_path, 'reference'))
+    assert run_main(reference) == 0
+    final, iterations, x = outcome(reference)
+    assert len(final) == 1
+    # killed in the first epoch and in a later one, then resumed until done
+    for stop_after in [3, 12]:
+        folder = make_folder(os.path.join(tmp_path, f'killed{stop_after}'))
+        assert run_main(folder, stop_after) == 9
+        assert run_main(folder, resume=True) == 0
+        with open(os.path.join(folder, 'min_details.txt'), 'r') as file:
+            assert 'Resuming minimization from checkpoint' in file.read()
+        res_final, res_iterations, res_x = outcome(folder)
+        assert res_final == final
+        assert res_iterations == iterations
+        assert np.array_equal(res_x, x)
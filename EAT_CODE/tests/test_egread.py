@@ -0,0 +1,52 @@
+##################################################################################
+# Tests of the .mixgrad reader: columns follow elements whatever order add-mix listed them in
+##################################################################################
+
+import os
+import numpy as np
+import modules.egread as eg
+
+elements = ['Mn', 'Cu', 'Ni']
+# gradient of every site by element, the value encodes site and element
+grads = {f'mix{i}': {element: 10 * i + j for j, element in enumerate(elements)} for i in range(1, 12)}
+# add-mix order of every site, sites listed in a different order than mix1 ... mix11
+mixes = {label: elements if i % 3 == 0 else elements[i % 3:] + elements[:i % 3] for i, label in enumerate(grads)}
+file_order = ['mix10', 'mix2', 'mix11', 'mix1'] + [f'mix{i}' for i in range(3, 10)]
+
+# O run of an evaluation in folder, with its input and .mixgrad
+def write_run(folder):
+    os.makedirs(os.path.join(folder, 'O'))
+    with open(os.path.join(folder, 'O', 'O.in'), 'w') as file:
+        for label in grads:
+            file.write(f"add-mix {label} {' '.join(mixes[label])}\n")
+    with open(os.path.join(folder, 'O', 'O.mixgrad'), 'w') as file:
+        file.write('mix name | atom | parameters\n')
+        for label in file_order:
+            file.write(f"{label}    0    {'    '.join(f'{grads[label][element]:.12f}' for element in mixes[label])}\n")
+        file.write('\n')
+
+def test_read_mix_elements(tmp_path):
+    write_run(tmp_path)
+    assert eg.read_mix_elements(os.path.join(tmp_path, 'O', 'O.in')) == mixes
+    assert eg.read_mix_elements(os.path.join(tmp_path, 'missing.in')) == {}
+
+def test_columns_follow_elements(tmp_path):
+    write_run(tmp_path)
+    grad, rows = eg.read_mixgrad(os.path.join(tmp_path, 'O', 'O.mixgrad'), elements, mixes)
+    assert grad.shape == (len(grads), len(elements))
+    # exact labels, mix1 is not confused with mix10 or mix11
+    assert rows == {label: i for i, label in enumerate(file_order)}
+    for label, i in rows.items():
+        assert list(grad[i]) == [grads[label][element] for element in elements]
+
+def test_columns_kept_without_mixes(tmp_path):
+    write_run(tmp_path)
+    grad, rows = eg.read_mixgrad(os.path.join(tmp_path, 'O', 'O.mixgrad'), elements)
+    for label, i in rows.items():
+        assert list(grad[i]) == [grads[label][element] for element in mixes[label]]
+
+def test_site_gradient_in_site_order(tmp_path):
+    write_run(tmp_path)
+    grad = eg.read_site_gradient('O', elements, str(tmp_path))
+    expected = np.array([[grads[f'mix{i}'][element] for element in elements] for i in range(1, 12)])
+    assert np.array_equal(grad, expected.flatten())
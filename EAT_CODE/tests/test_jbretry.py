@@ -0,0 +1,101 @@
+##################################################################################
+# Tests of the failure classification and retry of JDFTx runs
+##################################################################################
+
+import os
+import subprocess
+import pytest
+import modules.jbbackend as jb
+import modules.jbretry as jr
+
+# failed job in folder with the given log and, for a batch job, output of the job script
+def make_job(folder, log='', slurm_out=None, state=None, returncode=1):
+    job = jb.Job('O.in', 'O.out', folder, ranks=1)
+    job.state = state
+    job.returncode = returncode
+    with open(os.path.join(folder, 'O.out'), 'w') as file:
+        file.write(log)
+    if slurm_out is not None:
+        job.id = '1234'
+        with open(os.path.join(folder, 'slurm_out.o1234'), 'w') as file:
+            file.write(slurm_out)
+    return job
+
+stack_trace = 'Stack trace:\n\t0: jdftx(+0x1234)\nMPI_ABORT was invoked on rank 0 in communicator MPI_COMM_WORLD\n'
+
+@pytest.mark.parametrize('log, kind', [
+    ('Reading pseudopotential file SG15/Mn_ONCV_PBE.upf\nCould not open file SG15/Mn_ONCV_PBE.upf\n' + stack_trace, 'pseudopotential'),
+    ('Input parse error in command add-mix\n' + stack_trace, 'input'),
+    ('terminate called after throwing an instance of std::bad_alloc\n' + stack_trace, 'oom'),
+    ('ElecMinimize: None of the convergence criteria satisfied after 1000 iterations.\n', 'scf'),
+    (stack_trace, 'mpi'),
+    ('ElecMinimize: Iter: 10 F: -100.0\n', 'unknown'),
+])
+def test_log_kinds(tmp_path, log, kind):
+    assert jr.classify(make_job(tmp_path, log))[0] == kind
+
+def test_slurm_state_wins(tmp_path):
+    job = make_job(tmp_path, 'Input parse error\n', state='TIMEOUT')
+    assert jr.classify(job) == ('walltime', 'Slurm state TIMEOUT')
+
+@pytest.mark.parametrize('slurm_out, kind', [
+    ('slurmstepd: error: *** JOB 1234 ON node1 CANCELLED AT 2024-01-01T00:00:00 DUE TO TIME LIMIT ***\n', 'walltime'),
+    ('slurmstepd: error: *** JOB 1234 ON node1 CANCELLED AT 2024-01-01T00:00:00 ***\n', 'cancelled'),
+    ('slurmstepd: error: Detected 1 oom-kill event(s) in StepId=1234.0\n', 'oom'),
+])
+def test_job_script_output(tmp_path, slurm_out, kind):
+    assert jr.classify(make_job(tmp_path, 'ElecMinimize: Iter: 10\n', slurm_out))[0] == kind
+
+def test_exit_code_without_message(tmp_path):
+    assert jr.classify(make_job(tmp_path, returncode=137)) == ('oom', 'exit code 137')
+    assert jr.classify(make_job(tmp_path, returncode=-9))[0] == 'oom'
+    assert jr.classify(make_job(tmp_path, returncode=1)) == ('unknown', 'exit code 1')
+
+def test_only_the_tail_is_read(tmp_path):
+    job = make_job(tmp_path, 'Input parse error\n' + 'ElecMinimize: Iter: 10\n' * 100)
+    assert jr.classify(job)[0] == 'input'
+    assert jr.classify(job, {'tail_bytes': 1000})[0] == 'unknown'
+
+class ScriptedBackend:
+    """
+    Backend whose runs fail with the given logs, one per attempt, and succeed after them
+    """
+    def __init__(self, logs):
+        self.logs = list(logs)
+        self.submitted = 0
+
+    def submit(self, input_file, output_file, folder, ranks):
+        self.submitted += 1
+        return jb.Job(input_file, output_file, folder, ranks)
+
+    def wait(self, job):
+        if self.logs:
+            with open(os.path.join(job.folder, job.output_file), 'w') as file:
+                file.write(self.logs.pop(0))
+            job.returncode = 1
+            raise subprocess.CalledProcessError(1, 'jdftx')
+        job.returncode = 0
+
+def run_with_retries(folder, logs, max_retries=2):
+    with open(os.path.join(folder, 'O.in'), 'w') as file:
+        file.write('dump-name O.$VAR\n')
+    backend = ScriptedBackend(logs)
+    jobs = [backend.submit('O.in', 'O.out', folder, ranks=1)]
+    messages = []
+    jr.wait_jobs(backend, jobs, {'backoff': 0.0, 'max_retries': max_retries}, log=messages.append)
+    return backend, messages
+
+def test_transient_failures_are_resubmitted(tmp_path):
+    backend, messages = run_with_retries(tmp_path, [stack_trace, 'std::bad_alloc\n'])
+    assert backend.submitted == 3
+    assert sum('resubmitted' in message for message in messages) == 2
+    # the logs of the failed attempts are kept
+    assert os.path.exists(os.path.join(tmp_path, 'O.out.failed1')) and os.path.exists(os.path.join(tmp_path, 'O.out.failed2'))
+
+def test_permanent_failure_fails_the_trial(tmp_path):
+    with pytest.raises(jb.TrialFailed, match='input'):
+        run_with_retries(tmp_path, ['Input parse error\n'])
+
+def test_retries_run_out(tmp_path):
+    with pytest.raises(jb.TrialFailed, match='after 2 attempts'):
+        run_with_retries(tmp_path, [stack_trace] * 3, max_retries=1)
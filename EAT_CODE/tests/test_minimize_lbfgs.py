@@ -0,0 +1,77 @@
+##################################################################################
+# Tests of the limited-memory quasi-Hessian against the dense BFGS update
+##################################################################################
+
+import os
+import numpy as np
+import modules.minimize as mn
+
+# dense BFGS update of B with the pair (s, y)
+def bfgs(B, s, y):
+    Bs = B @ s
+    return B - np.outer(Bs, Bs) / (s @ Bs) + np.outer(y, y) / (s @ y)
+
+# pairs with positive curvature s.y, as the damped update produces
+def make_pairs(n, k, seed):
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(n, n))
+    C = A @ A.T / n + 0.5 * np.eye(n)
+    pairs = []
+    for _ in range(k):
+        s = rng.normal(size=n)
+        pairs.append((s, C @ s + 0.1 * rng.normal(size=n)))
+    return [(s, y) for s, y in pairs if s @ y > 0]
+
+def test_matches_dense_bfgs_within_memory():
+    n, m = 12, 5
+    d = np.linspace(0.5, 2.0, n)
+    B = mn.LimitedMemoryHessian(n, m=m, diag=d)
+    dense = np.diag(d)
+    v = np.arange(n, dtype=float)
+    assert np.allclose(B.dense(), dense) and np.allclose(B.dot(v), dense @ v)
+    for s, y in make_pairs(n, m, 0):
+        B.update(s, y)
+        dense = bfgs(dense, s, y)
+        assert np.allclose(B.dense(), dense, atol=1e-10)
+        assert np.allclose(B.dot(v), dense @ v, atol=1e-10)
+
+def test_keeps_the_last_pairs():
+    n, m = 10, 3
+    pairs = make_pairs(n, 8, 1)
+    B = mn.LimitedMemoryHessian(n, m=m, diag=1.5)
+    for s, y in pairs:
+        B.update(s, y)
+    # BFGS from the initial diagonal with only the last m pairs
+    dense = 1.5 * np.eye(n)
+    for s, y in pairs[-m:]:
+        dense = bfgs(dense, s, y)
+    assert B.S.shape == (n, m)
+    assert np.allclose(B.dense(), dense, atol=1e-10)
+
+def test_damped_update_matches_dense():
+    n = 8
+    rng = np.random.default_rng(2)
+    B = mn.LimitedMemoryHessian(n, m=10, diag=1.0)
+    dense = np.eye(n)
+    for k in range(6):
+        s = rng.normal(size=n)
+        # every other pair has negative curvature and is damped
+        y = s + 0.1 * rng.normal(size=n) if k % 2 == 0 else -s
+        B = mn.damped_update(B, s, y)
+        dense = mn.damped_update(dense, s, y)
+        assert np.allclose(B.dense(), dense, atol=1e-10)
+    # the damped updates keep B positive definite
+    assert np.linalg.eigvalsh(dense)[0] > 0
+
+def test_qp_matches_dense_hessian(tmp_path):
+    N, S = 6, 4
+    rng = np.random.default_rng(3)
+    B = mn.LimitedMemoryHessian(N * S, m=4, diag=2.0)
+    for s, y in make_pairs(N * S, 4, 3):
+        B.update(s, y)
+    x0 = rng.dirichlet(np.ones(S), size=N).flatten()
+    g = 3 * rng.normal(size=N * S)
+    details = os.path.join(tmp_path, 'details.txt')
+    x = mn.solve_quadratic_form_lm(x0, g, B, N, S, details)
+    reference = mn.solve_quadratic_form_dense(x0, g, B.dense(), N, S, details)
+    assert np.allclose(x, reference, atol=1e-8)
@@ -0,0 +1,41 @@
+##################################################################################
+# Tests of the active-set QP solver against the dense KKT reference
+##################################################################################
+
+import os
+import numpy as np
+import pytest
+import modules.minimize as mn
+
+# random positive definite H, point on the simplex and a gradient large enough to hit the bounds
+def make_problem(N, S, seed):
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(N * S, N * S))
+    H = A @ A.T / (N * S) + 0.1 * np.eye(N * S)
+    x0 = rng.dirichlet(np.ones(S), size=N).flatten()
+    g = 3 * rng.normal(size=N * S)
+    return x0, g, H
+
+@pytest.mark.parametrize('N, S, seed', [(1, 2, 0), (4, 3, 1), (8, 5, 2), (16, 4, 3), (32, 6, 4)])
+def test_matches_dense(tmp_path, N, S, seed):
+    x0, g, H = make_problem(N, S, seed)
+    details = os.path.join(tmp_path, 'details.txt')
+    reference = mn.solve_quadratic_form_dense(x0, g, H, N, S, details)
+    for refresh in [1, 3, 50]:
+        x = mn.solve_quadratic_form(x0, g, H, N, S, details, refresh=refresh)
+        assert np.allclose(x, reference, atol=1e-8)
+    # the minimizer is on the simplex and some bounds are active
+    assert np.all(reference >= -1e-6)
+    assert np.allclose(reference.reshape(N, S).sum(axis=1), 1)
+    if N > 1:
+        assert np.any(np.abs(reference) < 1e-12)
+
+def test_indefinite_hessian_matches_dense(tmp_path):
+    N, S = 6, 3
+    x0, g, H = make_problem(N, S, 5)
+    # both solvers clamp the eigenvalues of an indefinite H the same way
+    H -= 0.5 * np.eye(N * S) * np.linalg.eigvalsh(H)[-1]
+    details = os.path.join(tmp_path, 'details.txt')
+    reference = mn.solve_quadratic_form_dense(x0, g, H, N, S, details)
+    x = mn.solve_quadratic_form(x0, g, H, N, S, details)
+    assert np.allclose(x, reference, atol=1e-6)
@@ -0,0 +1,66 @@
+##################################################################################
+# Tests of the result cache: hits restore the outputs, least recently used entries are evicted
+##################################################################################
+
+import os
+import modules.rescache as rc
+
+# run folder holding an input and every cached output, outputs tagged with the input contents
+def make_run(folder, contents):
+    os.makedirs(folder, exist_ok=True)
+    input_path = os.path.join(folder, 'O.in')
+    with open(input_path, 'w') as file:
+        file.write(contents)
+    for extension in rc.cached_extensions:
+        with open(os.path.join(folder, f'O.{extension}'), 'w') as file:
+            file.write(f'{extension} of {contents}\n' * 10)
+    return input_path
+
+def test_fetch_restores_stored_outputs(tmp_path):
+    cache = rc.ResultCache(tmp_path / 'cache', identity='jdftx-1')
+    cache.store(make_run(tmp_path / 'run1', 'input a'))
+    # same input in a fresh folder
+    input_path = os.path.join(tmp_path, 'run2', 'O.in')
+    os.makedirs(os.path.dirname(input_path))
+    with open(input_path, 'w') as file:
+        file.write('input a')
+    assert cache.fetch(input_path)
+    for extension in rc.cached_extensions:
+        with open(os.path.join(tmp_path, 'run2', f'O.{extension}'), 'r') as file:
+            assert file.read() == f'{extension} of input a\n' * 10
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 0, 1)
+
+def test_key_depends_on_binary_identity(tmp_path):
+    input_path = make_run(tmp_path / 'run', 'input a')
+    rc.ResultCache(tmp_path / 'cache', identity='jdftx-1').store(input_path)
+    cache = rc.ResultCache(tmp_path / 'cache', identity='jdftx-2')
+    assert not cache.fetch(input_path)
+    # the totals of both sessions are kept on disk
+    assert cache.stats()['total_misses'] == 1
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = rc.ResultCache(tmp_path / 'cache', identity='jdftx-1')
+    inputs = {name: make_run(tmp_path / name, f'input {name}') for name in ['a', 'b', 'c']}
+    cache.store(inputs['a'])
+    # room for two entries
+    cache.max_bytes = int(2.5 * cache.usage()['bytes'])
+    cache.store(inputs['b'])
+    # a is older than b, until it is used again
+    os.utime(cache.entry_path(cache.key(inputs['a'])), (100, 100))
+    os.utime(cache.entry_path(cache.key(inputs['b'])), (200, 200))
+    assert cache.fetch(inputs['a'])
+    cache.store(inputs['c'])
+    assert cache.has(cache.key(inputs['a']))
+    assert not cache.has(cache.key(inputs['b']))
+    assert cache.has(cache.key(inputs['c']))
+    assert cache.usage()['entries'] == 2
+    assert cache.usage()['bytes'] <= cache.max_bytes
+
+def test_incomplete_entries_are_ignored(tmp_path):
+    cache = rc.ResultCache(tmp_path / 'cache', identity='jdftx-1')
+    input_path = make_run(tmp_path / 'run', 'input a')
+    # an entry left behind by a run killed while writing it has no meta.json
+    os.makedirs(cache.entry_path(cache.key(input_path)) + '.tmp123')
+    assert not cache.fetch(input_path)
+    assert cache.usage()['entries'] == 0
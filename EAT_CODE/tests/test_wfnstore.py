@@ -0,0 +1,54 @@
+##################################################################################
+# Tests of the wavefunction store: runs start from the nearest state, LRU entries are evicted
+##################################################################################
+
+import os
+import modules.wfnstore as ws
+
+# O run of two Mn/Cu sites with Mn weight w, and the state it dumped
+def make_run(folder, w, name='O'):
+    os.makedirs(folder, exist_ok=True)
+    input_path = os.path.join(folder, f'{name}.in')
+    with open(input_path, 'w') as file:
+        file.write(f'initial-state {name}.$VAR\ndump-name {name}.$VAR\ndump End State\n')
+        file.write('lattice \\\n\t8.0 8.0 0.0 \\\n\t8.0 -8.0 0.0 \\\n\t0.0 0.0 40.0\n')
+        file.write('add-mix mix1 Mn Cu\nadd-mix mix2 Mn Cu\n')
+        file.write(f'ion mix1 {w} {1 - w} 0.000 0.000 0.150 0\nion mix2 {w} {1 - w} 0.500 0.000 0.150 0\n')
+        file.write('ion O 0.250 0.250 0.150 0\n')
+    with open(os.path.join(folder, f'{name}.wfns'), 'w') as file:
+        file.write(f'state of {w}\n' * 50)
+    return input_path
+
+def read_state(folder, name='O'):
+    with open(os.path.join(folder, f'{name}.wfns'), 'r') as file:
+        return file.read()
+
+def test_seed_copies_nearest_state(tmp_path):
+    store = ws.WavefunctionStore(tmp_path / 'store')
+    store.store(make_run(tmp_path / 'a', 0.2))
+    store.store(make_run(tmp_path / 'b', 0.8))
+    input_path = make_run(tmp_path / 'new', 0.7)
+    d = store.seed(input_path)
+    assert read_state(tmp_path / 'new') == 'state of 0.8\n' * 50
+    assert abs(d - 0.2) < 1e-12
+    # an OH run cannot start from an O state
+    assert store.seed(make_run(tmp_path / 'oh', 0.7, name='OH')) is None
+
+def test_evicts_least_recently_used(tmp_path):
+    store = ws.WavefunctionStore(tmp_path / 'store')
+    inputs = {name: make_run(tmp_path / name, w) for name, w in [('a', 0.1), ('b', 0.5), ('c', 0.9)]}
+    store.store(inputs['a'])
+    # room for two entries
+    store.max_bytes = int(2.5 * store.usage()['bytes'])
+    store.store(inputs['b'])
+    entries = {name: store.entry_path(store.key(inputs[name])) for name in inputs}
+    # a is older than b, until it seeds a run
+    os.utime(entries['a'], (100, 100))
+    os.utime(entries['b'], (200, 200))
+    store.seed(make_run(tmp_path / 'new', 0.15))
+    assert read_state(tmp_path / 'new') == 'state of 0.1\n' * 50
+    store.store(inputs['c'])
+    assert [store.has(store.key(inputs[name])) for name in 'abc'] == [True, False, True]
+    # the description read from the evicted entry is dropped with it
+    assert entries['b'] not in store.meta
+    assert store.usage()['bytes'] <= store.max_bytes